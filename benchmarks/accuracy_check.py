@@ -0,0 +1,135 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from PIL import Image
+from models.cpu_inference import apply_cpu_profile
+from utils.postprocessing import extract_object_crop
+from utils.preprocessing import get_image_paths
+
+def mask_iou(mask, other):
+    """
+    Intersection over union of two BinaryMasks of the same image.
+    """
+    mask, other = mask.to_array(), other.to_array()
+    union = np.count_nonzero(mask | other)
+    if union == 0:
+        return 1.0
+    return np.count_nonzero(mask & other) / union
+
+def match_masks(reference_objects, candidate_objects):
+    """
+    Greedily pair each reference object with its best unused candidate by mask IoU; unmatched objects score 0.
+    """
+    unused = list(range(len(candidate_objects)))
+    ious = []
+    for obj in reference_objects:
+        scores = [(mask_iou(obj['mask'], candidate_objects[i]['mask']), i) for i in unused]
+        best_iou, best = max(scores, default=(0.0, None))
+        if best is not None and best_iou > 0:
+            unused.remove(best)
+        ious.append(best_iou)
+    return ious
+
+def check_accuracy(reference_model, candidate_model, image_paths):
+    """
+    Compare a candidate SegmentationModel (e.g. with the CPU profile) against an fp32 reference:
+    mask IoU of matched detections, and top-1 category agreement on the reference crops.
+    """
+    ious = []
+    agreements = []
+    detection_delta = 0
+    reference_seconds = candidate_seconds = 0.0
+
+    for image_path in image_paths:
+        started = time.perf_counter()
+        reference_objects, image = reference_model.segment_image(image_path)
+        crops = []
+        frame = np.asarray(image)
+        for obj in reference_objects:
+            crop, _ = extract_object_crop(frame, obj['mask'], obj['bbox'])
+            if crop is not None:
+                crops.append(Image.fromarray(crop))
+        reference_predictions = reference_model.identification_model.identify_objects(crops)
+        reference_seconds += time.perf_counter() - started
+
+        started = time.perf_counter()
+        candidate_objects, _ = candidate_model.segment_image(image_path)
+        candidate_predictions = candidate_model.identification_model.identify_objects(crops)
+        candidate_seconds += time.perf_counter() - started
+
+        ious.extend(match_masks(reference_objects, candidate_objects))
+        detection_delta += abs(len(candidate_objects) - len(reference_objects))
+        agreements.extend(reference[0][0] == candidate[0][0]
+                          for reference, candidate in zip(reference_predictions, candidate_predictions))
+
+    return {
+        'images': len(image_paths),
+        'objects': len(ious),
+        'mean_mask_iou': float(np.mean(ious)) if ious else 1.0,
+        'min_mask_iou': float(np.min(ious)) if ious else 1.0,
+        'detection_count_delta': detection_delta,
+        'top1_agreement': float(np.mean(agreements)) if agreements else 1.0,
+        'reference_seconds': reference_seconds,
+        'candidate_seconds': candidate_seconds,
+    }
+
+def _stub_setup(work_dir, num_images, num_objects):
+    from benchmarks.stubs import make_synthetic_image, make_stub_segmentation_model
+    image_paths = []
+    for i in range(num_images):
+        image_path = os.path.join(work_dir, f"synthetic_{i}.png")
+        make_synthetic_image(320, 240, num_objects, seed=i).save(image_path)
+        image_paths.append(image_path)
+    factory = lambda: make_stub_segmentation_model(num_objects, use_result_cache=False)
+    return image_paths, factory
+
+def _pretrained_factory():
+    from models.registry import load_detector, load_identification_model
+    from models.segmentation_model import SegmentationModel
+    return SegmentationModel(use_result_cache=False, detector=load_detector(),
+                             identification_model=load_identification_model())
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare the CPU inference profile against fp32.")
+    parser.add_argument("--input-dir", default="data/input_images")
+    parser.add_argument("--limit", type=int, default=10, help="number of sample images")
+    parser.add_argument("--stub", action="store_true", help="use synthetic images and stub models (offline)")
+    parser.add_argument("--no-quantize", action="store_true")
+    parser.add_argument("--no-channels-last", action="store_true")
+    parser.add_argument("--intra-op-threads", type=int)
+    parser.add_argument("--inter-op-threads", type=int)
+    parser.add_argument("--min-top1-agreement", type=float, default=0.95)
+    parser.add_argument("--min-mask-iou", type=float, default=0.9)
+    args = parser.parse_args(argv)
+
+    if args.stub:
+        import tempfile
+        work_dir = tempfile.mkdtemp(prefix="accuracy_")
+        image_paths, factory = _stub_setup(work_dir, args.limit, 8)
+    else:
+        image_paths, factory = get_image_paths(args.input_dir)[:args.limit], _pretrained_factory
+
+    reference_model = factory()
+    candidate_model = apply_cpu_profile(factory(), quantize=not args.no_quantize,
+                                        channels_last=not args.no_channels_last,
+                                        intra_op_threads=args.intra_op_threads,
+                                        inter_op_threads=args.inter_op_threads)
+    try:
+        report = check_accuracy(reference_model, candidate_model, image_paths)
+    finally:
+        reference_model.close()
+        candidate_model.close()
+
+    report['passed'] = (report['top1_agreement'] >= args.min_top1_agreement and
+                        report['mean_mask_iou'] >= args.min_mask_iou)
+    print(json.dumps(report, indent=2))
+    return 0 if report['passed'] else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,192 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+from benchmarks.stubs import make_synthetic_image, make_stub_segmentation_model
+from utils.crop_store import CropStore
+from utils.preprocessing import load_image
+from utils.postprocessing import extract_and_save_objects, save_object_metadata
+from utils.data_mapping import generate_object_descriptions
+from utils.storage import close_stores
+
+DEFAULT_CONFIG = {
+    'width': 1280,
+    'height': 960,
+    'objects': 15,
+    'images': 4,
+    'repeat': 3,
+    'seed': 0,
+}
+
+def _time(func, repeat):
+    """
+    Run func repeat times; return its last result and the wall times in seconds.
+    """
+    times = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - started)
+    return result, times
+
+def _summarize(times, images):
+    return {
+        'mean_s': sum(times) / len(times),
+        'min_s': min(times),
+        'max_s': max(times),
+        'per_image_s': min(times) / images,
+    }
+
+def run_benchmarks(config=None, work_dir=None):
+    """
+    Time each pipeline stage on synthetic images with stub models and return a JSON-serializable report.
+    Every stage runs over all images; min_s is the best of `repeat` runs.
+    """
+    config = dict(DEFAULT_CONFIG, **(config or {}))
+    own_work_dir = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix="benchmark_")
+    output_dir = os.path.join(work_dir, "output")
+    db_path = os.path.join(work_dir, "objects.db")
+    repeat = config['repeat']
+
+    try:
+        model = make_stub_segmentation_model(config['objects'], seed=config['seed'], use_result_cache=False)
+        images = [make_synthetic_image(config['width'], config['height'], config['objects'], seed=config['seed'] + i)
+                  for i in range(config['images'])]
+        image_paths = []
+        for i, image in enumerate(images):
+            image_path = os.path.join(work_dir, f"synthetic_{i}.png")
+            image.save(image_path)
+            image_paths.append(image_path)
+
+        stages = {}
+        jpeg_paths = []
+        for i, image in enumerate(images):
+            jpeg_path = os.path.join(work_dir, f"synthetic_{i}.jpg")
+            image.save(jpeg_path, quality=90)
+            jpeg_paths.append(jpeg_path)
+        _, times = _time(lambda: [load_image(path) for path in jpeg_paths], repeat)
+        stages['decode_jpeg'] = _summarize(times, len(images))
+        # Decoding for a quarter-size inference input lets draft mode skip most of the IDCT work
+        draft_size = max(config['width'], config['height']) // 4
+        _, times = _time(lambda: [load_image(path, draft_size, full_resolution=False) for path in jpeg_paths], repeat)
+        stages['decode_jpeg_draft'] = _summarize(times, len(images))
+
+        predictions = [model.predict([model.image_tensor(image)])[0] for image in images]
+
+        segmented, times = _time(lambda: [model.postprocess_prediction(p) for p in predictions], repeat)
+        stages['segment_postprocess'] = _summarize(times, len(images))
+
+        def extract():
+            return [extract_and_save_objects(objects, image, path, output_dir, db_path, save_metadata=False)
+                    for objects, image, path in zip(segmented, images, image_paths)]
+        extracted, times = _time(extract, repeat)
+        stages['extract'] = _summarize(times, len(images))
+
+        crop_store = CropStore(os.path.join(work_dir, "shards"))
+        _, times = _time(lambda: [extract_and_save_objects(objects, image, path, output_dir, db_path,
+                                                           save_metadata=False, crop_store=crop_store)
+                                  for objects, image, path in zip(segmented, images, image_paths)], repeat)
+        crop_store.close()
+        stages['extract_shards'] = _summarize(times, len(images))
+
+        crops = [[obj['image'] for obj in objects] for objects in extracted]
+        predictions, times = _time(lambda: [model.identification_model.identify_objects(c) for c in crops], repeat)
+        stages['identify'] = _summarize(times, len(images))
+
+        for objects, image_predictions in zip(extracted, predictions):
+            for obj, prediction in zip(objects, image_predictions):
+                obj['category'], obj['confidence'] = prediction[0]
+
+        # Each repeat inserts the rows again under fresh ids
+        runs = itertools.count()
+        def write_rows():
+            run = next(runs)
+            for objects in extracted:
+                save_object_metadata(db_path, [dict(obj, id=f"{obj['id']}-{run}") for obj in objects])
+        _, times = _time(write_rows, repeat)
+        stages['sqlite_write'] = _summarize(times, len(images))
+
+        _, times = _time(lambda: [model.visualize_segmentation(image, objects)
+                                  for image, objects in zip(images, segmented)], repeat)
+        stages['visualize'] = _summarize(times, len(images))
+
+        descriptions_path = os.path.join(work_dir, "object_descriptions.json")
+        _, times = _time(lambda: generate_object_descriptions(db_path, descriptions_path), repeat)
+        stages['describe'] = _summarize(times, len(images))
+
+        _, times = _time(lambda: generate_object_descriptions(db_path, descriptions_path + "l", streaming=True), repeat)
+        stages['describe_streaming'] = _summarize(times, len(images))
+
+        return {
+            'config': config,
+            'environment': {
+                'python': platform.python_version(),
+                'torch': torch.__version__,
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+            },
+            'objects_per_image': sum(len(objects) for objects in extracted) / len(images),
+            'stages': stages,
+        }
+    finally:
+        close_stores()
+        if own_work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+def compare_to_baseline(report, baseline, tolerance=0.2):
+    """
+    List stages whose best time per image is more than `tolerance` slower than in the baseline report.
+    """
+    regressions = []
+    for stage, result in report['stages'].items():
+        if stage not in baseline.get('stages', {}):
+            continue
+        before = baseline['stages'][stage]['per_image_s']
+        after = result['per_image_s']
+        if before > 0 and after > before * (1 + tolerance):
+            regressions.append({'stage': stage, 'baseline_s': before, 'current_s': after,
+                                'ratio': after / before})
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline per-stage benchmarks with stub models.")
+    parser.add_argument("--width", type=int, default=DEFAULT_CONFIG['width'])
+    parser.add_argument("--height", type=int, default=DEFAULT_CONFIG['height'])
+    parser.add_argument("--objects", type=int, default=DEFAULT_CONFIG['objects'])
+    parser.add_argument("--images", type=int, default=DEFAULT_CONFIG['images'])
+    parser.add_argument("--repeat", type=int, default=DEFAULT_CONFIG['repeat'])
+    parser.add_argument("--seed", type=int, default=DEFAULT_CONFIG['seed'])
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--baseline", help="JSON report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed slowdown per stage relative to the baseline (0.2 = 20%%)")
+    args = parser.parse_args(argv)
+
+    config = {key: getattr(args, key) for key in DEFAULT_CONFIG}
+    report = run_benchmarks(config)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            report['regressions'] = compare_to_baseline(report, json.load(f), args.tolerance)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    print(output)
+
+    return 1 if report.get('regressions') else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,123 @@
+import zlib
+import numpy as np
+import torch
+from PIL import Image
+from transformers import CLIPConfig, CLIPModel, CLIPImageProcessor
+from models.identification_model import IdentificationModel
+from models.segmentation_model import SegmentationModel
+
+def synthetic_layout(width, height, num_objects, seed=0):
+    """
+    Deterministic object boxes (x1, y1, x2, y2) and scores for an image size.
+    """
+    rng = np.random.default_rng([seed, width, height, num_objects])
+    objects = []
+    for _ in range(num_objects):
+        box_width = int(rng.integers(max(4, width // 12), max(5, width // 3)))
+        box_height = int(rng.integers(max(4, height // 12), max(5, height // 3)))
+        x1 = int(rng.integers(0, width - box_width))
+        y1 = int(rng.integers(0, height - box_height))
+        objects.append({'box': (x1, y1, x1 + box_width, y1 + box_height),
+                        'score': float(rng.uniform(0.5, 1.0)),
+                        'label': int(rng.integers(1, 91)),
+                        'color': rng.integers(0, 255, 3, dtype=np.uint8)})
+    return objects
+
+def _ellipse(box, width, height):
+    """
+    Soft elliptical mask in [0, 1] filling box, as a full-frame float32 array.
+    """
+    x1, y1, x2, y2 = box
+    ys, xs = np.ogrid[y1:y2, x1:x2]
+    cx, cy = (x1 + x2 - 1) / 2, (y1 + y2 - 1) / 2
+    rx, ry = max((x2 - x1) / 2, 1), max((y2 - y1) / 2, 1)
+    distance = ((xs - cx) / rx) ** 2 + ((ys - cy) / ry) ** 2
+    mask = np.zeros((height, width), dtype=np.float32)
+    mask[y1:y2, x1:x2] = np.clip(1.5 - distance, 0, 1)
+    return mask
+
+def make_synthetic_image(width, height, num_objects, seed=0):
+    """
+    Noisy background with one colored ellipse per object of synthetic_layout.
+    """
+    rng = np.random.default_rng([seed, width, height])
+    pixels = rng.integers(0, 64, (height, width, 3), dtype=np.uint8)
+    for obj in synthetic_layout(width, height, num_objects, seed):
+        pixels[_ellipse(obj['box'], width, height) > 0.5] = obj['color']
+    return Image.fromarray(pixels)
+
+class StubMaskRCNN(torch.nn.Module):
+    """
+    Returns Mask R-CNN shaped predictions (full-frame soft masks, boxes, scores, labels)
+    for the synthetic_layout of each input's size.
+    """
+    def __init__(self, num_objects, seed=0):
+        super().__init__()
+        self.num_objects = num_objects
+        self.seed = seed
+
+    def forward(self, images):
+        predictions = []
+        for image in images:
+            height, width = image.shape[-2:]
+            layout = synthetic_layout(width, height, self.num_objects, self.seed)
+            masks = np.stack([_ellipse(obj['box'], width, height) for obj in layout]) if layout else \
+                np.zeros((0, height, width), dtype=np.float32)
+            predictions.append({
+                'masks': torch.from_numpy(masks)[:, None].to(image.device),
+                'boxes': torch.tensor([obj['box'] for obj in layout], dtype=torch.float32).reshape(-1, 4),
+                'scores': torch.tensor([obj['score'] for obj in layout], dtype=torch.float32),
+                'labels': torch.tensor([obj['label'] for obj in layout], dtype=torch.int64),
+            })
+        return predictions
+
+class StubCLIPProcessor:
+    """
+    CLIPProcessor replacement: a real CLIPImageProcessor at a small resolution and a hashing tokenizer.
+    """
+    vocab_size = 1000
+    eos_token_id = vocab_size - 1
+
+    def __init__(self, image_size=32):
+        self.image_processor = CLIPImageProcessor(size={"shortest_edge": image_size},
+                                                  crop_size={"height": image_size, "width": image_size})
+
+    def tokenize(self, text):
+        ids = [zlib.crc32(word.encode("utf-8")) % (self.eos_token_id - 1) + 1 for word in text.split()]
+        return ids + [self.eos_token_id]
+
+    def __call__(self, text=None, images=None, return_tensors="pt", padding=True):
+        inputs = {}
+        if text is not None:
+            token_ids = [self.tokenize(t) for t in text]
+            length = max(len(ids) for ids in token_ids)
+            inputs["input_ids"] = torch.tensor([ids + [0] * (length - len(ids)) for ids in token_ids])
+            inputs["attention_mask"] = torch.tensor([[1] * len(ids) + [0] * (length - len(ids)) for ids in token_ids])
+        if images is not None:
+            inputs["pixel_values"] = self.image_processor(images=images, return_tensors="pt")["pixel_values"]
+        return inputs
+
+def make_stub_clip(image_size=32, seed=0):
+    """
+    Small randomly initialized CLIPModel with a fixed seed, and its matching StubCLIPProcessor.
+    """
+    torch.manual_seed(seed)
+    config = CLIPConfig(
+        text_config=dict(vocab_size=StubCLIPProcessor.vocab_size, hidden_size=32, intermediate_size=64,
+                         num_hidden_layers=2, num_attention_heads=2, max_position_embeddings=16,
+                         bos_token_id=0, eos_token_id=StubCLIPProcessor.eos_token_id),
+        vision_config=dict(hidden_size=32, intermediate_size=64, num_hidden_layers=2, num_attention_heads=2,
+                           image_size=image_size, patch_size=8),
+        projection_dim=16)
+    return CLIPModel(config).eval(), StubCLIPProcessor(image_size)
+
+def make_stub_identification_model(seed=0):
+    model, processor = make_stub_clip(seed=seed)
+    return IdentificationModel(model_name="stub-clip", cache_dir=None, model=model, processor=processor)
+
+def make_stub_segmentation_model(num_objects, seed=0, **kwargs):
+    """
+    SegmentationModel wired to StubMaskRCNN and a stub IdentificationModel.
+    """
+    return SegmentationModel(detector=StubMaskRCNN(num_objects, seed),
+                             identification_model=make_stub_identification_model(seed), **kwargs)
@@ -0,0 +1,85 @@
+import logging
+import torch
+
+logger = logging.getLogger(__name__)
+
+def configure_threads(intra_op_threads=None, inter_op_threads=None):
+    """
+    Set torch's intra-op and inter-op thread pools. The inter-op pool can only be sized
+    before the first parallel operation in the process, so a late call is logged and ignored.
+    """
+    if intra_op_threads:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads:
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError as e:
+            logger.warning(f"Could not set inter-op threads to {inter_op_threads}: {e}")
+    logger.info(f"Torch threads: intra-op {torch.get_num_threads()}, inter-op {torch.get_num_interop_threads()}")
+
+def quantize_linear_layers(module):
+    """
+    Replace the nn.Linear layers of module, in place, with dynamically quantized int8 versions.
+    """
+    from torch.ao.quantization import quantize_dynamic
+    return quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+def cpu_profile(quantize, channels_last):
+    """
+    Description of a model's CPU profile, recorded on it so result and text embedding caches keep
+    profiled outputs apart from fp32 ones.
+    """
+    return {'quantized': quantize, 'channels_last': channels_last, 'inference_context': 'inference_mode'}
+
+def optimize_identification_model(identification_model, quantize=True, channels_last=True):
+    """
+    Switch a CPU IdentificationModel to int8 linear layers, channels_last pixel inputs and inference_mode.
+    The text embedding bank is kept as computed at load time.
+    """
+    if identification_model.device.type != "cpu":
+        logger.warning("Skipping CPU profile for identification model on a non-CPU device")
+        return identification_model
+
+    if quantize:
+        quantize_linear_layers(identification_model.model)
+    if channels_last:
+        identification_model.model.to(memory_format=torch.channels_last)
+        identification_model.memory_format = torch.channels_last
+    identification_model.inference_context = torch.inference_mode
+    identification_model.cpu_profile = cpu_profile(quantize, channels_last)
+    return identification_model
+
+def optimize_detector(segmentation_model, quantize=True, channels_last=True):
+    """
+    Switch a CPU SegmentationModel's detector to the CPU profile. Only the Mask R-CNN box head
+    (fc6/fc7) is quantized: the box predictor and the convolutional mask head stay fp32
+    so box coordinates, scores and masks keep full precision.
+    """
+    if segmentation_model.device.type != "cpu":
+        logger.warning("Skipping CPU profile for detector on a non-CPU device")
+        return segmentation_model
+
+    detector = segmentation_model.model
+    if quantize:
+        box_head = getattr(getattr(detector, 'roi_heads', None), 'box_head', None)
+        if box_head is not None:
+            quantize_linear_layers(box_head)
+        else:
+            logger.warning(f"Detector {type(detector).__name__} has no roi_heads.box_head; not quantized")
+    if channels_last:
+        detector.to(memory_format=torch.channels_last)
+    segmentation_model.inference_context = torch.inference_mode
+    segmentation_model.cpu_profile = cpu_profile(quantize, channels_last)
+    return segmentation_model
+
+def apply_cpu_profile(segmentation_model, quantize=True, channels_last=True, intra_op_threads=None,
+                      inter_op_threads=None):
+    """
+    Opt-in CPU inference profile for a SegmentationModel and its identification model.
+    Models are changed in place, so with the shared registry every user of them gets the profile;
+    build separate instances to keep an fp32 reference.
+    """
+    configure_threads(intra_op_threads, inter_op_threads)
+    optimize_detector(segmentation_model, quantize, channels_last)
+    optimize_identification_model(segmentation_model.identification_model, quantize, channels_last)
+    return segmentation_model
@@ -1,9 +1,16 @@
 import torch
 from PIL import Image
-from transformers import CLIPProcessor, CLIPModel
+import numpy as np
 import sqlite3
 import json
 import logging
+import hashlib
+import os
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "cache")
 
 class IdentificationModel:
     object_categories = [
@@ -19,28 +26,133 @@ class IdentificationModel:
         "clock", "vase", "scissors", "teddy bear", "hair drier", "toothbrush"
     ]
 
-    def __init__(self):
+    prompt_template = "a photo of a {}"
+
+    def __init__(self, model_name="openai/clip-vit-base-patch32", cache_dir=DEFAULT_CACHE_DIR, model=None, processor=None):
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        self.model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32").to(self.device)
-        self.processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
+        self.model_name = model_name
+        self.cache_dir = cache_dir
+        self.inference_context = torch.no_grad
+        self.memory_format = torch.contiguous_format
+        # Set by models.cpu_inference when it changes the model's numerics; part of cache keys
+        self.cpu_profile = None
+        if model is None or processor is None:
+            from transformers import CLIPProcessor, CLIPModel
+        if model is None:
+            model = CLIPModel.from_pretrained(model_name)
+        self.model = model.to(self.device)
+        self.model.eval()
+        self.processor = processor if processor is not None else CLIPProcessor.from_pretrained(model_name)
+        self.text_embeddings = self.load_text_embeddings()
 
-    def identify_object(self, image_path):
-        image = Image.open(image_path)
-        inputs = self.processor(
-            text=["a photo of a " + obj for obj in self.object_categories], 
-            images=image, return_tensors="pt", padding=True
-        )
+    def category_prompts(self):
+        return [self.prompt_template.format(obj) for obj in self.object_categories]
+
+    def text_embedding_cache_path(self, prompts):
+        """
+        Path of the on-disk text embedding bank for this model, its CPU profile if any, and prompt list.
+        """
+        parts = [self.model_name] + prompts
+        if self.cpu_profile is not None:
+            parts.append(json.dumps(self.cpu_profile, sort_keys=True))
+        key = hashlib.sha1("\n".join(parts).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, f"clip_text_{key}.pt")
+
+    def load_text_embeddings(self, prompts=None):
+        """
+        Load the L2-normalized text embeddings of prompts (default: the category prompts),
+        encoding and caching them on a miss.
+        """
+        prompts = prompts or self.category_prompts()
+        cache_path = self.text_embedding_cache_path(prompts) if self.cache_dir else None
+
+        if cache_path and os.path.exists(cache_path):
+            logger.info(f"Loading text embedding bank from {cache_path}")
+            return torch.load(cache_path, map_location=self.device)
+
+        text_embeddings = self.encode_text(prompts)
+
+        if cache_path:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            torch.save(text_embeddings.cpu(), cache_path)
+            logger.info(f"Saved text embedding bank to {cache_path}")
+
+        return text_embeddings
+
+    def encode_text(self, prompts):
+        """
+        Encode prompts with the CLIP text tower and L2-normalize the result.
+        """
+        metrics.increment('identify.text_encodes', len(prompts))
+        inputs = self.processor(text=prompts, return_tensors="pt", padding=True)
         inputs = {k: v.to(self.device) for k, v in inputs.items()}
 
-        with torch.no_grad():
-            outputs = self.model(**inputs)
+        with self.inference_context():
+            pooled_output = self.model.text_model(**inputs)[1]
+            text_embeddings = self.model.text_projection(pooled_output)
 
-        logits_per_image = outputs.logits_per_image
-        probs = logits_per_image.softmax(dim=1)
-        
-        top_prob, top_idx = probs.topk(1)
-        predicted_category = self.object_categories[top_idx.item()]
-        confidence = top_prob.item()
+        return text_embeddings / text_embeddings.norm(dim=-1, keepdim=True)
 
-        return predicted_category, confidence
+    def encode_images(self, images):
+        """
+        Encode images with the CLIP vision tower and L2-normalize the result.
+        """
+        inputs = self.processor(images=images, return_tensors="pt")
+        pixel_values = inputs["pixel_values"].to(self.device, memory_format=self.memory_format)
 
+        with self.inference_context():
+            pooled_output = self.model.vision_model(pixel_values=pixel_values)[1]
+            image_embeddings = self.model.visual_projection(pooled_output)
+
+        return image_embeddings / image_embeddings.norm(dim=-1, keepdim=True)
+
+    def classify_embeddings(self, image_embeddings):
+        """
+        Score image embeddings against the text embedding bank, as CLIP's logits_per_image does.
+        """
+        with self.inference_context():
+            logit_scale = self.model.logit_scale.exp()
+            logits_per_image = logit_scale * image_embeddings @ self.text_embeddings.t()
+
+        return logits_per_image.softmax(dim=1)
+
+    def load_crop(self, crop):
+        """
+        Accept a crop as a file path, PIL image or HxWxC uint8 array.
+        """
+        if isinstance(crop, Image.Image):
+            return crop
+        if isinstance(crop, np.ndarray):
+            return Image.fromarray(crop)
+        return Image.open(crop)
+
+    def identify_objects(self, crops, top_k=1, batch_size=32, return_embeddings=False):
+        """
+        Identify a list of crops in batches of batch_size.
+        Returns, for each crop, a list of top_k (category, confidence) tuples;
+        with return_embeddings, also an (n, dim) float32 array of the crops' image embeddings.
+        """
+        top_k = min(top_k, len(self.object_categories))
+        results = []
+        embeddings = []
+        metrics.increment('identify.crops', len(crops))
+
+        for start in range(0, len(crops), batch_size):
+            with metrics.timer('identify.batch'):
+                images = [self.load_crop(crop) for crop in crops[start:start + batch_size]]
+                image_embeddings = self.encode_images(images)
+                probs = self.classify_embeddings(image_embeddings)
+                top_probs, top_idxs = probs.topk(top_k, dim=1)
+
+            for crop_probs, crop_idxs in zip(top_probs.tolist(), top_idxs.tolist()):
+                results.append([(self.object_categories[idx], prob) for idx, prob in zip(crop_idxs, crop_probs)])
+            if return_embeddings:
+                embeddings.append(image_embeddings.float().cpu().numpy())
+
+        if return_embeddings:
+            dim = self.text_embeddings.shape[1]
+            return results, np.concatenate(embeddings) if embeddings else np.zeros((0, dim), dtype=np.float32)
+        return results
+
+    def identify_object(self, image_path):
+        return self.identify_objects([image_path])[0][0]
@@ -0,0 +1,205 @@
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import uuid
+from utils.postprocessing import extract_and_save_objects, save_visualization, object_row
+from utils.preprocessing import get_image_paths
+from utils.storage import get_store, INSERT_OBJECT_SQL
+from utils.embeddings import save_object_embeddings
+from utils.manifest import IngestManifest
+
+logger = logging.getLogger(__name__)
+
+def default_model_factory():
+    from models.segmentation_model import SegmentationModel
+    return SegmentationModel(use_result_cache=False)
+
+def _ingest_worker(worker_id, task_queue, output_dir, visualization_dir, num_threads, model_factory, result_queue):
+    """
+    Worker process: load the models once, then segment, extract and identify images from task_queue
+    until it receives None. Object rows are sent back to the parent instead of being written to the database here.
+    """
+    import torch
+    torch.set_num_threads(num_threads)
+
+    model = model_factory()
+    started = time.time()
+    try:
+        for image_path in iter(task_queue.get, None):
+            image_started = time.time()
+            try:
+                segmented_objects, original_image = model.segment_image(image_path)
+                master_id = str(uuid.uuid4())
+                extracted_objects = extract_and_save_objects(segmented_objects, original_image, image_path, output_dir,
+                                                             None, crop_writer=model.crop_writer,
+                                                             save_metadata=False, master_id=master_id,
+                                                             crop_store=model.crop_store(output_dir))
+
+                model.identify_extracted(extracted_objects)
+                rows = [object_row(obj) for obj in extracted_objects]
+                embedded = [obj for obj in extracted_objects if obj.get('embedding') is not None]
+                embeddings = ([obj['id'] for obj in embedded], [obj['embedding'] for obj in embedded])
+
+                if visualization_dir:
+                    visualized_image = model.visualize_segmentation(original_image, segmented_objects)
+                    save_visualization(visualized_image, os.path.join(visualization_dir,
+                                                                      f"segmented_{os.path.basename(image_path)}"))
+
+                # The parent commits the rows as soon as it sees them, so the crops must be on disk first
+                model.crop_writer.flush()
+                result_queue.put(('result', worker_id, image_path, master_id, (rows, embeddings),
+                                  time.time() - image_started))
+            except Exception as e:
+                result_queue.put(('error', worker_id, image_path, str(e), None, time.time() - image_started))
+    finally:
+        model.close()
+        result_queue.put(('done', worker_id, None, None, None, time.time() - started))
+
+def _feed_tasks(image_paths, task_queue, num_workers, stop):
+    """
+    Hand paths to the workers through the bounded task queue, then one None per worker.
+    """
+    try:
+        for image_path in image_paths:
+            while not stop.is_set():
+                try:
+                    task_queue.put(image_path, timeout=1.0)
+                    break
+                except queue.Full:
+                    pass
+            if stop.is_set():
+                return
+    except Exception as e:
+        logger.error(f"Listing images to ingest failed: {e}")
+    for _ in range(num_workers):
+        task_queue.put(None)
+
+def ingest_paths(image_paths, output_dir, db_path, num_workers=None, threads_per_worker=1, visualization_dir=None,
+                 model_factory=default_model_factory, queue_size=64, report_every=50, manifest=None):
+    """
+    Ingest images with num_workers model processes, each pinned to threads_per_worker torch threads.
+    image_paths may be any iterable, including a lazy scan: a feeder thread passes paths to whichever
+    worker is free through a bounded task queue.
+    The calling process is the only database writer: it stores each image's rows together with
+    its ingest_progress entry in one transaction, so a rerun skips paths that were already stored.
+    Given the IngestManifest that produced image_paths, the manifest entry is written in the same
+    transaction and the manifest decides what to skip instead.
+    Returns per-worker stats: images, objects, errors, seconds and images_per_second.
+    """
+    if num_workers is None:
+        num_workers = max(1, (os.cpu_count() or 1) // threads_per_worker)
+    if hasattr(image_paths, '__len__'):
+        num_workers = max(1, min(num_workers, len(image_paths)))
+
+    os.makedirs(output_dir, exist_ok=True)
+    if visualization_dir:
+        os.makedirs(visualization_dir, exist_ok=True)
+
+    store = get_store(db_path)
+    if manifest is None:
+        done_paths = {image_path for (image_path,) in store.query("SELECT image_path FROM ingest_progress")}
+        pending = (image_path for image_path in image_paths if image_path not in done_paths)
+    else:
+        # The manifest already skips unchanged files, and changed ones must be ingested again
+        pending = iter(image_paths)
+
+    stats = {worker_id: {'images': 0, 'objects': 0, 'errors': 0, 'seconds': 0.0, 'images_per_second': 0.0}
+             for worker_id in range(num_workers)}
+    # Don't start any model processes when there is nothing new
+    first = next(pending, None)
+    if first is None:
+        logger.info("Nothing new to ingest")
+        if manifest is not None:
+            manifest.finish()
+        return stats
+    if manifest is None:
+        logger.info(f"Ingesting with {num_workers} workers ({len(done_paths)} images already done)")
+    else:
+        logger.info(f"Ingesting new and changed files under {manifest.root} with {num_workers} workers")
+
+    context = multiprocessing.get_context("spawn")
+    task_queue = context.Queue(maxsize=queue_size)
+    result_queue = context.Queue(maxsize=queue_size)
+    workers = []
+    for worker_id in range(num_workers):
+        process = context.Process(target=_ingest_worker, name=f"ingest-{worker_id}",
+                                  args=(worker_id, task_queue, output_dir, visualization_dir, threads_per_worker,
+                                        model_factory, result_queue))
+        process.start()
+        workers.append(process)
+
+    stop = threading.Event()
+    feeder = threading.Thread(target=_feed_tasks, name="ingest-feeder", daemon=True,
+                              args=(itertools.chain([first], pending), task_queue, num_workers, stop))
+    feeder.start()
+
+    started = time.time()
+    running = num_workers
+    processed = 0
+    while running:
+        try:
+            kind, worker_id, image_path, payload, result, elapsed = result_queue.get(timeout=1.0)
+        except queue.Empty:
+            if not any(process.is_alive() for process in workers):
+                logger.error("All ingest workers exited without finishing")
+                break
+            continue
+
+        worker_stats = stats[worker_id]
+        if kind == 'done':
+            running -= 1
+            worker_stats['seconds'] = elapsed
+            if elapsed > 0:
+                worker_stats['images_per_second'] = worker_stats['images'] / elapsed
+            continue
+
+        if kind == 'error':
+            worker_stats['errors'] += 1
+            logger.error(f"Worker {worker_id} failed on {image_path}: {payload}")
+            if manifest is not None:
+                manifest.release(image_path)
+            continue
+
+        # Embeddings first: their mapping only becomes visible once the object rows commit
+        rows, (embedded_ids, embeddings) = result
+        if embedded_ids:
+            save_object_embeddings(db_path, embedded_ids, embeddings)
+        with store.transaction() as cursor:
+            cursor.executemany(INSERT_OBJECT_SQL, rows)
+            cursor.execute("INSERT OR REPLACE INTO ingest_progress (image_path, master_id, worker, finished_at) "
+                           "VALUES (?, ?, ?, ?)", (image_path, payload, worker_id, time.time()))
+            if manifest is not None:
+                manifest.record(image_path, payload, cursor)
+
+        worker_stats['images'] += 1
+        worker_stats['objects'] += len(rows)
+        processed += 1
+        if processed % report_every == 0:
+            rate = processed / (time.time() - started)
+            logger.info(f"Ingested {processed} images ({rate:.2f} images/s)")
+
+    stop.set()
+    for process in workers:
+        process.join()
+    if manifest is not None:
+        manifest.finish()
+
+    for worker_id, worker_stats in stats.items():
+        logger.info(f"Worker {worker_id}: {worker_stats['images']} images, {worker_stats['objects']} objects, "
+                    f"{worker_stats['errors']} errors, {worker_stats['images_per_second']:.2f} images/s")
+    return stats
+
+def ingest_directory(input_dir, output_dir, db_path, recursive=True, incremental=True, **kwargs):
+    """
+    Ingest the images under input_dir; see ingest_paths. With incremental, an IngestManifest scan
+    only offers files that are new or changed since the last run and resumes an interrupted run
+    from its checkpoint; otherwise every image in input_dir itself is ingested.
+    """
+    if not incremental:
+        return ingest_paths(get_image_paths(input_dir), output_dir, db_path, **kwargs)
+    manifest = IngestManifest(db_path, input_dir, recursive=recursive)
+    return ingest_paths(manifest.scan(), output_dir, db_path, manifest=manifest, **kwargs)
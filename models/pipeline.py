@@ -0,0 +1,226 @@
+import logging
+import os
+import queue
+import threading
+import uuid
+from contextlib import closing
+from utils.preprocessing import load_image
+from utils.postprocessing import extract_and_save_objects, save_object_metadata, save_visualization
+from utils.result_cache import image_content_hash, result_cache_key, record_cached_result, evict_cached_results
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+# How often a thread blocked on a queue checks whether the pipeline was stopped, in seconds
+_POLL_INTERVAL = 0.1
+
+class Stage:
+    """
+    One pipeline step: func(job) updates the job dict in place and runs on `workers` threads.
+    """
+    def __init__(self, name, func, workers=1):
+        self.name = name
+        self.func = func
+        self.workers = workers
+
+class PipelineExecutor:
+    """
+    Runs jobs through a chain of stages, each with its own worker threads, connected by bounded queues.
+    A full queue blocks the stage feeding it, so a slow stage throttles the ones before it.
+    A job whose stage raises is marked with 'error' and passed straight through the remaining stages.
+    """
+    def __init__(self, stages, queue_size=8):
+        self.stages = stages
+        self.queue_size = queue_size
+
+    def run(self, jobs):
+        """
+        Yield each job dict once it has left the last stage, in completion order.
+        Closing the generator early stops the feeder and the stages: running jobs finish their
+        current stage, the rest are dropped, and the threads are joined before close() returns.
+        """
+        stop = threading.Event()
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self._feed, args=(jobs, queues[0], stop), name="pipeline-feed",
+                                    daemon=True)]
+
+        for index, stage in enumerate(self.stages):
+            remaining = [stage.workers]
+            lock = threading.Lock()
+            next_workers = self.stages[index + 1].workers if index + 1 < len(self.stages) else 1
+            for worker in range(stage.workers):
+                threads.append(threading.Thread(
+                    target=self._work,
+                    args=(stage, queues[index], queues[index + 1], remaining, lock, next_workers, stop),
+                    name=f"pipeline-{stage.name}-{worker}", daemon=True))
+
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                job = queues[-1].get()
+                if job is _STOP:
+                    break
+                yield job
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+            # Drop the jobs still queued between stages when the consumer stopped early
+            for pending in queues:
+                while not pending.empty():
+                    pending.get_nowait()
+
+    def _feed(self, jobs, out_queue, stop):
+        try:
+            for job in jobs:
+                if not _put(out_queue, job, stop):
+                    break
+        finally:
+            for _ in range(self.stages[0].workers):
+                _put(out_queue, _STOP, stop)
+
+    def _work(self, stage, in_queue, out_queue, remaining, lock, next_workers, stop):
+        while True:
+            job = _get(in_queue, stop)
+            if job is _STOP:
+                break
+
+            if 'error' not in job and not job.get('done'):
+                try:
+                    stage.func(job)
+                except Exception as e:
+                    logger.error(f"Stage {stage.name} failed for {job.get('image_path')}: {e}")
+                    job['error'] = f"{stage.name}: {e}"
+
+            _put(out_queue, job, stop)
+
+        # The last worker of a stage to finish tells every worker of the next stage to stop
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            for _ in range(next_workers):
+                _put(out_queue, _STOP, stop)
+
+def _put(out_queue, item, stop):
+    """
+    Put item on a bounded queue, giving up (and returning False) once stop is set.
+    """
+    while not stop.is_set():
+        try:
+            out_queue.put(item, timeout=_POLL_INTERVAL)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _get(in_queue, stop):
+    """
+    Next item from a queue, or _STOP once stop is set.
+    """
+    while not stop.is_set():
+        try:
+            return in_queue.get(timeout=_POLL_INTERVAL)
+        except queue.Empty:
+            pass
+    return _STOP
+
+DEFAULT_CONCURRENCY = {'decode': 2, 'segment': 1, 'extract': 2, 'identify': 1, 'persist': 1}
+
+def build_segmentation_pipeline(segmentation_model, output_dir, db_path, visualization_dir=None, concurrency=None,
+                                queue_size=8, manifest=None):
+    """
+    Build the decode -> segment -> extract -> identify -> persist pipeline around a SegmentationModel.
+    concurrency maps stage names to worker counts, overriding DEFAULT_CONCURRENCY.
+    A manifest (utils.manifest.IngestManifest) supplies the content hashes its scan already computed.
+    """
+    workers = dict(DEFAULT_CONCURRENCY, **(concurrency or {}))
+    model = segmentation_model
+    if visualization_dir:
+        os.makedirs(visualization_dir, exist_ok=True)
+
+    def decode(job):
+        image_path = job['image_path']
+        if model.use_result_cache:
+            job['content_hash'] = ((manifest and manifest.content_hash(image_path)) or
+                                   image_content_hash(image_path))
+            cached = model.load_cached_result(image_path, job['content_hash'], output_dir, db_path)
+            if cached is not None:
+                job['extracted_objects'], job['visualized_image'] = cached
+                job['done'] = True
+                return
+        job['image'], _ = load_image(image_path)
+        if not model.needs_tiling(job['image'].size):
+            job['image_tensor'] = model.image_tensor(job['image'])
+
+    def segment(job):
+        if 'image_tensor' not in job:
+            job['segmented_objects'] = model.segment_tiled(job['image'])
+            return
+        prediction = model.predict([job.pop('image_tensor')])[0]
+        job['segmented_objects'] = model.postprocess_prediction(prediction, job['image'].size)
+
+    def extract(job):
+        job['master_id'] = str(uuid.uuid4())
+        job['extracted_objects'] = extract_and_save_objects(job['segmented_objects'], job['image'], job['image_path'],
+                                                            output_dir, db_path, crop_writer=model.crop_writer,
+                                                            save_metadata=False, master_id=job['master_id'],
+                                                            crop_store=model.crop_store(output_dir))
+
+    def identify(job):
+        model.identify_extracted(job['extracted_objects'])
+
+    def persist(job):
+        save_object_metadata(db_path, job['extracted_objects'])
+
+        if job.get('content_hash') is not None:
+            cache_key = result_cache_key(job['content_hash'], model.cache_settings())
+            record_cached_result(db_path, cache_key, job['content_hash'], job['master_id'])
+            if model.cache_max_bytes is not None:
+                evict_cached_results(db_path, output_dir, model.cache_max_bytes)
+
+        job['visualized_image'] = model.visualize_segmentation(job.pop('image'), job.pop('segmented_objects'))
+        if visualization_dir:
+            visualization_path = os.path.join(visualization_dir, f"segmented_{os.path.basename(job['image_path'])}")
+            save_visualization(job['visualized_image'], visualization_path)
+
+    stages = [
+        Stage('decode', decode, workers['decode']),
+        Stage('segment', segment, workers['segment']),
+        Stage('extract', extract, workers['extract']),
+        Stage('identify', identify, workers['identify']),
+        Stage('persist', persist, workers['persist']),
+    ]
+    return PipelineExecutor(stages, queue_size=queue_size)
+
+def run_segmentation_pipeline(segmentation_model, image_paths, output_dir, db_path, visualization_dir=None,
+                              concurrency=None, queue_size=8, manifest=None):
+    """
+    Process image_paths through the staged pipeline.
+    Yields one job dict per image with 'image_path', 'extracted_objects', 'visualized_image',
+    and 'error' if a stage failed for that image.
+    If image_paths comes from manifest.scan(), each finished image is recorded in the manifest
+    as it is yielded and the manifest is finished once the scan is exhausted.
+    """
+    executor = build_segmentation_pipeline(segmentation_model, output_dir, db_path, visualization_dir=visualization_dir,
+                                           concurrency=concurrency, queue_size=queue_size, manifest=manifest)
+    jobs = ({'image_path': image_path} for image_path in image_paths)
+
+    # Closing this generator early closes the executor's too, stopping the stage threads
+    with closing(executor.run(jobs)) as results:
+        for job in results:
+            for key in ('image', 'image_tensor', 'segmented_objects', 'content_hash', 'done'):
+                job.pop(key, None)
+            if manifest is not None:
+                if 'error' in job:
+                    manifest.release(job['image_path'])
+                else:
+                    master_id = (job.get('master_id') or
+                                 next((obj['master_id'] for obj in job['extracted_objects']), None))
+                    manifest.record(job['image_path'], master_id)
+            yield job
+
+    if manifest is not None:
+        manifest.finish()
@@ -0,0 +1,90 @@
+import logging
+import threading
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+def load_detector():
+    import torch
+    from torchvision.models.detection import maskrcnn_resnet50_fpn
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    return maskrcnn_resnet50_fpn(pretrained=True).to(device).eval()
+
+def load_identification_model():
+    from .identification_model import IdentificationModel
+    return IdentificationModel()
+
+class ModelRegistry:
+    """
+    Process-wide model instances, each built by its factory on first use and then shared by every caller.
+    Concurrent first calls for the same model wait on a single load.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.factories = {}
+        self.load_locks = {}
+        self.instances = {}
+
+    def register(self, name, factory):
+        with self.lock:
+            self.factories[name] = factory
+            self.load_locks.setdefault(name, threading.Lock())
+            self.instances.pop(name, None)
+
+    def is_loaded(self, name):
+        return name in self.instances
+
+    def get(self, name):
+        instance = self.instances.get(name)
+        if instance is not None:
+            return instance
+
+        with self.lock:
+            if name not in self.factories:
+                raise KeyError(f"Unknown model: {name}")
+            factory = self.factories[name]
+            load_lock = self.load_locks[name]
+
+        with load_lock:
+            if name not in self.instances:
+                logger.info(f"Loading model {name}")
+                with metrics.timer(f"model_load.{name}"):
+                    self.instances[name] = factory()
+            return self.instances[name]
+
+    def warm_up(self, names=None):
+        """
+        Load models on a background thread and return the thread; failures are logged and retried on get().
+        """
+        names = list(self.factories) if names is None else list(names)
+
+        def run():
+            for name in names:
+                try:
+                    self.get(name)
+                except Exception as e:
+                    logger.error(f"Warm-up of model {name} failed: {e}")
+
+        thread = threading.Thread(target=run, name="model-warm-up", daemon=True)
+        thread.start()
+        return thread
+
+    def unload(self, name=None):
+        """
+        Drop one loaded instance, or all of them, so the next get() loads again.
+        """
+        with self.lock:
+            if name is None:
+                self.instances.clear()
+            else:
+                self.instances.pop(name, None)
+
+registry = ModelRegistry()
+registry.register("detector", load_detector)
+registry.register("identification", load_identification_model)
+
+def get_model(name):
+    return registry.get(name)
+
+def warm_up(names=None):
+    return registry.warm_up(names)
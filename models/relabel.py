@@ -0,0 +1,136 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from utils.embeddings import iter_object_embeddings
+from utils.storage import get_store
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+def relabel_objects(db_path, categories, prompts=None, identification_model=None, chunk_size=65536):
+    """
+    Re-classify every object with a stored image embedding against a new category list,
+    without running CLIP on the crops again. prompts (one per category) default to the
+    model's prompt_template applied to each category; they are encoded once.
+    Objects are scored in chunks of chunk_size with one matrix multiply each, and every
+    chunk's category/confidence updates are written in one transaction.
+    Objects without a stored embedding (labelled by the detector fast path) cannot be re-scored:
+    those whose category is also in the new vocabulary keep it, the rest have category and confidence
+    cleared and label_source set to 'unlabelled', so the table never mixes two vocabularies.
+    Returns the number of objects assigned to each category, with the cleared ones under None.
+    """
+    if identification_model is None:
+        from models.registry import get_model
+        identification_model = get_model("identification")
+
+    categories = list(categories)
+    if prompts is None:
+        prompts = [identification_model.prompt_template.format(category) for category in categories]
+    if len(prompts) != len(categories):
+        raise ValueError(f"Got {len(prompts)} prompts for {len(categories)} categories")
+
+    text_embeddings = identification_model.load_text_embeddings(list(prompts)).float().cpu().numpy()
+    logit_scale = identification_model.model.logit_scale.detach().exp().item()
+    store = get_store(db_path)
+    counts = np.zeros(len(categories), dtype=np.int64)
+
+    with metrics.timer('relabel'):
+        for object_ids, embeddings in iter_object_embeddings(db_path, chunk_size):
+            if embeddings.shape[1] != text_embeddings.shape[1]:
+                raise ValueError(f"Stored embeddings have dimension {embeddings.shape[1]}, "
+                                 f"the text encoder produces {text_embeddings.shape[1]}")
+
+            # Softmax confidence of the best category, as classify_embeddings computes it
+            logits = logit_scale * (embeddings @ text_embeddings.T)
+            best = logits.argmax(axis=1)
+            best_logits = logits[np.arange(len(best)), best]
+            confidences = 1.0 / np.exp(logits - best_logits[:, None]).sum(axis=1)
+
+            store.update_categories(zip([categories[i] for i in best], confidences.tolist(), object_ids))
+            counts += np.bincount(best, minlength=len(categories))
+            metrics.increment('relabel.objects', len(object_ids))
+
+    counts = dict(zip(categories, counts.tolist()))
+    kept, cleared = _settle_unembedded_objects(store, categories)
+    for category, count in kept.items():
+        counts[category] += count
+    if cleared:
+        logger.warning(f"Cleared the labels of {cleared} objects that have no stored embedding and a category "
+                       f"outside the new vocabulary; identify them again to label them")
+        counts[None] = cleared
+    return counts
+
+def _settle_unembedded_objects(store, categories):
+    """
+    Keep the labels of objects without an embedding that belong to the new vocabulary and clear the rest.
+    Returns (kept counts by category, number cleared).
+    """
+    placeholders = ", ".join("?" * len(categories))
+    unembedded = "NOT EXISTS (SELECT 1 FROM object_embeddings e WHERE e.object_id = objects.id)"
+    with store.transaction() as cursor:
+        kept = dict(cursor.execute(f"""SELECT category, COUNT(*) FROM objects
+                                       WHERE {unembedded} AND category IN ({placeholders})
+                                       GROUP BY category""", categories).fetchall())
+        cleared = cursor.execute(f"""UPDATE objects SET category = NULL, confidence = NULL, label_source = 'unlabelled'
+                                     WHERE {unembedded} AND (category IS NULL OR category NOT IN ({placeholders}))""",
+                                 categories).rowcount
+    metrics.increment('relabel.cleared', cleared)
+    return kept, cleared
+
+def _read_categories(path):
+    """
+    One category per line, optionally followed by a tab and its prompt.
+    """
+    categories, prompts = [], []
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if not line.strip():
+                continue
+            category, _, prompt = line.partition("\t")
+            categories.append(category.strip())
+            prompts.append(prompt.strip() or None)
+    return categories, prompts
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Re-label stored objects against a new vocabulary.")
+    parser.add_argument("--db", default="data/object_metadata.db")
+    parser.add_argument("--categories", nargs="+", help="new category names")
+    parser.add_argument("--categories-file", help="file with one category per line, optionally '<category>\\t<prompt>'")
+    parser.add_argument("--prompt-template", help="prompt template with one {} for the category")
+    parser.add_argument("--chunk-size", type=int, default=65536)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+
+    if args.categories_file:
+        categories, file_prompts = _read_categories(args.categories_file)
+    elif args.categories:
+        categories, file_prompts = args.categories, [None] * len(args.categories)
+    else:
+        parser.error("pass --categories or --categories-file")
+
+    from models.registry import get_model
+    identification_model = get_model("identification")
+    template = args.prompt_template or identification_model.prompt_template
+    prompts = [prompt or template.format(category) for category, prompt in zip(categories, file_prompts)]
+
+    started = time.perf_counter()
+    counts = relabel_objects(args.db, categories, prompts, identification_model, args.chunk_size)
+    cleared = counts.pop(None, 0)
+    logger.info(f"Re-labelled {sum(counts.values())} objects in {time.perf_counter() - started:.2f}s")
+    print(json.dumps(counts, indent=2))
+    if cleared:
+        print(f"{cleared} objects have no stored embedding and no category in the new vocabulary; "
+              f"their labels were cleared (label_source = 'unlabelled')")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
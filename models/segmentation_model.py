@@ -64,70 +64,512 @@
 #         return extracted_objects, visualized_image
 
 import torch
-import torchvision
-from torchvision.models.detection import maskrcnn_resnet50_fpn
-from torchvision.transforms import functional as F
 from PIL import Image
 import numpy as np
+import multiprocessing
 import os
-from utils.postprocessing import extract_and_save_objects
-from .identification_model import IdentificationModel
+import queue
+import threading
+import uuid
+from torch.utils.data import DataLoader, IterableDataset
+from utils.postprocessing import (extract_and_save_objects, save_object_metadata, build_label_map, blend_label_map,
+                                  CropWriter, clip_box)
+from utils.preprocessing import get_image_paths, resize_to_max_size, load_image, image_to_float32, ArrayPool
+from utils.crop_store import get_crop_store
+from utils.masks import BinaryMask
+from utils.metrics import metrics
+from utils.result_cache import (image_content_hash, result_cache_key, lookup_cached_result, record_cached_result,
+                                load_cached_objects, evict_cached_results, forget_cached_result)
+from .registry import registry
+from .tiling import tile_boxes, to_image_coordinates, merge_tile_detections
+
+class ImageDataset(IterableDataset):
+    """
+    Decodes images and converts them to tensors; used as a DataLoader dataset so decoding runs in worker processes.
+    Each (index, image_path) task, taken from tasks or, in worker processes, from task_queue until a None,
+    yields (index, image_path, content_hash, image, tensor); the tensor is None for images to be tiled.
+    With hash_contents, each file is read once and its content hash (for the result cache) computed from the same bytes.
+    """
+    def __init__(self, tasks=None, task_queue=None, inference_size=None, tile_size=None, hash_contents=False):
+        self.tasks = tasks
+        self.task_queue = task_queue
+        self.inference_size = inference_size
+        self.tile_size = tile_size
+        self.hash_contents = hash_contents
+
+    def __iter__(self):
+        tasks = self.tasks if self.task_queue is None else iter(self.task_queue.get, None)
+        for index, image_path in tasks:
+            yield (index,) + self.load(image_path)
+
+    def load(self, image_path):
+        content_hash = None
+        source = image_path
+        if self.hash_contents:
+            with open(image_path, 'rb') as f:
+                source = f.read()
+            content_hash = image_content_hash(source)
+        image, _ = load_image(source)
+        if self.tile_size and max(image.size) > self.tile_size:
+            # Segmented tile by tile in the main process
+            return image_path, content_hash, image, None
+        return (image_path, content_hash, image,
+                torch.from_numpy(image_to_float32(resize_to_max_size(image, self.inference_size))))
+
+def _collate_single(item):
+    return item
+
+def _feed_tasks(tasks, task_queue, num_workers, stop, errors):
+    """
+    Pass (index, image_path) tasks to the loader workers as the input is read, then one None per worker.
+    An error reading the input is kept in errors for the main thread to raise.
+    """
+    try:
+        for task in tasks:
+            while not stop.is_set():
+                try:
+                    task_queue.put(task, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if stop.is_set():
+                return
+    except Exception as e:
+        errors.append(e)
+    for _ in range(num_workers):
+        task_queue.put(None)
+
+def _in_input_order(items):
+    """
+    Reorder (index, ...) items from several loader workers by index, dropping the index.
+    """
+    pending = {}
+    next_index = 0
+    for item in items:
+        pending[item[0]] = item[1:]
+        while next_index in pending:
+            yield pending.pop(next_index)
+            next_index += 1
+
+def detector_category_map(categories):
+    """
+    Map torchvision COCO label ids to the names in categories, for the labels both vocabularies share.
+    """
+    from torchvision.models.detection import MaskRCNN_ResNet50_FPN_Weights
+    names = set(categories)
+    return {label: name for label, name in enumerate(MaskRCNN_ResNet50_FPN_Weights.COCO_V1.meta["categories"])
+            if name in names}
+
+def upsample_mask_in_box(mask, box, image_size, threshold=0.5):
+    """
+    Bilinearly upsample a low-resolution HxW probability mask to image_size (width, height),
+    evaluating only the pixels inside box (original coordinates). Matches a full-frame
+    F.interpolate inside the box; returns a BinaryMask of the full frame.
+    """
+    width, height = image_size
+    mask_height, mask_width = mask.shape
+    scale_x, scale_y = width / mask_width, height / mask_height
+    x1, y1, x2, y2 = clip_box(box, width, height)
+    if x2 <= x1 or y2 <= y1:
+        return BinaryMask(image_size, (0, 0, 0, 0), np.zeros(0, dtype=np.uint8))
+
+    # Low-resolution window under the box, with one pixel of context for the interpolation
+    lx1, ly1 = max(int(x1 / scale_x) - 1, 0), max(int(y1 / scale_y) - 1, 0)
+    lx2 = min(int(np.ceil(x2 / scale_x)) + 1, mask_width)
+    ly2 = min(int(np.ceil(y2 / scale_y)) + 1, mask_height)
+    window = mask[ly1:ly2, lx1:lx2].float()[None, None]
+
+    # Source coordinates of the output pixel centers, normalized to the window for grid_sample
+    xs = (torch.arange(x1, x2, device=mask.device, dtype=torch.float32) + 0.5) * (mask_width / width) - 0.5
+    ys = (torch.arange(y1, y2, device=mask.device, dtype=torch.float32) + 0.5) * (mask_height / height) - 0.5
+    grid_x = (2 * (xs - lx1) + 1) / (lx2 - lx1) - 1
+    grid_y = (2 * (ys - ly1) + 1) / (ly2 - ly1) - 1
+    grid_y, grid_x = torch.meshgrid(grid_y, grid_x, indexing='ij')
+    grid = torch.stack([grid_x, grid_y], dim=-1)[None]
+
+    box_mask = torch.nn.functional.grid_sample(window, grid, mode='bilinear', padding_mode='border',
+                                               align_corners=False)[0, 0]
+    return BinaryMask.from_tensor(box_mask > threshold, origin=(x1, y1), image_size=image_size)
 
 class SegmentationModel:
-    def __init__(self):
+    def __init__(self, use_result_cache=True, cache_max_bytes=None, detector=None, identification_model=None,
+                 inference_size=None, detector_label_threshold=None, crop_format="png", tile_size=None,
+                 tile_overlap=128, tile_batch_size=4, tile_merge_threshold=0.5):
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-        self.model = maskrcnn_resnet50_fpn(pretrained=True)
-        self.identification_model = IdentificationModel()
-        self.model.to(self.device)
-        self.model.eval()
+        self.detector = detector
+        self._identification_model = identification_model
+        self.crop_writer = CropWriter()
+        # Detector input buffers, recycled once predict has consumed them
+        self.input_buffers = ArrayPool()
+        self.confidence_threshold = 0.7
+        self.inference_context = torch.no_grad
+        # Set by models.cpu_inference when it changes the detector's numerics; part of the result cache key
+        self.cpu_profile = None
+        # Longest image side fed to the detector; None runs at full resolution
+        self.inference_size = inference_size
+        # Images larger than tile_size are segmented in overlapping tiles (see segment_tiled)
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.tile_batch_size = tile_batch_size
+        self.tile_merge_threshold = tile_merge_threshold
+        # Detections scoring at least this keep the detector's COCO label instead of going through CLIP
+        self.detector_label_threshold = detector_label_threshold
+        self.detector_categories = None
+        # "png" writes one file per crop; "shard" appends crops to packed shards (utils.crop_store)
+        self.crop_format = crop_format
+        self.use_result_cache = use_result_cache
+        self.cache_max_bytes = cache_max_bytes
+        if detector is not None:
+            detector.to(self.device)
+            detector.eval()
+
+    @property
+    def model(self):
+        """
+        The detector; Mask R-CNN is loaded from the shared registry on first use.
+        """
+        if self.detector is None:
+            self.detector = registry.get("detector")
+        return self.detector
+
+    @property
+    def identification_model(self):
+        """
+        The CLIP identification model, shared through the registry unless one was passed in.
+        """
+        if self._identification_model is None:
+            self._identification_model = registry.get("identification")
+        return self._identification_model
 
     def segment_image(self, image_path):
-        image = Image.open(image_path).convert("RGB")
-        image_tensor = F.to_tensor(image).unsqueeze(0).to(self.device)
+        image, _ = load_image(image_path)
+        return self.segment(image), image
+
+    def segment(self, image):
+        """
+        Segmented objects of a full-resolution PIL image, tiled if it is larger than tile_size.
+        """
+        if self.needs_tiling(image.size):
+            return self.segment_tiled(image)
+        prediction = self.predict([self.image_tensor(image)])[0]
+        return self.postprocess_prediction(prediction, image.size)
+
+    def needs_tiling(self, image_size):
+        return bool(self.tile_size) and max(image_size) > self.tile_size
+
+    def segment_tiled(self, image):
+        """
+        Segment an image in tile_size tiles overlapping by tile_overlap, tile_batch_size tiles per
+        Mask R-CNN batch. Each batch's detections are mapped to image coordinates and their masks
+        packed before the next batch runs, so peak memory depends on the tile size, not the image size.
+        Detections are then merged across tile borders (see models.tiling.merge_tile_detections).
+        """
+        tiles = tile_boxes(image.width, image.height, self.tile_size, self.tile_overlap)
+        detections = []
+        for start in range(0, len(tiles), self.tile_batch_size):
+            batch = tiles[start:start + self.tile_batch_size]
+            tile_images = [image.crop(tile) for tile in batch]
+            predictions = self.predict([self.image_tensor(tile_image) for tile_image in tile_images])
+            for tile, tile_image, prediction in zip(batch, tile_images, predictions):
+                detections.extend(to_image_coordinates(obj, tile, image.size)
+                                  for obj in self.postprocess_prediction(prediction, tile_image.size))
+            del predictions
+
+        metrics.increment('segment.tiles', len(tiles))
+        with metrics.timer('segment.tile_merge'):
+            return merge_tile_detections(detections, self.tile_merge_threshold)
 
-        with torch.no_grad():
-            prediction = self.model(image_tensor)[0]
+    def image_tensor(self, image):
+        """
+        Detector input for a PIL image, downscaled to inference_size, in a buffer from input_buffers.
+        """
+        image = resize_to_max_size(image, self.inference_size)
+        buffer = self.input_buffers.acquire((3, image.height, image.width))
+        return torch.from_numpy(image_to_float32(image, buffer))
 
+    def predict(self, image_tensors):
+        """
+        Run Mask R-CNN on a list of CHW image tensors as one batch.
+        Tensors from image_tensor go back to input_buffers afterwards and must not be used again.
+        """
+        inputs = image_tensors
+        image_tensors = [image_tensor.to(self.device) for image_tensor in image_tensors]
+
+        try:
+            with self.inference_context(), metrics.timer('segment.predict'):
+                predictions = self.model(image_tensors)
+        finally:
+            for image_tensor in inputs:
+                self.input_buffers.release(image_tensor.data_ptr())
+
+        metrics.increment('segment.images', len(image_tensors))
+        metrics.record_tensor_memory('segment.predict', image_tensors + [p['masks'] for p in predictions])
+        return predictions
+
+    @metrics.timed('segment.postprocess')
+    def postprocess_prediction(self, prediction, image_size=None):
+        """
+        Keep high-confidence detections as a list of {'bbox', 'mask', 'label', 'score'} dicts,
+        with each mask thresholded on the device and stored as a BinaryMask.
+        If the prediction was made on a downscaled image, image_size is the original (width, height):
+        boxes are mapped back to it and masks are upsampled inside their boxes only.
+        """
         masks = prediction['masks']
         scores = prediction['scores']
         labels = prediction['labels']
         boxes = prediction['boxes']
 
-        confidence_threshold = 0.7
-        high_confidence_indices = scores > confidence_threshold
-        high_confidence_masks = masks[high_confidence_indices]
-        high_confidence_boxes = boxes[high_confidence_indices]
+        high_confidence_indices = scores > self.confidence_threshold
+        high_confidence_labels = labels[high_confidence_indices].tolist()
+        high_confidence_scores = scores[high_confidence_indices].tolist()
+        mask_height, mask_width = masks.shape[-2:]
 
-        segmented_objects = []
-        for i, mask in enumerate(high_confidence_masks):
-            bbox = high_confidence_boxes[i].cpu().numpy().tolist()
-            mask = mask.squeeze().cpu().numpy()
-            segmented_objects.append({'bbox': bbox, 'mask': mask})
+        if image_size is None or tuple(image_size) == (mask_width, mask_height):
+            high_confidence_masks = masks[high_confidence_indices][:, 0] > 0.5
+            high_confidence_boxes = boxes[high_confidence_indices].cpu().numpy().tolist()
+            binary_masks = [BinaryMask.from_tensor(mask) for mask in high_confidence_masks]
+        else:
+            width, height = image_size
+            scale = boxes.new_tensor([width / mask_width, height / mask_height] * 2)
+            high_confidence_masks = masks[high_confidence_indices][:, 0]
+            high_confidence_boxes = (boxes[high_confidence_indices] * scale).cpu().numpy().tolist()
+            binary_masks = [upsample_mask_in_box(mask, bbox, image_size)
+                            for bbox, mask in zip(high_confidence_boxes, high_confidence_masks)]
 
-        return segmented_objects, image
+        return [{'bbox': bbox, 'mask': mask, 'label': label, 'score': score}
+                for bbox, mask, label, score in zip(high_confidence_boxes, binary_masks, high_confidence_labels,
+                                                    high_confidence_scores)]
 
-    def visualize_segmentation(self, image, segmented_objects):
-        color_map = np.random.randint(0, 255, (256, 3), dtype=np.uint8)
-        mask_overlay = np.zeros((image.height, image.width, 3), dtype=np.uint8)
+    @metrics.timed('visualize')
+    def visualize_segmentation(self, image, segmented_objects, alpha=0.5, preview_size=None):
+        """
+        Overlay the object masks on the image with a fixed palette.
+        preview_size=(width, height) bounds the output size for a cheaper downscaled preview.
+        """
+        label_map = build_label_map(segmented_objects, image.width, image.height)
 
-        for i, obj in enumerate(segmented_objects):
-            color = color_map[i % 256]
-            mask = obj['mask']
-            mask_overlay[mask > 0.5] = color
+        if preview_size is not None and (image.width > preview_size[0] or image.height > preview_size[1]):
+            image = image.copy()
+            image.thumbnail(preview_size)
+            label_map = np.asarray(Image.fromarray(label_map).resize(image.size, Image.NEAREST))
 
-        alpha = 0.5
-        blended = Image.fromarray((np.array(image) * (1 - alpha) + mask_overlay * alpha).astype(np.uint8))
-        return blended
+        return blend_label_map(image, label_map, alpha=alpha)
 
     def process_image(self, image_path, output_dir, db_path):
+        content_hash = image_content_hash(image_path) if self.use_result_cache else None
+        cached = self.load_cached_result(image_path, content_hash, output_dir, db_path)
+        if cached is not None:
+            return cached
+
         segmented_objects, original_image = self.segment_image(image_path)
-        extracted_objects = extract_and_save_objects(segmented_objects, original_image, image_path, output_dir, db_path)
+        return self.process_segmentation(segmented_objects, original_image, image_path, output_dir, db_path,
+                                         content_hash=content_hash)
 
-        for obj in extracted_objects:
-            object_path = os.path.join(output_dir, obj['filename'])
-            category, confidence = self.identification_model.identify_object(object_path)
-            obj['category'] = category
-            obj['confidence'] = confidence
+    def crop_store(self, output_dir):
+        """
+        The CropStore that crops for output_dir go to, or None when they are written as PNG files.
+        """
+        if self.crop_format == "shard":
+            return get_crop_store(output_dir)
+        return None
+
+    def cache_settings(self):
+        """
+        Settings that change results; part of the result cache key.
+        """
+        settings = {
+            'detector': 'maskrcnn_resnet50_fpn',
+            'confidence_threshold': self.confidence_threshold,
+            'inference_size': self.inference_size,
+            'tiling': [self.tile_size, self.tile_overlap, self.tile_merge_threshold] if self.tile_size else None,
+            'detector_label_threshold': self.detector_label_threshold,
+            'identifier': self.identification_model.model_name,
+            'categories': self.identification_model.category_prompts()
+        }
+        # Only present under a CPU profile, so fp32 entries cached before profiles existed stay valid
+        if self.cpu_profile is not None or self.identification_model.cpu_profile is not None:
+            settings['cpu_profile'] = [self.cpu_profile, self.identification_model.cpu_profile]
+        return settings
+
+    def load_cached_result(self, image_path, content_hash, output_dir, db_path, original_image=None):
+        """
+        Return (extracted_objects, visualized_image) stored for identical image bytes and settings, or None.
+        original_image, when already decoded, is reused for the visualization.
+        """
+        if content_hash is None:
+            return None
+
+        cache_key = result_cache_key(content_hash, self.cache_settings())
+        master_id = lookup_cached_result(db_path, cache_key)
+        if master_id is None:
+            return None
+
+        self.crop_writer.flush()
+        extracted_objects = load_cached_objects(db_path, master_id, output_dir)
+        if extracted_objects is None:
+            # Missing artifacts make this a miss; the image is segmented again and re-cached
+            forget_cached_result(db_path, cache_key)
+            return None
+        segmented_objects = [{'bbox': obj['bbox'], 'mask': obj['mask']} for obj in extracted_objects
+                             if obj['mask'] is not None]
+        if original_image is None:
+            original_image, _ = load_image(image_path)
+        return extracted_objects, self.visualize_segmentation(original_image, segmented_objects)
+
+    def process_segmentation(self, segmented_objects, original_image, image_path, output_dir, db_path,
+                             content_hash=None):
+        """
+        Extract, identify and visualize the objects of an already segmented image.
+        Rows are written once, with their categories, in a single transaction.
+        If content_hash is given, the result is recorded in the result cache.
+        """
+        master_id = str(uuid.uuid4())
+        extracted_objects = extract_and_save_objects(segmented_objects, original_image, image_path, output_dir, db_path,
+                                                     crop_writer=self.crop_writer, save_metadata=False,
+                                                     master_id=master_id, crop_store=self.crop_store(output_dir))
+
+        self.identify_extracted(extracted_objects)
+        save_object_metadata(db_path, extracted_objects)
+
+        if content_hash is not None:
+            record_cached_result(db_path, result_cache_key(content_hash, self.cache_settings()), content_hash, master_id)
+            if self.cache_max_bytes is not None:
+                evict_cached_results(db_path, output_dir, self.cache_max_bytes)
 
         visualized_image = self.visualize_segmentation(original_image, segmented_objects)
         return extracted_objects, visualized_image
+
+    def detector_label(self, label, score):
+        """
+        (category, score) to use for a detection without running CLIP, or None if it needs CLIP.
+        """
+        if self.detector_label_threshold is None or score is None or score < self.detector_label_threshold:
+            return None
+        if self.detector_categories is None:
+            self.detector_categories = detector_category_map(self.identification_model.object_categories)
+        category = self.detector_categories.get(label)
+        return (category, score) if category is not None else None
+
+    def identify_extracted(self, extracted_objects):
+        """
+        Set category, confidence and label_source on extracted objects; objects labelled by CLIP also get an embedding.
+        With detector_label_threshold set, detections at or above it whose COCO label is in the
+        identification vocabulary keep the detector's label and score, and only the rest go through CLIP.
+        """
+        clip_objects = []
+        for obj in extracted_objects:
+            detector_label = self.detector_label(obj.get('detector_label'), obj.get('detector_score'))
+            if detector_label is not None:
+                obj['category'], obj['confidence'] = detector_label
+                obj['label_source'] = 'detector'
+            else:
+                clip_objects.append(obj)
+
+        predictions, embeddings = self.identification_model.identify_objects(
+            [obj['image'] for obj in clip_objects], return_embeddings=True)
+        for obj, prediction, embedding in zip(clip_objects, predictions, embeddings):
+            obj['category'], obj['confidence'] = prediction[0]
+            obj['label_source'] = 'clip'
+            obj['embedding'] = embedding
+
+        skipped = len(extracted_objects) - len(clip_objects)
+        metrics.increment('identify.detector_labels', skipped)
+        metrics.increment('identify.clip_labels', len(clip_objects))
+        if extracted_objects:
+            metrics.observe('identify.clip_skip_share', skipped / len(extracted_objects))
+        return extracted_objects
+
+    def process_paths(self, image_paths, output_dir, db_path, batch_size=4, num_workers=None):
+        """
+        Process many images, decoding (and hashing, for the result cache) them in num_workers loader
+        processes and running consecutive images through Mask R-CNN in batches of up to batch_size
+        (the detector accepts differently sized images in one batch), so at most one batch is held in memory.
+        image_paths may be a lazy iterable: a feeder thread hands paths to one set of loader workers
+        through a bounded queue as they are read.
+        Yields (image_path, extracted_objects, visualized_image) as each image finishes, in input order.
+        """
+        if num_workers is None:
+            num_workers = os.cpu_count() or 0
+
+        tasks = enumerate(image_paths)
+        settings = dict(inference_size=self.inference_size, tile_size=self.tile_size,
+                        hash_contents=self.use_result_cache)
+        if num_workers == 0:
+            items = (item[1:] for item in ImageDataset(tasks, **settings))
+        else:
+            context = multiprocessing.get_context()
+            task_queue = context.Queue(maxsize=4 * num_workers)
+            stop = threading.Event()
+            errors = []
+            feeder = threading.Thread(target=_feed_tasks, args=(tasks, task_queue, num_workers, stop, errors),
+                                      name="loader-feeder", daemon=True)
+            feeder.start()
+            loader = DataLoader(ImageDataset(task_queue=task_queue, **settings), batch_size=None,
+                                num_workers=num_workers, collate_fn=_collate_single, multiprocessing_context=context)
+            items = _in_input_order(loader)
+
+        try:
+            batch = []
+            for image_path, content_hash, image, image_tensor in items:
+                cached = self.load_cached_result(image_path, content_hash, output_dir, db_path, original_image=image)
+                if cached is None and image_tensor is None:
+                    if batch:
+                        yield from self._process_batch(batch, output_dir, db_path)
+                        batch = []
+                    extracted_objects, visualized_image = self.process_segmentation(
+                        self.segment_tiled(image), image, image_path, output_dir, db_path, content_hash=content_hash)
+                    yield image_path, extracted_objects, visualized_image
+                    continue
+
+                # Cached results wait in the batch too, so results stay in input order
+                batch.append((image_path, content_hash, image, image_tensor, cached))
+                if len(batch) >= batch_size:
+                    yield from self._process_batch(batch, output_dir, db_path)
+                    batch = []
+
+            if batch:
+                yield from self._process_batch(batch, output_dir, db_path)
+        finally:
+            if num_workers:
+                # Stopped early: let workers waiting for a path see their None and exit
+                stop.set()
+                feeder.join()
+                try:
+                    while True:
+                        task_queue.get_nowait()
+                except queue.Empty:
+                    pass
+                for _ in range(num_workers):
+                    try:
+                        task_queue.put(None, timeout=0.1)
+                    except queue.Full:
+                        break
+        if num_workers and errors:
+            raise errors[0]
+
+    def process_directory(self, input_dir, output_dir, db_path, batch_size=4, num_workers=None):
+        """
+        Process every image in input_dir; see process_paths.
+        """
+        image_paths = get_image_paths(input_dir)
+        return self.process_paths(image_paths, output_dir, db_path, batch_size=batch_size, num_workers=num_workers)
+
+    def _process_batch(self, batch, output_dir, db_path):
+        image_tensors = [image_tensor for _, _, _, image_tensor, cached in batch if cached is None]
+        predictions = iter(self.predict(image_tensors) if image_tensors else [])
+
+        for image_path, content_hash, image, _, cached in batch:
+            if cached is not None:
+                yield (image_path,) + cached
+                continue
+            segmented_objects = self.postprocess_prediction(next(predictions), image.size)
+            extracted_objects, visualized_image = self.process_segmentation(segmented_objects, image, image_path,
+                                                                            output_dir, db_path,
+                                                                            content_hash=content_hash)
+            yield image_path, extracted_objects, visualized_image
+
+    def close(self):
+        """
+        Flush crops still queued for disk.
+        """
+        self.crop_writer.close()
@@ -0,0 +1,388 @@
+import argparse
+import asyncio
+import base64
+import io
+import json
+import logging
+import os
+import signal
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from PIL import Image
+from utils.metrics import metrics
+from utils.postprocessing import extract_object_crop
+from utils.preprocessing import load_image
+
+logger = logging.getLogger(__name__)
+
+class QueueFullError(Exception):
+    pass
+
+class MicroBatcher:
+    """
+    Collect concurrent requests into batches of up to max_batch_size, waiting at most max_wait_ms
+    after the first one arrives, and run process_batch(items) -> results on a dedicated thread.
+    At most max_queue requests wait; further submissions fail with QueueFullError.
+    """
+    def __init__(self, name, process_batch, max_batch_size=8, max_wait_ms=10, max_queue=256):
+        self.name = name
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"{name}-batch")
+        self.accepting = True
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def submit(self, item):
+        if not self.accepting:
+            raise QueueFullError(f"{self.name} is draining")
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((item, future, time.perf_counter()))
+        except asyncio.QueueFull:
+            metrics.increment(f"server.{self.name}.rejected")
+            raise QueueFullError(f"{self.name} queue is full")
+        return await future
+
+    async def _collect(self, first):
+        """
+        Gather up to max_batch_size entries; returns the batch and whether the stop sentinel was seen.
+        """
+        loop = asyncio.get_running_loop()
+        batch = [first]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            try:
+                entry = self.queue.get_nowait()
+            except asyncio.QueueEmpty:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    entry = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            if entry is None:
+                return batch, True
+            batch.append(entry)
+        return batch, False
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            first = await self.queue.get()
+            if first is None:
+                break
+            batch, stopping = await self._collect(first)
+
+            started = time.perf_counter()
+            for _, _, queued_at in batch:
+                metrics.observe(f"server.{self.name}.queue_wait_seconds", started - queued_at)
+            metrics.observe(f"server.{self.name}.batch_size", len(batch))
+
+            try:
+                results = await loop.run_in_executor(self.executor, self.process_batch, [item for item, _, _ in batch])
+            except Exception as e:
+                logger.error(f"{self.name} batch of {len(batch)} failed: {e}")
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for (_, future, _), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+            metrics.observe(f"server.{self.name}.batch_seconds", time.perf_counter() - started)
+
+    async def drain(self):
+        """
+        Stop accepting requests, finish everything already queued, then stop the worker.
+        """
+        self.accepting = False
+        await self.queue.put(None)
+        await self.task
+        self.executor.shutdown(wait=True)
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 413: "Payload Too Large",
+           500: "Internal Server Error", 503: "Service Unavailable"}
+
+def _decode_image(data):
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    return image
+
+class InferenceServer:
+    """
+    Local HTTP service sharing one warm SegmentationModel (and its IdentificationModel) between clients.
+
+    POST /segment          image bytes -> detections with bbox, score, label and base64 BinaryMask bytes;
+                           ?identify=1 also labels each object (detector fast path or CLIP)
+    POST /identify         crop bytes -> top_k (category, confidence) pairs; ?top_k=N
+    GET  /metrics          Prometheus text;  GET /health -> JSON status
+    Segment and identify requests are micro-batched separately.
+    """
+    def __init__(self, segmentation_model, max_batch_size=4, identify_batch_size=32, max_wait_ms=10,
+                 max_queue=256, max_body_bytes=64 * 1024 * 1024):
+        self.segmentation_model = segmentation_model
+        self.segment_batcher = MicroBatcher("segment", self.segment_batch, max_batch_size, max_wait_ms, max_queue)
+        self.identify_batcher = MicroBatcher("identify", self.identify_batch, identify_batch_size, max_wait_ms,
+                                             max_queue)
+        self.max_body_bytes = max_body_bytes
+        self.server = None
+        self.draining = False
+        self.inflight = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.connections = set()
+
+    def segment_batch(self, images):
+        """
+        Segment (decoded image, source size) pairs; results are in source coordinates.
+        Images above the model's tile_size are segmented on their own, in tiles.
+        """
+        model = self.segmentation_model
+        results = [model.segment_tiled(image) if model.needs_tiling(size) else None for image, size in images]
+        untiled = [i for i, result in enumerate(results) if result is None]
+        if untiled:
+            predictions = model.predict([model.image_tensor(images[i][0]) for i in untiled])
+            for i, prediction in zip(untiled, predictions):
+                results[i] = model.postprocess_prediction(prediction, images[i][1])
+        return results
+
+    def identify_batch(self, items):
+        top_k = max(k for _, k in items)
+        predictions = self.segmentation_model.identification_model.identify_objects(
+            [crop for crop, _ in items], top_k=top_k, batch_size=len(items))
+        return [prediction[:k] for prediction, (_, k) in zip(predictions, items)]
+
+    def _describe_objects(self, image, segmented_objects, identify):
+        """
+        Response dicts for segmented objects, with base64 masks and detector labels, and the
+        (result, crop image) pairs still to identify. Runs on an executor thread, off the event loop.
+        """
+        objects = [{'bbox': obj['bbox'], 'score': obj['score'], 'label': obj['label'],
+                    'mask': base64.b64encode(obj['mask'].to_bytes()).decode('ascii')} for obj in segmented_objects]
+        crops = []
+        if identify:
+            frame = np.asarray(image)
+            for obj, result in zip(segmented_objects, objects):
+                detector_label = self.segmentation_model.detector_label(obj['label'], obj['score'])
+                if detector_label is not None:
+                    result['category'], result['confidence'] = detector_label
+                    result['label_source'] = 'detector'
+                    continue
+                crop, _ = extract_object_crop(frame, obj['mask'], obj['bbox'])
+                if crop is not None:
+                    crops.append((result, Image.fromarray(crop)))
+        return objects, crops
+
+    async def segment(self, body, params):
+        loop = asyncio.get_running_loop()
+        identify = params.get('identify', ['0'])[0] not in ('0', 'false', '')
+        # Only crops and tiling need full-resolution pixels; otherwise a JPEG is decoded straight at the inference scale
+        full_resolution = identify or bool(self.segmentation_model.tile_size)
+        image, size = await loop.run_in_executor(None, load_image, body, self.segmentation_model.inference_size,
+                                                 full_resolution)
+        segmented_objects = await self.segment_batcher.submit((image, size))
+
+        objects, crops = await loop.run_in_executor(None, self._describe_objects, image, segmented_objects, identify)
+
+        if crops:
+            predictions = await asyncio.gather(*[self.identify_batcher.submit((crop, 1)) for _, crop in crops])
+            for (result, _), prediction in zip(crops, predictions):
+                result['category'], result['confidence'] = prediction[0]
+                result['label_source'] = 'clip'
+
+        return {'width': size[0], 'height': size[1], 'objects': objects}
+
+    async def identify(self, body, params):
+        top_k = int(params.get('top_k', ['1'])[0])
+        crop = await asyncio.get_running_loop().run_in_executor(None, _decode_image, body)
+        predictions = await self.identify_batcher.submit((crop, top_k))
+        return {'predictions': [{'category': category, 'confidence': confidence} for category, confidence in predictions]}
+
+    async def dispatch(self, method, target, body):
+        """
+        Route one request; returns (status, content_type, payload bytes).
+        """
+        url = urlsplit(target)
+        params = parse_qs(url.query)
+        routes = {('POST', '/segment'): self.segment, ('POST', '/identify'): self.identify}
+
+        if method == 'GET' and url.path == '/metrics':
+            return 200, "text/plain; version=0.0.4", metrics.to_prometheus().encode()
+        if method == 'GET' and url.path == '/health':
+            status = {'status': 'draining' if self.draining else 'ok', 'inflight': self.inflight,
+                      'segment_queue': self.segment_batcher.queue.qsize(),
+                      'identify_queue': self.identify_batcher.queue.qsize()}
+            return 200, "application/json", json.dumps(status).encode()
+
+        handler = routes.get((method, url.path))
+        if handler is None:
+            return 404, "application/json", json.dumps({'error': f"no route for {method} {url.path}"}).encode()
+        if self.draining:
+            return 503, "application/json", json.dumps({'error': "server is draining"}).encode()
+
+        name = url.path.strip('/')
+        started = time.perf_counter()
+        self.inflight += 1
+        self.idle.clear()
+        metrics.record_peak('server.inflight', self.inflight)
+        try:
+            result = await handler(body, params)
+            status, payload = 200, result
+        except QueueFullError as e:
+            status, payload = 503, {'error': str(e)}
+        except (OSError, ValueError) as e:
+            status, payload = 400, {'error': str(e)}
+        except Exception as e:
+            logger.exception(f"{name} request failed")
+            status, payload = 500, {'error': str(e)}
+        finally:
+            self.inflight -= 1
+            if self.inflight == 0:
+                self.idle.set()
+
+        metrics.increment(f"server.{name}.responses.{status}")
+        metrics.observe(f"server.{name}.latency_seconds", time.perf_counter() - started)
+        return status, "application/json", json.dumps(payload).encode()
+
+    async def handle_connection(self, reader, writer):
+        """
+        Minimal HTTP/1.1 with keep-alive: one request at a time per connection.
+        """
+        self.connections.add(writer)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, target, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    await self._respond(writer, 400, "text/plain", b"bad request line", False)
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                length = headers.get('content-length', '0') or '0'
+                if not length.isdigit():
+                    await self._respond(writer, 400, "text/plain", b"bad content-length", False)
+                    break
+                length = int(length)
+                if length > self.max_body_bytes:
+                    await self._respond(writer, 413, "text/plain", b"request body too large", False)
+                    break
+                body = await reader.readexactly(length) if length else b''
+
+                status, content_type, payload = await self.dispatch(method, target, body)
+                keep_alive = (version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                              and not self.draining)
+                await self._respond(writer, status, content_type, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.connections.discard(writer)
+            writer.close()
+
+    async def _respond(self, writer, status, content_type, payload, keep_alive):
+        head = (f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+                f"Content-Type: {content_type}\r\nContent-Length: {len(payload)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n")
+        if status == 503:
+            head += "Retry-After: 1\r\n"
+        writer.write(head.encode('latin-1') + b"\r\n" + payload)
+        await writer.drain()
+
+    async def start(self, host="127.0.0.1", port=8765):
+        self.segment_batcher.start()
+        self.identify_batcher.start()
+        self.server = await asyncio.start_server(self.handle_connection, host, port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logger.info(f"Serving on http://{host}:{self.port}")
+        return self
+
+    async def drain(self, timeout=30):
+        """
+        Graceful shutdown: stop accepting connections, answer new requests with 503,
+        let in-flight requests finish (up to timeout seconds), then stop the batchers.
+        """
+        self.draining = True
+        self.server.close()
+        try:
+            await asyncio.wait_for(self.idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Drain timed out with {self.inflight} requests in flight")
+        await self.segment_batcher.drain()
+        await self.identify_batcher.drain()
+        for writer in list(self.connections):
+            writer.close()
+        self.segmentation_model.close()
+        logger.info("Server drained")
+
+    async def serve_forever(self, host="127.0.0.1", port=8765):
+        """
+        Serve until SIGINT or SIGTERM, then drain.
+        """
+        await self.start(host, port)
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except (NotImplementedError, RuntimeError):
+                pass
+        await stop.wait()
+        await self.drain()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local segmentation/identification server with micro-batching.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--max-batch-size", type=int, default=4, help="images per segmentation batch")
+    parser.add_argument("--identify-batch-size", type=int, default=32, help="crops per identification batch")
+    parser.add_argument("--max-wait-ms", type=float, default=10)
+    parser.add_argument("--max-queue", type=int, default=256, help="waiting requests per model before 503")
+    parser.add_argument("--inference-size", type=int)
+    parser.add_argument("--detector-label-threshold", type=float)
+    parser.add_argument("--tile-size", type=int, help="segment larger images in tiles of this size")
+    parser.add_argument("--tile-overlap", type=int, default=128)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+
+    from models.registry import warm_up
+    from models.segmentation_model import SegmentationModel
+    warm_up().join()
+    model = SegmentationModel(use_result_cache=False, inference_size=args.inference_size,
+                              detector_label_threshold=args.detector_label_threshold, tile_size=args.tile_size,
+                              tile_overlap=args.tile_overlap)
+
+    async def run():
+        server = InferenceServer(model, args.max_batch_size, args.identify_batch_size, args.max_wait_ms,
+                                 args.max_queue)
+        await server.serve_forever(args.host, args.port)
+
+    asyncio.run(run())
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,81 @@
+import numpy as np
+
+def tile_starts(length, tile_size, stride):
+    """
+    Start offsets of tiles of tile_size along one axis, stride apart, with the last tile flush with the end.
+    """
+    if length <= tile_size:
+        return [0]
+    starts = list(range(0, length - tile_size + 1, stride))
+    if starts[-1] + tile_size < length:
+        starts.append(length - tile_size)
+    return starts
+
+def tile_boxes(width, height, tile_size, overlap):
+    """
+    (x1, y1, x2, y2) tiles covering a width x height image, neighbours overlapping by at least overlap pixels.
+    """
+    stride = tile_size - overlap
+    if stride <= 0:
+        raise ValueError(f"Tile overlap {overlap} must be smaller than the tile size {tile_size}")
+    return [(x, y, min(x + tile_size, width), min(y + tile_size, height))
+            for y in tile_starts(height, tile_size, stride)
+            for x in tile_starts(width, tile_size, stride)]
+
+def to_image_coordinates(obj, tile, image_size, edge_margin=1):
+    """
+    Map a detection made on a tile to image coordinates. It is marked truncated when its box
+    reaches an edge of the tile that lies inside the image, where the object may continue.
+    """
+    tx1, ty1, tx2, ty2 = tile
+    width, height = image_size
+    x1, y1, x2, y2 = obj['bbox']
+    truncated = ((tx1 > 0 and x1 <= edge_margin) or (ty1 > 0 and y1 <= edge_margin) or
+                 (tx2 < width and x2 >= tx2 - tx1 - edge_margin) or (ty2 < height and y2 >= ty2 - ty1 - edge_margin))
+    return dict(obj, bbox=[x1 + tx1, y1 + ty1, x2 + tx1, y2 + ty1], mask=obj['mask'].offset(tx1, ty1, image_size),
+                tile=tile, truncated=truncated)
+
+def _intersection(box, other):
+    return (max(box[0], other[0]), max(box[1], other[1]), min(box[2], other[2]), min(box[3], other[3]))
+
+def _overlap_iou(obj, other):
+    """
+    Mask IoU of two detections inside the window their tiles share (0 if the tiles don't overlap).
+    """
+    x1, y1, x2, y2 = _intersection(obj['tile'], other['tile'])
+    if x2 <= x1 or y2 <= y1:
+        return 0.0
+    bx1, by1, bx2, by2 = _intersection(obj['mask'].box, other['mask'].box)
+    if bx2 <= bx1 or by2 <= by1:
+        return 0.0
+    mask = obj['mask'].region(x1, y1, x2, y2)
+    other_mask = other['mask'].region(x1, y1, x2, y2)
+    union = np.count_nonzero(mask | other_mask)
+    return np.count_nonzero(mask & other_mask) / union if union else 0.0
+
+def merge_tile_detections(detections, merge_threshold=0.5):
+    """
+    Merge detections from overlapping tiles (from to_image_coordinates) into one list per object.
+    Two same-label detections from different tiles are the same object when their masks agree
+    (IoU >= merge_threshold) inside the tiles' shared window. A complete detection suppresses the
+    fragments of it found by other tiles; fragments truncated at tile borders are unioned, stitching
+    together objects larger than the overlap. Returns {'bbox', 'mask', 'label', 'score'} dicts.
+    """
+    # Complete detections first, so they anchor the merge, then by score
+    ordered = sorted((obj for obj in detections if not obj['mask'].is_empty()),
+                     key=lambda obj: (obj['truncated'], -obj['score']))
+    kept = []
+    for obj in ordered:
+        match = next((other for other in kept if other['label'] == obj['label'] and other['tile'] != obj['tile']
+                      and _overlap_iou(other, obj) >= merge_threshold), None)
+        if match is None:
+            kept.append(dict(obj))
+        elif match['truncated']:
+            match['mask'] = match['mask'].union(obj['mask'])
+            match['bbox'] = [min(match['bbox'][0], obj['bbox'][0]), min(match['bbox'][1], obj['bbox'][1]),
+                             max(match['bbox'][2], obj['bbox'][2]), max(match['bbox'][3], obj['bbox'][3])]
+            match['score'] = max(match['score'], obj['score'])
+            match['tile'] = (min(match['tile'][0], obj['tile'][0]), min(match['tile'][1], obj['tile'][1]),
+                             max(match['tile'][2], obj['tile'][2]), max(match['tile'][3], obj['tile'][3]))
+
+    return [{'bbox': obj['bbox'], 'mask': obj['mask'], 'label': obj['label'], 'score': obj['score']} for obj in kept]
@@ -0,0 +1,29 @@
+import unittest
+import os
+import sys
+import json
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.run_benchmarks import run_benchmarks, compare_to_baseline
+
+class TestBenchmarks(unittest.TestCase):
+    def test_run_benchmarks(self):
+        report = run_benchmarks({'width': 160, 'height': 120, 'objects': 4, 'images': 2, 'repeat': 1})
+
+        for stage in ['segment_postprocess', 'extract', 'identify', 'sqlite_write', 'visualize', 'describe']:
+            self.assertIn(stage, report['stages'])
+            self.assertGreaterEqual(report['stages'][stage]['min_s'], 0)
+
+        self.assertGreater(report['objects_per_image'], 0)
+        json.dumps(report)
+
+    def test_compare_to_baseline(self):
+        baseline = {'stages': {'extract': {'per_image_s': 1.0}, 'identify': {'per_image_s': 1.0}}}
+        report = {'stages': {'extract': {'per_image_s': 1.5}, 'identify': {'per_image_s': 1.1}}}
+
+        regressions = compare_to_baseline(report, baseline, tolerance=0.2)
+        self.assertEqual([regression['stage'] for regression in regressions], ['extract'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+import os
+import sys
+import json
+import shutil
+import tempfile
+import uuid
+import numpy as np
+from PIL import Image
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.crop_store import (CropStore, get_crop_store, close_crop_stores, load_crop_array, compact_crop_shards,
+                              export_crops_to_png)
+from utils.storage import get_store, close_stores, INSERT_OBJECT_SQL
+
+class TestCropStore(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.output_dir = os.path.join(self.work_dir, "output")
+        self.db_path = os.path.join(self.work_dir, "objects.db")
+        rng = np.random.default_rng(0)
+        self.crops = [rng.integers(0, 256, size=(5 + i, 7 + 2 * i, 4), dtype=np.uint8) for i in range(6)]
+        self.object_ids = [str(uuid.uuid4()) for _ in self.crops]
+
+    def tearDown(self):
+        close_crop_stores()
+        close_stores()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def test_round_trip_raw_and_compressed(self):
+        for compression in (None, "zlib"):
+            store = CropStore(self.output_dir, max_shard_bytes=512, compression=compression)
+            locations = [store.append(object_id, crop) for object_id, crop in zip(self.object_ids, self.crops)]
+            self.assertGreater(len({location.split("#")[0] for location in locations}), 1)
+            for location, object_id, crop in zip(locations, self.object_ids, self.crops):
+                np.testing.assert_array_equal(store.read(location), crop)
+                self.assertEqual(store.header(location)[-1], object_id)
+            store.close()
+
+    def test_compact_keeps_referenced_crops(self):
+        store = get_crop_store(self.output_dir)
+        locations = [store.append(object_id, crop) for object_id, crop in zip(self.object_ids, self.crops)]
+        rows = [(object_id, "master", location, json.dumps([0, 0, 1, 1]), None, None, None, None)
+                for object_id, location in list(zip(self.object_ids, locations))[::2]]
+        with get_store(self.db_path).transaction() as cursor:
+            cursor.executemany(INSERT_OBJECT_SQL, rows)
+
+        kept, reclaimed = compact_crop_shards(self.db_path, self.output_dir)
+        self.assertEqual(kept, 3)
+        self.assertGreater(reclaimed, 0)
+
+        for object_id, filename in get_store(self.db_path).query("SELECT id, filename FROM objects"):
+            crop = self.crops[self.object_ids.index(object_id)]
+            np.testing.assert_array_equal(load_crop_array(self.output_dir, filename), crop)
+
+        export_dir = os.path.join(self.work_dir, "export")
+        self.assertEqual(export_crops_to_png(self.db_path, self.output_dir, export_dir), 3)
+        exported = np.asarray(Image.open(os.path.join(export_dir, f"{self.object_ids[0]}.png")))
+        np.testing.assert_array_equal(exported, self.crops[0])
+
+if __name__ == '__main__':
+    unittest.main()
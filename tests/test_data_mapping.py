@@ -0,0 +1,75 @@
+import unittest
+import json
+import os
+import sys
+import shutil
+import tempfile
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.data_mapping import generate_object_descriptions
+from utils.storage import get_store, close_stores, INSERT_OBJECT_SQL
+
+def object_rows(master_id, categories):
+    return [(f"{master_id}_{i}", master_id, f"{master_id}_{i}.png", "[0, 0, 10, 10]", category, 0.5 + i / 10,
+             None, "clip") for i, category in enumerate(categories)]
+
+class TestObjectDescriptions(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.use_database("objects.db")
+
+    def tearDown(self):
+        close_stores()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def use_database(self, name):
+        self.db_path = os.path.join(self.work_dir, name)
+        self.store = get_store(self.db_path)
+        with self.store.transaction() as cursor:
+            for index in range(5):
+                cursor.executemany(INSERT_OBJECT_SQL, object_rows(f"image_{index}", ["cat", "dog"]))
+
+    def change_count(self):
+        return self.store.query("SELECT COUNT(*) FROM object_changes")[0][0]
+
+    def modify_objects(self):
+        with self.store.transaction() as cursor:
+            cursor.executemany(INSERT_OBJECT_SQL, object_rows("image_2a", ["bird"]) + object_rows("image_9", ["cow"]))
+            cursor.execute("UPDATE objects SET category = 'fox' WHERE id = 'image_1_0'")
+            cursor.execute("DELETE FROM objects WHERE master_id = 'image_3'")
+            cursor.execute("UPDATE objects SET confidence = NULL WHERE master_id = 'image_4'")
+
+    def test_changes_are_only_logged_for_incremental_exports(self):
+        generate_object_descriptions(self.db_path, os.path.join(self.work_dir, "full.json"), streaming=True)
+        self.modify_objects()
+        self.assertEqual(self.change_count(), 0)
+
+    def test_incremental_output_matches_full_export(self):
+        for output_format in ("json", "jsonl"):
+            incremental_file = os.path.join(self.work_dir, f"incremental.{output_format}")
+            full_file = os.path.join(self.work_dir, f"full.{output_format}")
+            self.use_database(f"{output_format}.db")
+
+            self.assertEqual(generate_object_descriptions(self.db_path, incremental_file, incremental=True), 5)
+            self.modify_objects()
+            self.assertGreater(self.change_count(), 0)
+            self.assertEqual(generate_object_descriptions(self.db_path, incremental_file, incremental=True), 5)
+            self.assertEqual(self.change_count(), 0)
+
+            self.assertEqual(generate_object_descriptions(self.db_path, full_file, streaming=True), 6)
+            with open(incremental_file) as f, open(full_file) as full:
+                incremental_text = f.read()
+                self.assertEqual(incremental_text, full.read())
+
+            descriptions = generate_object_descriptions(self.db_path, full_file)
+            if output_format == "json":
+                self.assertEqual(json.loads(incremental_text), descriptions)
+            else:
+                entries = [json.loads(line) for line in incremental_text.splitlines()]
+                self.assertEqual({entry["master_id"]: entry["descriptions"] for entry in entries}, descriptions)
+            self.assertNotIn("image_3", descriptions)
+            self.assertIn("Object in image_1_0.png: fox", descriptions["image_1"][0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+import os
+import sys
+import json
+import shutil
+import tempfile
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.embeddings import save_object_embeddings, load_object_embeddings, SimilarityIndex, find_similar_objects
+from utils.storage import get_store, close_stores, INSERT_OBJECT_SQL
+
+class TestEmbeddings(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.work_dir, "objects.db")
+
+        rng = np.random.default_rng(0)
+        self.embeddings = rng.normal(size=(200, 16)).astype(np.float32)
+        self.embeddings /= np.linalg.norm(self.embeddings, axis=1, keepdims=True)
+        self.object_ids = [f"object-{i}" for i in range(200)]
+
+        rows = [(object_id, "master", None, json.dumps([0, 0, 1, 1]), None, None, None, None) for object_id in self.object_ids]
+        with get_store(self.db_path).transaction() as cursor:
+            cursor.executemany(INSERT_OBJECT_SQL, rows)
+        save_object_embeddings(self.db_path, self.object_ids[:100], self.embeddings[:100])
+        save_object_embeddings(self.db_path, self.object_ids[100:], self.embeddings[100:])
+
+    def tearDown(self):
+        close_stores()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def test_round_trip_and_search(self):
+        object_ids, embeddings = load_object_embeddings(self.db_path)
+        self.assertEqual(object_ids, self.object_ids)
+        np.testing.assert_array_equal(embeddings, self.embeddings)
+
+        results = find_similar_objects(self.db_path, object_id="object-7", k=5)
+        self.assertEqual(len(results), 5)
+        self.assertNotIn("object-7", [object_id for object_id, _ in results])
+        expected = np.argsort(-(self.embeddings @ self.embeddings[7]))[1:6]
+        self.assertEqual([object_id for object_id, _ in results], [self.object_ids[i] for i in expected])
+
+    def test_ivf_probing_all_lists_matches_brute_force(self):
+        brute_force = SimilarityIndex(self.object_ids, self.embeddings)
+        ivf = SimilarityIndex(self.object_ids, self.embeddings, n_lists=8, n_probe=8)
+        for i in range(10):
+            self.assertEqual([object_id for object_id, _ in ivf.search(self.embeddings[i], 5)],
+                             [object_id for object_id, _ in brute_force.search(self.embeddings[i], 5)])
+
+    def test_deleted_objects_are_skipped(self):
+        with get_store(self.db_path).transaction() as cursor:
+            cursor.execute("DELETE FROM objects WHERE id = ?", ("object-3",))
+        object_ids, embeddings = load_object_embeddings(self.db_path)
+        self.assertNotIn("object-3", object_ids)
+        self.assertEqual(len(embeddings), 199)
+
+if __name__ == '__main__':
+    unittest.main()
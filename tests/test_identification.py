@@ -0,0 +1,91 @@
+import unittest
+import os
+import sys
+import shutil
+import tempfile
+import numpy as np
+import torch
+from PIL import Image
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.stubs import make_stub_clip, make_stub_segmentation_model
+from models.cpu_inference import apply_cpu_profile
+from models.identification_model import IdentificationModel
+from utils.metrics import metrics
+
+def text_encodes():
+    return metrics.snapshot()['counters'].get('identify.text_encodes', 0)
+
+class TestIdentificationModel(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.clip, self.processor = make_stub_clip()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def make_model(self, model_name="stub-clip"):
+        return IdentificationModel(model_name=model_name, cache_dir=self.cache_dir, model=self.clip,
+                                   processor=self.processor)
+
+    def test_text_embeddings_are_cached(self):
+        encodes = text_encodes()
+        model = self.make_model()
+        prompts = model.category_prompts()
+        self.assertEqual(text_encodes() - encodes, len(prompts))
+        self.assertTrue(os.path.exists(model.text_embedding_cache_path(prompts)))
+        torch.testing.assert_close(model.text_embeddings.norm(dim=-1), torch.ones(len(prompts)))
+
+        cached = self.make_model()
+        self.assertEqual(text_encodes() - encodes, len(prompts))
+        torch.testing.assert_close(cached.text_embeddings, model.text_embeddings)
+
+        other = self.make_model("other-clip")
+        self.assertNotEqual(other.text_embedding_cache_path(prompts), model.text_embedding_cache_path(prompts))
+        self.assertEqual(text_encodes() - encodes, 2 * len(prompts))
+
+    def test_batches_match_single_pass(self):
+        model = self.make_model()
+        rng = np.random.default_rng(0)
+        crops = [rng.integers(0, 256, (20 + i, 30, 3), dtype=np.uint8) for i in range(5)]
+        crops[1] = Image.fromarray(crops[1])
+
+        batch_sizes = []
+        encode_images = model.encode_images
+        model.encode_images = lambda images: batch_sizes.append(len(images)) or encode_images(images)
+
+        results, embeddings = model.identify_objects(crops, top_k=3, batch_size=2, return_embeddings=True)
+        self.assertEqual(batch_sizes, [2, 2, 1])
+        self.assertEqual(embeddings.shape, (5, model.text_embeddings.shape[1]))
+        self.assertTrue(all(len(result) == 3 for result in results))
+
+        single = model.identify_objects(crops, top_k=3)
+        self.assertEqual(batch_sizes, [2, 2, 1, 5])
+        for result, expected in zip(results, single):
+            self.assertEqual([category for category, _ in result], [category for category, _ in expected])
+            np.testing.assert_allclose([p for _, p in result], [p for _, p in expected], rtol=1e-4)
+
+        results, embeddings = model.identify_objects([], return_embeddings=True)
+        self.assertEqual((results, embeddings.shape), ([], (0, model.text_embeddings.shape[1])))
+
+    def test_cpu_profile_is_part_of_cache_keys(self):
+        model = make_stub_segmentation_model(1, use_result_cache=False)
+        identification_model = model.identification_model
+        identification_model.cache_dir = self.cache_dir
+        prompts = identification_model.category_prompts()
+        fp32_path = identification_model.text_embedding_cache_path(prompts)
+        fp32_settings = model.cache_settings()
+        self.assertNotIn('cpu_profile', fp32_settings)
+
+        try:
+            apply_cpu_profile(model)
+            self.assertNotEqual(identification_model.text_embedding_cache_path(prompts), fp32_path)
+            self.assertEqual(model.cache_settings()['cpu_profile'][1]['quantized'], True)
+            identification_model.load_text_embeddings(prompts)
+            self.assertFalse(os.path.exists(fp32_path))
+        finally:
+            model.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import unittest
+import os
+import sys
+import shutil
+import tempfile
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.manifest import IngestManifest
+from utils.preprocessing import iter_image_files, get_image_paths
+from utils.storage import get_store, close_stores, INSERT_OBJECT_SQL
+
+class TestIngestManifest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.work_dir, "images")
+        self.db_path = os.path.join(self.work_dir, "objects.db")
+        self.relative_paths = ["a.jpg", "b/c.png", "b/d/e.jpg", "b/f.bmp", "g.png"]
+        for relative_path in self.relative_paths + ["notes.txt", "b/readme.md"]:
+            path = os.path.join(self.root, relative_path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(relative_path.encode())
+
+    def tearDown(self):
+        close_stores()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def relative(self, paths):
+        return [os.path.relpath(path, self.root).replace(os.sep, '/') for path in paths]
+
+    def test_recursive_walk_resumes_after_position(self):
+        walked = self.relative(entry.path for entry in iter_image_files(self.root, recursive=True))
+        self.assertEqual(walked, self.relative_paths)
+        resumed = self.relative(entry.path for entry in iter_image_files(self.root, True, start_after="b/d/e.jpg"))
+        self.assertEqual(resumed, ["b/f.bmp", "g.png"])
+        flat = self.relative(entry.path for entry in iter_image_files(self.root))
+        self.assertEqual(flat, ["a.jpg", "g.png"])
+
+        with self.assertRaises(FileNotFoundError):
+            get_image_paths(os.path.join(self.work_dir, "missing"))
+        with self.assertRaises(FileNotFoundError):
+            list(IngestManifest(self.db_path, os.path.join(self.work_dir, "missing")).scan())
+
+    def record_with_object(self, manifest, path, master_id):
+        with manifest.store.transaction() as cursor:
+            cursor.execute(INSERT_OBJECT_SQL, (f"{master_id}_0", master_id, f"{master_id}_0.png", "[0, 0, 1, 1]",
+                                               "cat", 0.9, None, "clip"))
+            manifest.record(path, master_id, cursor)
+
+    def test_only_new_or_changed_files_are_offered(self):
+        manifest = IngestManifest(self.db_path, self.root)
+        for i, path in enumerate(manifest.scan()):
+            self.record_with_object(manifest, path, f"master-{i}")
+        self.assertTrue(manifest.finish())
+
+        with open(os.path.join(self.root, "b/c.png"), 'ab') as f:
+            f.write(b"changed")
+        # Same bytes with a new mtime: refreshed without being offered again
+        os.utime(os.path.join(self.root, "a.jpg"), ns=(1, 1))
+        with open(os.path.join(self.root, "h.jpg"), 'wb') as f:
+            f.write(b"new")
+
+        manifest = IngestManifest(self.db_path, self.root)
+        changed = list(manifest.scan())
+        self.assertEqual(self.relative(changed), ["b/c.png", "h.jpg"])
+
+        # The changed file's objects from its earlier version are replaced, not kept alongside
+        for i, path in enumerate(changed):
+            self.record_with_object(manifest, path, f"master-new-{i}")
+        master_ids = [master_id for (master_id,) in get_store(self.db_path).query(
+            "SELECT master_id FROM objects ORDER BY master_id")]
+        self.assertEqual(master_ids, ["master-0", "master-2", "master-3", "master-4", "master-new-0", "master-new-1"])
+
+    def test_interrupted_scan_resumes_from_checkpoint(self):
+        manifest = IngestManifest(self.db_path, self.root, checkpoint_every=1)
+        scan = manifest.scan()
+        first, second, third = next(scan), next(scan), next(scan)
+        manifest.record(first, "master-0")
+        manifest.record(third, "master-2")
+        self.assertEqual(manifest.load_checkpoint(), "a.jpg")
+
+        # The second file never finished, so a new run starts right after the first
+        manifest = IngestManifest(self.db_path, self.root, checkpoint_every=1)
+        self.assertEqual(self.relative(manifest.scan()), ["b/c.png", "b/f.bmp", "g.png"])
+
+if __name__ == '__main__':
+    unittest.main()
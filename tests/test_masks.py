@@ -0,0 +1,57 @@
+import unittest
+import os
+import sys
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.masks import BinaryMask
+
+class TestBinaryMask(unittest.TestCase):
+    def setUp(self):
+        self.mask = np.zeros((37, 53), dtype=bool)
+        self.mask[5:9, 10:20] = True
+        self.mask[20, 40] = True
+
+    def test_tight_box(self):
+        binary_mask = BinaryMask.from_array(self.mask)
+        self.assertEqual(binary_mask.box, (10, 5, 41, 21))
+        self.assertEqual(binary_mask.shape, (37, 53))
+        self.assertEqual(binary_mask.area(), int(self.mask.sum()))
+
+    def test_round_trip(self):
+        binary_mask = BinaryMask.from_bytes(BinaryMask.from_array(self.mask).to_bytes())
+        np.testing.assert_array_equal(binary_mask.to_array(), self.mask)
+
+    def test_threshold(self):
+        probabilities = self.mask * np.float32(0.9) + np.float32(0.2)
+        np.testing.assert_array_equal(BinaryMask.from_array(probabilities).to_array(), self.mask)
+
+    def test_region(self):
+        binary_mask = BinaryMask.from_array(self.mask)
+        np.testing.assert_array_equal(binary_mask.region(0, 0, 15, 10), self.mask[0:10, 0:15])
+
+    def test_empty(self):
+        binary_mask = BinaryMask.from_array(np.zeros((4, 4)))
+        self.assertTrue(binary_mask.is_empty())
+        self.assertFalse(binary_mask.to_array().any())
+
+class TestUpsampleMaskInBox(unittest.TestCase):
+    def test_matches_full_frame_interpolation(self):
+        import torch
+        from models.segmentation_model import upsample_mask_in_box
+
+        torch.manual_seed(0)
+        low_res = torch.nn.functional.avg_pool2d(torch.rand(1, 1, 60, 80), 5, 1, 2)[0, 0]
+        full = torch.nn.functional.interpolate(low_res[None, None], size=(300, 400), mode='bilinear',
+                                               align_corners=False)[0, 0].numpy() > 0.5
+
+        binary_mask = upsample_mask_in_box(low_res, (33.4, 21.7, 250.2, 300), (400, 300))
+        expected = np.zeros_like(full)
+        expected[21:300, 33:251] = full[21:300, 33:251]
+
+        self.assertEqual(binary_mask.shape, (300, 400))
+        self.assertLessEqual(np.count_nonzero(binary_mask.to_array() != expected), 5)
+
+if __name__ == '__main__':
+    unittest.main()
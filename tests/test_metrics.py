@@ -0,0 +1,32 @@
+import unittest
+import os
+import sys
+import json
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.metrics import MetricsRegistry
+
+class TestMetrics(unittest.TestCase):
+    def test_registry_exports(self):
+        registry = MetricsRegistry(prefix="test")
+        registry.increment('crops.written', 3)
+        registry.observe('extract.objects_per_image', 2)
+        registry.observe('extract.objects_per_image', 4)
+        registry.record_peak('segment.tensor_bytes', 10)
+        registry.record_peak('segment.tensor_bytes', 5)
+        with registry.timer('extract'):
+            pass
+
+        snapshot = json.loads(registry.to_json())
+        self.assertEqual(snapshot['counters']['crops.written'], 3)
+        self.assertEqual(snapshot['summaries']['extract.objects_per_image']['mean'], 3)
+        self.assertEqual(snapshot['summaries']['extract.seconds']['count'], 1)
+        self.assertEqual(snapshot['peaks']['segment.tensor_bytes'], 10)
+
+        text = registry.to_prometheus()
+        self.assertIn("test_crops_written_total 3", text)
+        self.assertIn("test_extract_objects_per_image_max 4", text)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import unittest
+import os
+import sys
+import shutil
+import tempfile
+from functools import partial
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.stubs import make_synthetic_image, make_stub_segmentation_model
+from models.parallel_ingest import ingest_paths, ingest_directory
+from utils.preprocessing import get_image_paths
+from utils.storage import get_store, close_stores
+
+# Module-level, so the spawned worker processes can unpickle it
+stub_model_factory = partial(make_stub_segmentation_model, 3, use_result_cache=False)
+
+def totals(stats):
+    return {key: sum(worker_stats[key] for worker_stats in stats.values()) for key in ('images', 'objects', 'errors')}
+
+class TestParallelIngest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.input_dir = os.path.join(self.work_dir, "images")
+        self.output_dir = os.path.join(self.work_dir, "output")
+        os.makedirs(self.input_dir)
+        for i in range(4):
+            make_synthetic_image(96 + 8 * i, 80, 3, seed=i).save(os.path.join(self.input_dir, f"synthetic_{i}.png"))
+        with open(os.path.join(self.input_dir, "broken.png"), 'wb') as f:
+            f.write(b"not an image")
+
+    def tearDown(self):
+        close_stores()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def test_rows_written_once_and_rerun_skips_done_images(self):
+        db_path = os.path.join(self.work_dir, "objects.db")
+        store = get_store(db_path)
+        stats = ingest_paths(get_image_paths(self.input_dir), self.output_dir, db_path, num_workers=2,
+                             model_factory=stub_model_factory)
+
+        self.assertEqual(len(stats), 2)
+        counts = totals(stats)
+        self.assertEqual((counts['images'], counts['errors']), (4, 1))
+        rows = store.query("SELECT master_id, filename FROM objects")
+        self.assertEqual(len(rows), counts['objects'])
+        self.assertEqual(len({master_id for master_id, _ in rows}), 4)
+        self.assertEqual(store.query("SELECT COUNT(*) FROM ingest_progress")[0][0], 4)
+        # Workers flush their crops before the parent commits the rows
+        self.assertTrue(all(os.path.exists(os.path.join(self.output_dir, filename)) for _, filename in rows))
+
+        # Only the broken image is tried again
+        counts = totals(ingest_paths(get_image_paths(self.input_dir), self.output_dir, db_path, num_workers=2,
+                                     model_factory=stub_model_factory))
+        self.assertEqual(counts, {'images': 0, 'objects': 0, 'errors': 1})
+        self.assertEqual(store.query("SELECT COUNT(*) FROM objects")[0][0], len(rows))
+
+    def test_incremental_ingest_replaces_changed_files(self):
+        os.remove(os.path.join(self.input_dir, "broken.png"))
+        db_path = os.path.join(self.work_dir, "manifest.db")
+        store = get_store(db_path)
+        self.assertEqual(totals(ingest_directory(self.input_dir, self.output_dir, db_path, num_workers=2,
+                                                 model_factory=stub_model_factory))['images'], 4)
+        self.assertEqual(ingest_directory(self.input_dir, self.output_dir, db_path, num_workers=2,
+                                          model_factory=stub_model_factory),
+                         {worker_id: {'images': 0, 'objects': 0, 'errors': 0, 'seconds': 0.0, 'images_per_second': 0.0}
+                          for worker_id in range(2)})
+
+        make_synthetic_image(120, 90, 3, seed=9).save(os.path.join(self.input_dir, "synthetic_0.png"))
+        self.assertEqual(totals(ingest_directory(self.input_dir, self.output_dir, db_path, num_workers=2,
+                                                 model_factory=stub_model_factory))['images'], 1)
+        manifest_ids = {master_id for (master_id,) in store.query("SELECT master_id FROM ingest_manifest")}
+        object_ids = {master_id for (master_id,) in store.query("SELECT DISTINCT master_id FROM objects")}
+        self.assertEqual(len(manifest_ids), 4)
+        self.assertEqual(object_ids, manifest_ids)
+
+if __name__ == '__main__':
+    unittest.main()
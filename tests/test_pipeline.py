@@ -0,0 +1,79 @@
+import unittest
+import os
+import sys
+import threading
+import time
+from itertools import count
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models.pipeline import PipelineExecutor, Stage
+
+def numbered_jobs(limit=None, pulled=None):
+    for number in (range(limit) if limit is not None else count()):
+        if pulled is not None:
+            pulled.append(number)
+        yield {'number': number}
+
+def pipeline_threads():
+    return [thread for thread in threading.enumerate() if thread.name.startswith("pipeline-")]
+
+class TestPipelineExecutor(unittest.TestCase):
+    def test_single_workers_keep_input_order(self):
+        def double(job):
+            job['value'] = job['number'] * 2
+
+        def increment(job):
+            time.sleep(0.001 * (job['number'] % 3))
+            job['value'] += 1
+
+        executor = PipelineExecutor([Stage('double', double), Stage('increment', increment)], queue_size=2)
+        jobs = list(executor.run(numbered_jobs(20)))
+        self.assertEqual([job['value'] for job in jobs], [number * 2 + 1 for number in range(20)])
+
+        executor = PipelineExecutor([Stage('double', double, workers=3), Stage('increment', increment, workers=2)])
+        self.assertEqual(sorted(job['value'] for job in executor.run(numbered_jobs(20))),
+                         [number * 2 + 1 for number in range(20)])
+        self.assertEqual(pipeline_threads(), [])
+
+    def test_failed_job_skips_later_stages(self):
+        def check(job):
+            if job['number'] == 3:
+                raise ValueError("bad image")
+
+        def mark(job):
+            job['marked'] = True
+
+        executor = PipelineExecutor([Stage('check', check, workers=2), Stage('mark', mark)])
+        jobs = {job['number']: job for job in executor.run(numbered_jobs(6))}
+        self.assertEqual(jobs[3]['error'], "check: bad image")
+        self.assertNotIn('marked', jobs[3])
+        self.assertTrue(all(jobs[number].get('marked') and 'error' not in jobs[number]
+                            for number in range(6) if number != 3))
+
+    def test_slow_consumer_throttles_feeder(self):
+        pulled = []
+        executor = PipelineExecutor([Stage('a', lambda job: None), Stage('b', lambda job: None)], queue_size=2)
+        results = executor.run(numbered_jobs(100, pulled))
+        next(results)
+        time.sleep(0.2)
+        # Three queues of two jobs, one job held by each thread and the one consumed
+        self.assertLessEqual(len(pulled), 3 * 2 + 3 + 1)
+        self.assertEqual(len(list(results)), 99)
+
+    def test_closing_early_stops_stages(self):
+        pulled = []
+        executor = PipelineExecutor([Stage('a', lambda job: time.sleep(0.001), workers=2), Stage('b', lambda job: None)],
+                                    queue_size=2)
+        results = executor.run(numbered_jobs(pulled=pulled))
+        self.assertEqual([job['number'] for job in (next(results), next(results))], [0, 1])
+        time.sleep(0.1)
+        results.close()
+
+        self.assertEqual(pipeline_threads(), [])
+        pulled_at_close = len(pulled)
+        time.sleep(0.1)
+        self.assertEqual(len(pulled), pulled_at_close)
+
+if __name__ == '__main__':
+    unittest.main()
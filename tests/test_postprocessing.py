@@ -0,0 +1,116 @@
+import unittest
+import os
+import sys
+import shutil
+import tempfile
+import numpy as np
+from PIL import Image
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.masks import BinaryMask
+from benchmarks.stubs import make_stub_segmentation_model
+from utils.postprocessing import CropWriter, extract_object_crop, build_label_map, blend_label_map, PALETTE
+
+class TestCropWriter(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir, ignore_errors=True)
+
+    def test_flush_and_close(self):
+        writer = CropWriter(max_queue_size=2)
+        image = Image.fromarray(np.full((8, 8, 4), 200, dtype=np.uint8))
+        paths = [os.path.join(self.output_dir, f"crop_{i}.png") for i in range(6)]
+        writer.submit(image, os.path.join(self.output_dir, "missing", "crop.png"))
+        for path in paths[:3]:
+            writer.submit(image, path)
+
+        writer.flush()
+        self.assertTrue(all(os.path.exists(path) for path in paths[:3]))
+
+        # A failed save is logged and the writer keeps going; close writes what is still queued
+        for path in paths[3:]:
+            writer.submit(image, path)
+        writer.close()
+        writer.close()
+        self.assertFalse(writer.thread.is_alive())
+        self.assertTrue(all(os.path.exists(path) for path in paths))
+        self.assertEqual(np.asarray(Image.open(paths[-1])).tolist(), np.asarray(image).tolist())
+        with self.assertRaises(RuntimeError):
+            writer.submit(image, paths[0])
+
+class TestExtractObjectCrop(unittest.TestCase):
+    def setUp(self):
+        self.frame = np.random.default_rng(0).integers(1, 256, (20, 30, 3), dtype=np.uint8)
+        self.mask_array = np.zeros((20, 30), dtype=bool)
+        self.mask_array[5:10, 10:15] = True
+        self.mask_array[7, 16] = True
+        self.mask = BinaryMask.from_array(self.mask_array)
+
+    def test_crop_is_tightened_to_mask(self):
+        crop, box = extract_object_crop(self.frame, self.mask, [8.6, 3.2, 18.4, 12.9])
+        self.assertEqual(box, (10, 5, 17, 10))
+        self.assertEqual(crop.shape, (5, 7, 4))
+        inside = self.mask_array[5:10, 10:17]
+        np.testing.assert_array_equal(crop[..., 3], inside * 255)
+        np.testing.assert_array_equal(crop[..., :3][inside], self.frame[5:10, 10:17][inside])
+        self.assertFalse(crop[..., :3][~inside].any())
+
+    def test_box_limits_and_clipping(self):
+        # Only the part of the mask inside the detector box is kept
+        _, box = extract_object_crop(self.frame, self.mask, [11, 0, 15.5, 8])
+        self.assertEqual(box, (11, 5, 15, 8))
+
+        crop, box = extract_object_crop(self.frame, self.mask, [-5, -5, 40, 40])
+        self.assertEqual(box, (10, 5, 17, 10))
+        self.assertEqual(crop.shape, (5, 7, 4))
+
+        self.assertEqual(extract_object_crop(self.frame, self.mask, [0, 0, 5, 5]), (None, None))
+        self.assertEqual(extract_object_crop(self.frame, self.mask, [35, 25, 50, 40]), (None, None))
+        empty = BinaryMask.from_array(np.zeros((20, 30), dtype=bool))
+        self.assertEqual(extract_object_crop(self.frame, empty, [0, 0, 30, 20]), (None, None))
+
+class TestVisualization(unittest.TestCase):
+    def setUp(self):
+        self.image = Image.fromarray(np.random.default_rng(0).integers(0, 256, (60, 80, 3), dtype=np.uint8))
+        first = np.zeros((60, 80), dtype=bool)
+        first[10:40, 10:50] = True
+        second = np.zeros((60, 80), dtype=bool)
+        second[30:50, 40:70] = True
+        self.objects = [{'mask': BinaryMask.from_array(first)}, {'mask': BinaryMask.from_array(second)}]
+
+    def test_blend_matches_float_formula(self):
+        label_map = build_label_map(self.objects, 80, 60)
+        self.assertEqual(label_map[20, 20], 1)
+        self.assertEqual(label_map[35, 45], 2)  # later objects win where masks overlap
+        self.assertEqual(label_map[5, 5], 0)
+
+        # The overlay formula used before the label map, with the same palette
+        overlay = PALETTE[label_map]
+        expected = (np.array(self.image) * (1 - 0.5) + overlay * 0.5).astype(np.uint8)
+        np.testing.assert_array_equal(np.asarray(blend_label_map(self.image, label_map)), expected)
+
+        # The palette is fixed, so visualizations are reproducible across runs
+        self.assertEqual(PALETTE[:3].tolist(), [[0, 0, 0], [216, 206, 234], [14, 162, 32]])
+
+    def test_preview_size(self):
+        model = make_stub_segmentation_model(1, use_result_cache=False)
+        try:
+            full = model.visualize_segmentation(self.image, self.objects)
+            preview = model.visualize_segmentation(self.image, self.objects, preview_size=(40, 40))
+        finally:
+            model.close()
+
+        self.assertEqual(full.size, (80, 60))
+        self.assertEqual(preview.size, (40, 30))
+        # The preview blends the thumbnail with a nearest-neighbour downscaled label map
+        thumbnail = self.image.copy()
+        thumbnail.thumbnail((40, 40))
+        label_map = build_label_map(self.objects, 80, 60)[::2, ::2]
+        self.assertEqual(label_map[10, 10], 1)
+        np.testing.assert_array_equal(np.asarray(preview), np.asarray(blend_label_map(thumbnail, label_map)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+import io
+import os
+import sys
+import numpy as np
+from PIL import Image
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.preprocessing import load_image, image_to_float32, ArrayPool
+
+class TestImageLoading(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.image = Image.fromarray(rng.integers(0, 256, size=(60, 80, 3), dtype=np.uint8)).resize((1600, 1200))
+        buffer = io.BytesIO()
+        self.image.save(buffer, format="JPEG")
+        self.jpeg = buffer.getvalue()
+
+    def test_draft_decode_covers_target_size(self):
+        image, size = load_image(self.jpeg)
+        self.assertEqual((image.size, size), ((1600, 1200), (1600, 1200)))
+
+        image, size = load_image(self.jpeg, max_size=300, full_resolution=False)
+        self.assertEqual(size, (1600, 1200))
+        self.assertEqual(image.size, (400, 300))
+        self.assertEqual(image.mode, "RGB")
+
+    def test_float32_conversion_reuses_buffers(self):
+        image = self.image.resize((40, 30))
+        expected = np.asarray(image).transpose(2, 0, 1) / 255.0
+
+        pool = ArrayPool()
+        buffer = pool.acquire((3, 30, 40))
+        result = image_to_float32(image, buffer)
+        self.assertIs(result, buffer)
+        self.assertEqual(result.dtype, np.float32)
+        np.testing.assert_allclose(result, expected, rtol=1e-6)
+
+        pool.release(buffer.ctypes.data)
+        self.assertIs(pool.acquire((3, 30, 40)), buffer)
+        self.assertIsNot(pool.acquire((3, 30, 40)), buffer)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import unittest
+import gc
+import multiprocessing
+import os
+import sys
+import shutil
+import tempfile
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.stubs import make_synthetic_image, make_stub_segmentation_model
+from utils.result_cache import evict_cached_results
+from utils.storage import get_store, close_stores
+
+class TestProcessPaths(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.output_dir = os.path.join(self.work_dir, "output")
+        self.db_path = os.path.join(self.work_dir, "objects.db")
+        self.image_paths = []
+        for i in range(6):
+            image_path = os.path.join(self.work_dir, f"synthetic_{i}.png")
+            make_synthetic_image(120 + 10 * i, 100 + 5 * i, 3, seed=i).save(image_path)
+            self.image_paths.append(image_path)
+        self.model = make_stub_segmentation_model(3, use_result_cache=False)
+
+    def tearDown(self):
+        self.model.close()
+        close_stores()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def test_mixed_sizes_stream_in_batches(self):
+        predicted = []
+        predict = self.model.predict
+        self.model.predict = lambda image_tensors: predicted.append(len(image_tensors)) or predict(image_tensors)
+
+        results = self.model.process_paths(self.image_paths, self.output_dir, self.db_path, batch_size=2,
+                                           num_workers=0)
+        first_path, extracted_objects, _ = next(results)
+        self.assertEqual(first_path, self.image_paths[0])
+        self.assertEqual(predicted, [2])
+        self.assertTrue(extracted_objects)
+
+        self.assertEqual([image_path for image_path, _, _ in results], self.image_paths[1:])
+        self.assertEqual(predicted, [2, 2, 2])
+
+    def test_loader_workers_keep_input_order_and_stop_early(self):
+        results = self.model.process_paths((path for path in self.image_paths), self.output_dir, self.db_path,
+                                           batch_size=2, num_workers=2)
+        self.assertEqual([image_path for image_path, _, _ in results], self.image_paths)
+
+        results = self.model.process_paths(iter(self.image_paths), self.output_dir, self.db_path, batch_size=2,
+                                           num_workers=2)
+        self.assertEqual(next(results)[0], self.image_paths[0])
+        results.close()
+        del results
+        gc.collect()
+        self.assertEqual(multiprocessing.active_children(), [])
+
+    def test_lazy_input_hits_cache_and_evicts_oldest_entries(self):
+        model = make_stub_segmentation_model(3, crop_format="shard")
+        try:
+            first = [[obj['id'] for obj in objects] for _, objects, _ in
+                     model.process_paths(iter(self.image_paths), self.output_dir, self.db_path, batch_size=2,
+                                         num_workers=0)]
+
+            predicted = []
+            predict = model.predict
+            model.predict = lambda image_tensors: predicted.append(len(image_tensors)) or predict(image_tensors)
+            results = list(model.process_paths(iter(self.image_paths), self.output_dir, self.db_path, batch_size=2,
+                                               num_workers=0))
+            self.assertEqual(predicted, [])
+            self.assertEqual([image_path for image_path, _, _ in results], self.image_paths)
+            self.assertEqual([[obj['id'] for obj in objects] for _, objects, _ in results], first)
+        finally:
+            model.close()
+
+        store = get_store(self.db_path)
+        self.assertEqual(evict_cached_results(self.db_path, self.output_dir, 1 << 40), [])
+        entries = store.query("SELECT master_id, bytes FROM image_cache ORDER BY last_used")
+        self.assertEqual(store.query("SELECT bytes FROM image_cache_totals")[0][0], sum(size for _, size in entries))
+
+        object_count = store.query("SELECT COUNT(*) FROM objects")[0][0]
+        max_bytes = sum(size for _, size in entries[-2:])
+        evicted = evict_cached_results(self.db_path, self.output_dir, max_bytes)
+        self.assertEqual(evicted, [master_id for master_id, _ in entries[:-2]])
+        self.assertEqual(store.query("SELECT bytes FROM image_cache_totals")[0][0], max_bytes)
+        self.assertEqual(store.query("SELECT COUNT(*) FROM image_cache")[0][0], 2)
+        # Evicting a cache entry keeps the image's stored objects
+        self.assertEqual(store.query("SELECT COUNT(*) FROM objects")[0][0], object_count)
+
+    def test_missing_cached_crop_is_a_cache_miss(self):
+        model = make_stub_segmentation_model(3)
+        try:
+            image_path = self.image_paths[0]
+            first, _ = model.process_image(image_path, self.output_dir, self.db_path)
+            model.crop_writer.flush()
+            os.remove(os.path.join(self.output_dir, first[0]['filename']))
+
+            predicted = []
+            predict = model.predict
+            model.predict = lambda image_tensors: predicted.append(len(image_tensors)) or predict(image_tensors)
+            extracted_objects, _ = model.process_image(image_path, self.output_dir, self.db_path)
+            self.assertEqual(predicted, [1])
+            self.assertEqual(len(extracted_objects), len(first))
+
+            model.process_image(image_path, self.output_dir, self.db_path)
+            self.assertEqual(predicted, [1])
+        finally:
+            model.close()
+
+if __name__ == '__main__':
+    unittest.main()
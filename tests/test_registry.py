@@ -0,0 +1,38 @@
+import unittest
+import os
+import sys
+import threading
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models.registry import ModelRegistry
+
+class TestModelRegistry(unittest.TestCase):
+    def test_lazy_shared_instances(self):
+        loads = []
+        registry = ModelRegistry()
+        registry.register("model", lambda: loads.append(1) or object())
+        self.assertFalse(registry.is_loaded("model"))
+
+        instances = []
+        threads = [threading.Thread(target=lambda: instances.append(registry.get("model"))) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(loads), 1)
+        self.assertTrue(all(instance is instances[0] for instance in instances))
+
+        registry.warm_up(["model"]).join()
+        self.assertEqual(len(loads), 1)
+
+        registry.unload("model")
+        registry.get("model")
+        self.assertEqual(len(loads), 2)
+
+        with self.assertRaises(KeyError):
+            registry.get("missing")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+import os
+import sys
+import shutil
+import tempfile
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.stubs import make_synthetic_image, make_stub_segmentation_model
+from models.relabel import relabel_objects
+from utils.storage import get_store, close_stores
+
+class TestRelabel(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.work_dir, "objects.db")
+        image_paths = []
+        for i in range(2):
+            image_path = os.path.join(self.work_dir, f"synthetic_{i}.png")
+            make_synthetic_image(160, 120, 4, seed=i).save(image_path)
+            image_paths.append(image_path)
+
+        self.model = make_stub_segmentation_model(4, use_result_cache=False)
+        list(self.model.process_paths(image_paths, os.path.join(self.work_dir, "output"), self.db_path, num_workers=0))
+
+    def tearDown(self):
+        self.model.close()
+        close_stores()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def labels(self):
+        return dict((object_id, (category, confidence)) for object_id, category, confidence in
+                    get_store(self.db_path).query("SELECT id, category, confidence FROM objects"))
+
+    def test_same_vocabulary_keeps_labels(self):
+        before = self.labels()
+        identification_model = self.model.identification_model
+        counts = relabel_objects(self.db_path, identification_model.object_categories,
+                                 identification_model=identification_model, chunk_size=3)
+
+        after = self.labels()
+        self.assertEqual(sum(counts.values()), len(before))
+        for object_id, (category, confidence) in before.items():
+            self.assertEqual(after[object_id][0], category)
+            self.assertAlmostEqual(after[object_id][1], confidence, places=4)
+
+    def test_new_vocabulary(self):
+        counts = relabel_objects(self.db_path, ["lamp", "shoe", "tree"],
+                                 identification_model=self.model.identification_model)
+        self.assertEqual(set(category for category, _ in self.labels().values()) - {"lamp", "shoe", "tree"}, set())
+        self.assertEqual(sum(counts.values()), len(self.labels()))
+
+    def test_detector_labelled_objects_are_kept_or_cleared(self):
+        image_path = os.path.join(self.work_dir, "synthetic_0.png")
+        db_path = os.path.join(self.work_dir, "detector.db")
+        model = make_stub_segmentation_model(4, use_result_cache=False, detector_label_threshold=0.0)
+        list(model.process_paths([image_path], os.path.join(self.work_dir, "output"), db_path, num_workers=0))
+        model.close()
+
+        rows = get_store(db_path).query("SELECT category, label_source FROM objects")
+        self.assertTrue(rows)
+        self.assertEqual({label_source for _, label_source in rows}, {'detector'})
+        kept_category = rows[0][0]
+        expected_kept = sum(category == kept_category for category, _ in rows)
+
+        counts = relabel_objects(db_path, ["lamp", kept_category], identification_model=self.model.identification_model)
+        self.assertEqual(counts, {"lamp": 0, kept_category: expected_kept, None: len(rows) - expected_kept})
+        after = get_store(db_path).query("SELECT category, label_source FROM objects")
+        self.assertEqual(set(after), {(kept_category, 'detector'), (None, 'unlabelled')})
+
+if __name__ == '__main__':
+    unittest.main()
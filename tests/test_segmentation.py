@@ -70,7 +70,7 @@ from PIL import Image
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from models.segmentation_model import SegmentationModel
-from models.identification_model import IdentificationModel
+from models.registry import get_model
 from utils.preprocessing import get_image_paths
 from utils.postprocessing import save_visualization
 from utils.data_mapping import generate_object_descriptions
@@ -83,7 +83,7 @@ class TestSegmentation(unittest.TestCase):
     def setUp(self):
         logger.info("Setting up test environment")
         self.segmentation_model = SegmentationModel()
-        self.identification_model = IdentificationModel()
+        self.identification_model = get_model("identification")
         self.input_dir = "../data/input_images"
         self.output_dir = "../data/output"
         self.visualization_dir = "../data/segmented_objects"
@@ -0,0 +1,83 @@
+import unittest
+import os
+import sys
+import io
+import json
+import asyncio
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.stubs import make_synthetic_image, make_stub_segmentation_model
+from models.server import InferenceServer, MicroBatcher, QueueFullError
+from utils.metrics import metrics
+
+def png_bytes(image):
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+async def request(port, method, path, body=b'', content_length=None):
+    if content_length is None:
+        content_length = len(body)
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {content_length}\r\n"
+                 f"Connection: close\r\n\r\n".encode() + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, payload = response.partition(b"\r\n\r\n")
+    return int(head.split()[1]), payload
+
+class TestInferenceServer(unittest.TestCase):
+    def test_micro_batched_requests(self):
+        metrics.reset()
+        image = png_bytes(make_synthetic_image(160, 120, 4))
+        crop = png_bytes(make_synthetic_image(32, 32, 1))
+
+        async def scenario():
+            server = await InferenceServer(make_stub_segmentation_model(4, use_result_cache=False),
+                                           max_wait_ms=50).start(port=0)
+            segment = [request(server.port, "POST", "/segment?identify=1", image) for _ in range(4)]
+            identify = [request(server.port, "POST", "/identify?top_k=3", crop) for _ in range(8)]
+            responses = await asyncio.gather(*segment, *identify)
+            health = await request(server.port, "GET", "/health")
+            malformed = await asyncio.gather(*[request(server.port, "POST", "/identify", crop, content_length=value)
+                                               for value in ("abc", "-5")])
+            await server.drain()
+            return responses, health, malformed
+
+        responses, health, malformed = asyncio.run(scenario())
+        self.assertEqual([status for status, _ in responses], [200] * 12)
+        self.assertEqual([status for status, _ in malformed], [400, 400])
+
+        result = json.loads(responses[0][1])
+        self.assertEqual((result['width'], result['height']), (160, 120))
+        self.assertTrue(all('category' in obj and 'mask' in obj for obj in result['objects']))
+        self.assertEqual(len(json.loads(responses[-1][1])['predictions']), 3)
+        self.assertEqual(json.loads(health[1])['status'], 'ok')
+
+        summaries = metrics.snapshot()['summaries']
+        self.assertGreater(summaries['server.identify.batch_size']['max'], 1)
+        self.assertEqual(summaries['server.segment.latency_seconds']['count'], 4)
+
+    def test_queue_limit_and_drain(self):
+        def slow_batch(items):
+            time.sleep(0.05)
+            return items
+
+        async def scenario():
+            batcher = MicroBatcher("test", slow_batch, max_batch_size=1, max_wait_ms=0, max_queue=1)
+            batcher.start()
+            results = await asyncio.gather(*[batcher.submit(i) for i in range(4)], return_exceptions=True)
+            await batcher.drain()
+            with self.assertRaises(QueueFullError):
+                await batcher.submit(5)
+            return results
+
+        results = asyncio.run(scenario())
+        self.assertEqual(results[0], 0)
+        self.assertTrue(any(isinstance(result, QueueFullError) for result in results))
+
+if __name__ == '__main__':
+    unittest.main()
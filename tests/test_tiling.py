@@ -0,0 +1,51 @@
+import unittest
+import os
+import sys
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models.tiling import tile_boxes, to_image_coordinates, merge_tile_detections
+from utils.masks import BinaryMask
+
+def tile_detection(frame, tile, score=0.9, label=1):
+    """
+    Detection of the part of a full-frame bool mask visible in a tile, as the detector would report it.
+    """
+    x1, y1, x2, y2 = tile
+    mask = BinaryMask.from_array(frame[y1:y2, x1:x2])
+    bx1, by1, bx2, by2 = mask.box
+    obj = {'bbox': [bx1, by1, bx2, by2], 'mask': mask, 'label': label, 'score': score}
+    return to_image_coordinates(obj, tile, (frame.shape[1], frame.shape[0]))
+
+class TestTiling(unittest.TestCase):
+    def test_tiles_cover_image_with_overlap(self):
+        tiles = tile_boxes(1000, 500, 400, 100)
+        self.assertEqual([tile[0] for tile in tiles[:3]], [0, 300, 600])
+        self.assertTrue(all(x2 - x1 <= 400 and y2 - y1 <= 400 for x1, y1, x2, y2 in tiles))
+        covered = np.zeros((500, 1000), dtype=bool)
+        for x1, y1, x2, y2 in tiles:
+            covered[y1:y2, x1:x2] = True
+        self.assertTrue(covered.all())
+        self.assertEqual(tile_boxes(300, 200, 400, 100), [(0, 0, 300, 200)])
+
+    def test_merge_stitches_and_deduplicates(self):
+        frame = np.zeros((100, 200), dtype=bool)
+        frame[20:60, 30:170] = True  # wider than the overlap, cut by both tiles
+        small = np.zeros((100, 200), dtype=bool)
+        small[40:50, 90:100] = True  # inside the overlap, found whole by both tiles
+        left, right = (0, 0, 120, 100), (80, 0, 200, 100)
+
+        detections = [tile_detection(frame, left, 0.8), tile_detection(frame, right, 0.9),
+                      tile_detection(small, left, 0.95, label=2), tile_detection(small, right, 0.7, label=2)]
+        merged = merge_tile_detections(detections)
+
+        self.assertEqual(len(merged), 2)
+        large = next(obj for obj in merged if obj['label'] == 1)
+        np.testing.assert_array_equal(large['mask'].to_array(), frame)
+        self.assertEqual(large['bbox'], [30, 20, 170, 60])
+        self.assertEqual(large['score'], 0.9)
+        self.assertEqual(next(obj['score'] for obj in merged if obj['label'] == 2), 0.95)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,282 @@
+import argparse
+import atexit
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import uuid
+import zlib
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from PIL import Image
+from utils.metrics import metrics
+from utils.storage import get_store
+
+logger = logging.getLogger(__name__)
+
+# Record layout: this 64-byte header, then the pixel payload, padded to a multiple of 8 bytes
+RECORD = struct.Struct("<4sIIBBxxQ36s4x")
+MAGIC = b"CROP"
+RAW, ZLIB = 0, 1
+SHARD_SUFFIX = ".shard"
+
+def is_shard_location(filename):
+    return "#" in filename
+
+def parse_location(location):
+    """
+    Split a '<shard file>#<offset>' location, as stored in the objects filename column.
+    """
+    shard, _, offset = location.rpartition("#")
+    return shard, int(offset)
+
+class CropStore:
+    """
+    Append-only shard files of object crops in one directory.
+    Each record holds an object's raw (or zlib-compressed) uint8 pixels and is addressed by
+    '<shard file>#<offset>'. Every CropStore instance appends to its own shards, so several
+    processes can write to the same directory; reads memory-map any shard there.
+    """
+    def __init__(self, directory, max_shard_bytes=1 << 30, compression=None, level=1):
+        self.directory = directory
+        self.max_shard_bytes = max_shard_bytes
+        self.compression = ZLIB if compression == "zlib" else RAW
+        self.level = level
+        self.writer_id = uuid.uuid4().hex[:8]
+        self.shard_number = 0
+        self.shard = None
+        self.file = None
+        self.lock = threading.Lock()
+        self.maps = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def _open_next_shard(self):
+        if self.file is not None:
+            self.file.close()
+        self.shard = f"crops-{self.writer_id}-{self.shard_number:05d}{SHARD_SUFFIX}"
+        self.shard_number += 1
+        self.file = open(os.path.join(self.directory, self.shard), 'ab')
+
+    def append(self, object_id, crop):
+        """
+        Store an HxW or HxWxC uint8 crop and return its location.
+        """
+        crop = np.ascontiguousarray(crop, dtype=np.uint8)
+        height, width = crop.shape[:2]
+        channels = crop.shape[2] if crop.ndim == 3 else 1
+        payload = crop.tobytes() if self.compression == RAW else zlib.compress(crop.tobytes(), self.level)
+        header = RECORD.pack(MAGIC, height, width, channels, self.compression, len(payload),
+                             object_id.encode('ascii'))
+        padding = b"\0" * (-len(payload) % 8)
+
+        with self.lock:
+            if self.file is None or self.file.tell() + RECORD.size + len(payload) > self.max_shard_bytes:
+                self._open_next_shard()
+            offset = self.file.tell()
+            self.file.write(header + payload + padding)
+            self.file.flush()
+            location = f"{self.shard}#{offset}"
+
+        metrics.increment('crops.written')
+        metrics.increment('crops.bytes_written', RECORD.size + len(payload))
+        return location
+
+    def _map(self, shard, end):
+        """
+        Read-only mapping of a shard covering at least `end` bytes, remapping a shard that has grown.
+        """
+        mapped = self.maps.get(shard)
+        if mapped is None or len(mapped) < end:
+            with open(os.path.join(self.directory, shard), 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[shard] = mapped
+        return mapped
+
+    def header(self, location):
+        """
+        (height, width, channels, compression, payload_length, object_id) of a record.
+        """
+        shard, offset = parse_location(location)
+        mapped = self._map(shard, offset + RECORD.size)
+        magic, height, width, channels, compression, length, object_id = RECORD.unpack_from(mapped, offset)
+        if magic != MAGIC:
+            raise ValueError(f"No crop record at {location}")
+        return height, width, channels, compression, length, object_id.decode('ascii')
+
+    def read(self, location):
+        """
+        The crop at location as a uint8 array; raw records are a zero-copy read-only view of the mapping.
+        """
+        height, width, channels, compression, length, _ = self.header(location)
+        shard, offset = parse_location(location)
+        mapped = self._map(shard, offset + RECORD.size + length)
+        shape = (height, width, channels) if channels > 1 else (height, width)
+
+        if compression == RAW:
+            return np.frombuffer(mapped, dtype=np.uint8, count=length, offset=offset + RECORD.size).reshape(shape)
+        payload = mapped[offset + RECORD.size:offset + RECORD.size + length]
+        return np.frombuffer(zlib.decompress(payload), dtype=np.uint8).reshape(shape)
+
+    def record_size(self, location):
+        length = self.header(location)[4]
+        return RECORD.size + length + (-length % 8)
+
+    def copy_record(self, location, target):
+        """
+        Append the record at location to another store unchanged (no decompression); returns its new location.
+        """
+        shard, offset = parse_location(location)
+        size = self.record_size(location)
+        record = self._map(shard, offset + size)[offset:offset + size]
+
+        with target.lock:
+            if target.file is None or target.file.tell() + size > target.max_shard_bytes:
+                target._open_next_shard()
+            new_offset = target.file.tell()
+            target.file.write(record)
+            target.file.flush()
+            return f"{target.shard}#{new_offset}"
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            for mapped in self.maps.values():
+                try:
+                    mapped.close()
+                except BufferError:
+                    pass  # arrays returned by read() still reference it; freed with them
+            self.maps = {}
+
+_crop_stores = {}
+_crop_stores_lock = threading.Lock()
+
+def get_crop_store(directory, **kwargs):
+    """
+    The process-wide CropStore for a directory.
+    """
+    key = os.path.abspath(directory)
+    with _crop_stores_lock:
+        store = _crop_stores.get(key)
+        if store is None:
+            store = _crop_stores[key] = CropStore(directory, **kwargs)
+        return store
+
+def close_crop_stores():
+    with _crop_stores_lock:
+        for store in _crop_stores.values():
+            store.close()
+        _crop_stores.clear()
+
+atexit.register(close_crop_stores)
+
+def load_crop_array(output_dir, filename):
+    """
+    Pixels of a stored crop, from a shard record or a PNG file.
+    """
+    if is_shard_location(filename):
+        return get_crop_store(output_dir).read(filename)
+    return np.asarray(Image.open(os.path.join(output_dir, filename)))
+
+def load_crop_image(output_dir, filename):
+    if is_shard_location(filename):
+        return Image.fromarray(get_crop_store(output_dir).read(filename))
+    return Image.open(os.path.join(output_dir, filename))
+
+def crop_size(output_dir, filename):
+    """
+    Bytes used by a stored crop; raises OSError if it is missing.
+    """
+    if is_shard_location(filename):
+        try:
+            return get_crop_store(output_dir).record_size(filename)
+        except (ValueError, struct.error) as e:
+            raise OSError(str(e))
+    return os.path.getsize(os.path.join(output_dir, filename))
+
+def delete_crop(output_dir, filename):
+    """
+    Remove a PNG crop. Shard records cannot be removed in place; compact_crop_shards reclaims them
+    once no object row references them.
+    """
+    if not is_shard_location(filename):
+        os.remove(os.path.join(output_dir, filename))
+
+def compact_crop_shards(db_path, output_dir):
+    """
+    Rewrite the records still referenced by the objects table into fresh shards, repoint their
+    filename column, and delete the old shard files. Run it while nothing else writes crops to output_dir.
+    Returns (records kept, bytes reclaimed).
+    """
+    store = get_store(db_path)
+    old_shards = [name for name in os.listdir(output_dir) if name.endswith(SHARD_SUFFIX)]
+    old_bytes = sum(os.path.getsize(os.path.join(output_dir, name)) for name in old_shards)
+
+    reader = get_crop_store(output_dir)
+    reader.close()
+    writer = CropStore(output_dir)
+    updates = []
+    for object_id, filename in store.query("SELECT id, filename FROM objects WHERE filename LIKE '%#%' "
+                                           "ORDER BY filename"):
+        try:
+            updates.append((reader.copy_record(filename, writer), object_id))
+        except (OSError, ValueError, struct.error) as e:
+            logger.warning(f"Skipping unreadable crop {filename} of object {object_id}: {e}")
+    writer.close()
+
+    with store.transaction() as cursor:
+        cursor.executemany("UPDATE objects SET filename = ? WHERE id = ?", updates)
+
+    reader.close()
+    for name in old_shards:
+        os.remove(os.path.join(output_dir, name))
+
+    new_bytes = sum(os.path.getsize(os.path.join(output_dir, name)) for name in os.listdir(output_dir)
+                    if name.endswith(SHARD_SUFFIX))
+    logger.info(f"Compacted {len(old_shards)} shards: kept {len(updates)} crops, reclaimed {old_bytes - new_bytes} bytes")
+    return len(updates), old_bytes - new_bytes
+
+def export_crops_to_png(db_path, output_dir, export_dir, master_id=None):
+    """
+    Write '<object id>.png' into export_dir for every stored crop (or one image's crops). Returns the count.
+    """
+    os.makedirs(export_dir, exist_ok=True)
+    store = get_store(db_path)
+    if master_id is None:
+        rows = store.iterate("SELECT id, filename FROM objects WHERE filename IS NOT NULL")
+    else:
+        rows = store.query("SELECT id, filename FROM objects WHERE master_id = ?", (master_id,))
+
+    count = 0
+    for object_id, filename in rows:
+        load_crop_image(output_dir, filename).save(os.path.join(export_dir, f"{object_id}.png"))
+        count += 1
+    return count
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain the packed crop shards of an output directory.")
+    parser.add_argument("--db", default="data/object_metadata.db")
+    parser.add_argument("--output-dir", default="data/output")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("compact", help="drop unreferenced records and rewrite the shards")
+    export_parser = subparsers.add_parser("export", help="export crops as PNG files")
+    export_parser.add_argument("export_dir")
+    export_parser.add_argument("--master-id")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "compact":
+        kept, reclaimed = compact_crop_shards(args.db, args.output_dir)
+        print(f"kept {kept} crops, reclaimed {reclaimed} bytes")
+    else:
+        count = export_crops_to_png(args.db, args.output_dir, args.export_dir, args.master_id)
+        print(f"exported {count} crops to {args.export_dir}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
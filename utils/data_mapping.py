@@ -1,93 +1,213 @@
-import sqlite3
 import json
 import os
+from utils.masks import BinaryMask
+from utils.storage import get_store, prune_object_changes
+from utils.metrics import metrics
 
 def get_object_metadata(db_path, object_id=None, master_id=None):
     """
     Retrieve object metadata from the SQLite database.
     """
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    store = get_store(db_path)
 
     if object_id:
-        cursor.execute("SELECT * FROM objects WHERE id = ?", (object_id,))
+        return store.query("SELECT * FROM objects WHERE id = ?", (object_id,))
     elif master_id:
-        cursor.execute("SELECT * FROM objects WHERE master_id = ?", (master_id,))
+        return store.query("SELECT * FROM objects WHERE master_id = ?", (master_id,))
     else:
-        cursor.execute("SELECT * FROM objects")
-
-    results = cursor.fetchall()
-    conn.close()
-
-    return results
+        return store.query("SELECT * FROM objects")
 
 def update_object_metadata(db_path, object_id, updates):
     """
     Update object metadata in the SQLite database.
     """
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-
     update_query = "UPDATE objects SET "
     update_query += ", ".join([f"{key} = ?" for key in updates.keys()])
     update_query += " WHERE id = ?"
 
     values = list(updates.values()) + [object_id]
-    
-    cursor.execute(update_query, values)
-    conn.commit()
-    conn.close()
+
+    with get_store(db_path).transaction() as cursor:
+        cursor.execute(update_query, values)
+
+def get_object_masks(db_path, object_id=None, master_id=None):
+    """
+    Load stored object masks as a dict of object id to BinaryMask.
+    """
+    store = get_store(db_path)
+
+    if object_id:
+        rows = store.query("SELECT id, mask FROM objects WHERE id = ? AND mask IS NOT NULL", (object_id,))
+    elif master_id:
+        rows = store.query("SELECT id, mask FROM objects WHERE master_id = ? AND mask IS NOT NULL", (master_id,))
+    else:
+        rows = store.query("SELECT id, mask FROM objects WHERE mask IS NOT NULL")
+
+    return {object_id: BinaryMask.from_bytes(mask) for object_id, mask in rows}
 
 import logging
+from itertools import groupby
 
 logger = logging.getLogger(__name__)
 
-def generate_object_descriptions(db_path, output_file):
+def describe_object(filename, category, confidence):
+    # Handle case where confidence might be None
+    if confidence is not None:
+        confidence_str = f"{confidence:.2f}"
+    else:
+        confidence_str = "N/A"
+        logger.warning(f"Confidence is None for object in {filename}")
+
+    return f"Object in {filename}: {category} (confidence: {confidence_str})"
+
+@metrics.timed('describe')
+def generate_object_descriptions(db_path, output_file, streaming=False, incremental=False, output_format=None):
+    """
+    Write per-image object descriptions to output_file as JSON or JSON Lines.
+
+    By default the whole table is loaded and the descriptions dict is returned.
+    streaming=True iterates the rows in master_id order and writes each image as it is read.
+    incremental=True (which implies streaming) rewrites only the images whose objects changed
+    since the previous incremental run on output_file, merging them into the existing output.
+    Streaming modes return the number of images written.
+    output_format is "json" or "jsonl"; by default it follows the file extension.
+    """
+    if output_format is None:
+        output_format = "jsonl" if output_file.endswith(".jsonl") else "json"
+
     logger.info(f"Generating object descriptions from database: {db_path}")
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT master_id, filename, object_categories, confidence FROM objects")
-    results = cursor.fetchall()
-    
+    store = get_store(db_path)
+
+    if incremental:
+        return _generate_incremental_descriptions(store, output_file, output_format)
+
+    # A full rewrite invalidates any incremental watermark for this file
+    with store.transaction() as cursor:
+        cursor.execute("DELETE FROM export_state WHERE output_file = ?", (os.path.abspath(output_file),))
+        prune_object_changes(cursor)
+
+    if streaming:
+        rows = store.iterate("SELECT master_id, filename, category, confidence FROM objects ORDER BY master_id")
+        count = _write_descriptions(output_file, output_format, _group_descriptions(rows))
+        logger.info(f"Generated descriptions for {count} images")
+        return count
+
+    results = store.query("SELECT master_id, filename, category, confidence FROM objects")
+
     logger.info(f"Found {len(results)} objects in the database")
-    
+
     descriptions = {}
-    for master_id, filename, object_categories, confidence in results:
+    for master_id, filename, category, confidence in results:
         if master_id not in descriptions:
             descriptions[master_id] = []
-        
-        # Handle case where confidence might be None
-        if confidence is not None:
-            confidence_str = f"{confidence:.2f}"
-        else:
-            confidence_str = "N/A"
-            logger.warning(f"Confidence is None for object in {filename}")
-        
-        descriptions[master_id].append(f"Object in {filename}: {object_categories} (confidence: {confidence_str})")
-    
-    conn.close()
-    
+
+        descriptions[master_id].append(describe_object(filename, category, confidence))
+
     with open(output_file, 'w') as f:
-        json.dump(descriptions, f, indent=2)
-    
+        if output_format == "jsonl":
+            for master_id, image_descriptions in descriptions.items():
+                f.write(json.dumps({"master_id": master_id, "descriptions": image_descriptions}) + "\n")
+        else:
+            json.dump(descriptions, f, indent=2)
+
     logger.info(f"Generated descriptions for {len(descriptions)} images")
     return descriptions
 
-def get_image_descriptions(db_path, master_id):
+def _group_descriptions(rows):
     """
-    Get descriptions for all objects in a specific image.
+    Turn (master_id, filename, category, confidence) rows sorted by master_id into (master_id, descriptions).
     """
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    for master_id, image_rows in groupby(rows, key=lambda row: row[0]):
+        yield master_id, [describe_object(filename, category, confidence) for _, filename, category, confidence in image_rows]
 
-    cursor.execute("SELECT filename, object_categories, confidence FROM objects WHERE master_id = ?", (master_id,))
-    results = cursor.fetchall()
+def _write_descriptions(output_file, output_format, entries):
+    """
+    Write (master_id, descriptions) entries one line per image, through a temporary file.
+    JSON output holds each image on its own line so it can be merged line by line later.
+    """
+    count = 0
+    tmp_file = output_file + ".tmp"
+    with open(tmp_file, 'w') as f:
+        if output_format == "json":
+            f.write("{")
+        for master_id, image_descriptions in entries:
+            if output_format == "jsonl":
+                f.write(json.dumps({"master_id": master_id, "descriptions": image_descriptions}) + "\n")
+            else:
+                f.write(("," if count else "") + "\n  " + json.dumps(master_id) + ": " + json.dumps(image_descriptions))
+            count += 1
+        if output_format == "json":
+            f.write("\n}\n")
+    os.replace(tmp_file, output_file)
+    return count
 
-    descriptions = []
-    for filename, object_categories, confidence in results:
-        descriptions.append(f"Object in {filename}: {object_categories} (confidence: {confidence:.2f})")
+def _read_descriptions(output_file, output_format):
+    """
+    Read back (master_id, descriptions) entries written by _write_descriptions.
+    """
+    with open(output_file) as f:
+        for line in f:
+            line = line.strip()
+            if output_format == "jsonl":
+                if line:
+                    entry = json.loads(line)
+                    yield entry["master_id"], entry["descriptions"]
+            elif line not in ("{", "}", ""):
+                (master_id, image_descriptions), = json.loads("{" + line.rstrip(",") + "}").items()
+                yield master_id, image_descriptions
 
-    conn.close()
+def _merge_descriptions(existing, fresh, changed_ids):
+    """
+    Merge two master_id-ordered entry streams, dropping existing entries for changed images.
+    """
+    existing = ((master_id, d) for master_id, d in existing if master_id not in changed_ids)
+    pending = next(fresh, None)
+    for master_id, image_descriptions in existing:
+        while pending is not None and pending[0] < master_id:
+            yield pending
+            pending = next(fresh, None)
+        yield master_id, image_descriptions
+    while pending is not None:
+        yield pending
+        pending = next(fresh, None)
 
-    return descriptions
+def _generate_incremental_descriptions(store, output_file, output_format):
+    key = os.path.abspath(output_file)
+    state = store.query("SELECT watermark FROM export_state WHERE output_file = ?", (key,))
+    current = store.query("SELECT COALESCE(MAX(seq), 0) FROM object_changes")[0][0]
+
+    if not state or not os.path.exists(output_file):
+        rows = store.iterate("SELECT master_id, filename, category, confidence FROM objects ORDER BY master_id")
+        count = _write_descriptions(output_file, output_format, _group_descriptions(rows))
+        logger.info(f"Generated descriptions for {count} images")
+    else:
+        watermark = state[0][0]
+        changed_ids = {master_id for (master_id,) in store.query(
+            "SELECT DISTINCT master_id FROM object_changes WHERE seq > ? AND seq <= ?", (watermark, current))}
+
+        if changed_ids:
+            rows = store.iterate("""SELECT master_id, filename, category, confidence FROM objects
+                                    WHERE master_id IN (SELECT master_id FROM object_changes WHERE seq > ? AND seq <= ?)
+                                    ORDER BY master_id""", (watermark, current))
+            # The old output is read while the new one is written to a temporary file
+            entries = _merge_descriptions(_read_descriptions(output_file, output_format),
+                                          _group_descriptions(rows), changed_ids)
+            _write_descriptions(output_file, output_format, entries)
+
+        count = len(changed_ids)
+        logger.info(f"Regenerated descriptions for {count} changed images")
+
+    with store.transaction() as cursor:
+        cursor.execute("INSERT OR REPLACE INTO export_state (output_file, watermark) VALUES (?, ?)", (key, current))
+        prune_object_changes(cursor)
+
+    return count
+
+def get_image_descriptions(db_path, master_id):
+    """
+    Get descriptions for all objects in a specific image.
+    """
+    results = get_store(db_path).query("SELECT filename, category, confidence FROM objects WHERE master_id = ?",
+                                       (master_id,))
+
+    return [describe_object(filename, category, confidence) for filename, category, confidence in results]
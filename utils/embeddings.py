@@ -0,0 +1,219 @@
+import itertools
+import logging
+import os
+import struct
+import numpy as np
+from utils.storage import get_store
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Embedding file layout: this header, then one float32 row of `dim` values per stored embedding
+HEADER = struct.Struct("<4sI8x")
+MAGIC = b"EMB1"
+
+def embeddings_path(db_path):
+    return os.path.splitext(db_path)[0] + ".embeddings"
+
+def _read_dim(path):
+    with open(path, 'rb') as f:
+        magic, dim = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not an embedding file")
+    return dim
+
+def save_object_embeddings(db_path, object_ids, embeddings):
+    """
+    Append float32 embeddings to the database's embedding file and map each object id to its row.
+    The rows are written before the mapping commits, so a crash can only leave unreferenced rows behind.
+    """
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    if len(object_ids) == 0:
+        return
+
+    store = get_store(db_path)
+    path = embeddings_path(db_path)
+    dim = embeddings.shape[1]
+    row_bytes = dim * embeddings.itemsize
+
+    with store.lock:
+        if not os.path.exists(path) or os.path.getsize(path) < HEADER.size:
+            with open(path, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, dim))
+        elif _read_dim(path) != dim:
+            raise ValueError(f"Embedding dimension {dim} does not match {path} ({_read_dim(path)})")
+
+        with open(path, 'r+b') as f:
+            # Drop a partially written trailing row left by an interrupted append
+            first_row = (f.seek(0, os.SEEK_END) - HEADER.size) // row_bytes
+            f.seek(HEADER.size + first_row * row_bytes)
+            f.write(embeddings.tobytes())
+            f.truncate()
+
+        with store.transaction() as cursor:
+            cursor.executemany("INSERT OR REPLACE INTO object_embeddings (object_id, row) VALUES (?, ?)",
+                               zip(object_ids, range(first_row, first_row + len(object_ids))))
+
+    metrics.increment('embeddings.written', len(object_ids))
+
+def load_object_embeddings(db_path):
+    """
+    Memory-map the embedding file. Returns the ids of stored objects that still exist
+    and a read-only (n, dim) float32 array of their embeddings in the same order.
+    """
+    path = embeddings_path(db_path)
+    rows = get_store(db_path).query('''SELECT e.object_id, e.row FROM object_embeddings e
+                                       JOIN objects o ON o.id = e.object_id ORDER BY e.row''')
+    if not rows or not os.path.exists(path):
+        return [], np.zeros((0, 0), dtype=np.float32)
+
+    dim = _read_dim(path)
+    count = (os.path.getsize(path) - HEADER.size) // (dim * 4)
+    matrix = np.memmap(path, dtype=np.float32, mode='r', offset=HEADER.size, shape=(count, dim))
+
+    object_ids = [object_id for object_id, _ in rows]
+    row_indices = np.fromiter((row for _, row in rows), dtype=np.int64, count=len(rows))
+    if len(row_indices) == count and np.array_equal(row_indices, np.arange(count)):
+        return object_ids, matrix
+    return object_ids, matrix[row_indices]
+
+def iter_object_embeddings(db_path, chunk_size=65536):
+    """
+    Yield (object_ids, embeddings) chunks for the stored objects that still exist,
+    copying only one chunk at a time out of the memory-mapped file.
+    """
+    path = embeddings_path(db_path)
+    if not os.path.exists(path):
+        return
+
+    dim = _read_dim(path)
+    count = (os.path.getsize(path) - HEADER.size) // (dim * 4)
+    matrix = np.memmap(path, dtype=np.float32, mode='r', offset=HEADER.size, shape=(count, dim))
+
+    rows = get_store(db_path).iterate('''SELECT e.object_id, e.row FROM object_embeddings e
+                                         JOIN objects o ON o.id = e.object_id ORDER BY e.row''', batch_size=chunk_size)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            return
+        row_indices = np.fromiter((row for _, row in chunk), dtype=np.int64, count=len(chunk))
+        yield [object_id for object_id, _ in chunk], matrix[row_indices]
+
+def get_object_embedding(db_path, object_id):
+    """
+    Stored embedding of one object, or None if it has none.
+    """
+    rows = get_store(db_path).query("SELECT row FROM object_embeddings WHERE object_id = ?", (object_id,))
+    path = embeddings_path(db_path)
+    if not rows or not os.path.exists(path):
+        return None
+
+    dim = _read_dim(path)
+    with open(path, 'rb') as f:
+        f.seek(HEADER.size + rows[0][0] * dim * 4)
+        return np.frombuffer(f.read(dim * 4), dtype=np.float32)
+
+class SimilarityIndex:
+    """
+    k-nearest-neighbour search over L2-normalized embeddings by inner product (cosine similarity).
+    Brute force by default; with n_lists, an IVF partitioning groups the rows under k-means
+    centroids and a query only scans the n_probe lists whose centroids are closest.
+    """
+    def __init__(self, object_ids, embeddings, n_lists=None, n_probe=8, iterations=10, seed=0):
+        self.object_ids = list(object_ids)
+        self.embeddings = embeddings
+        self.n_probe = n_probe
+        self.centroids = None
+        if n_lists and len(self.object_ids) > n_lists:
+            self.build_ivf(n_lists, iterations, seed)
+
+    @classmethod
+    def from_database(cls, db_path, **kwargs):
+        object_ids, embeddings = load_object_embeddings(db_path)
+        return cls(object_ids, embeddings, **kwargs)
+
+    def __len__(self):
+        return len(self.object_ids)
+
+    def build_ivf(self, n_lists, iterations=10, seed=0):
+        """
+        Spherical k-means over the embeddings, then store the rows grouped by list
+        so each probed list is one contiguous slice.
+        """
+        embeddings = np.asarray(self.embeddings, dtype=np.float32)
+        rng = np.random.default_rng(seed)
+        centroids = embeddings[rng.choice(len(embeddings), n_lists, replace=False)].copy()
+
+        for _ in range(iterations):
+            assignments = np.argmax(embeddings @ centroids.T, axis=1)
+            for list_id in range(n_lists):
+                members = embeddings[assignments == list_id]
+                if len(members):
+                    centroid = members.sum(axis=0)
+                    centroids[list_id] = centroid / max(np.linalg.norm(centroid), 1e-12)
+
+        assignments = np.argmax(embeddings @ centroids.T, axis=1)
+        order = np.argsort(assignments, kind='stable')
+        self.centroids = centroids
+        self.embeddings = embeddings[order]
+        self.object_ids = [self.object_ids[i] for i in order]
+        self.list_offsets = np.searchsorted(assignments[order], np.arange(n_lists + 1))
+        logger.info(f"Built IVF index with {n_lists} lists over {len(order)} embeddings")
+
+    def _candidates(self, query):
+        """
+        Row ranges to scan for a query: everything, or the n_probe closest IVF lists.
+        """
+        if self.centroids is None:
+            return [(0, len(self.object_ids))]
+        n_probe = min(self.n_probe, len(self.centroids))
+        probed = np.argpartition(-(self.centroids @ query), n_probe - 1)[:n_probe]
+        return [(self.list_offsets[i], self.list_offsets[i + 1]) for i in sorted(probed)]
+
+    def search(self, query, k=10, exclude=()):
+        """
+        Return up to k (object_id, similarity) pairs for one query embedding, best first.
+        """
+        if not self.object_ids:
+            return []
+
+        with metrics.timer('similarity.search'):
+            query = np.asarray(query, dtype=np.float32).ravel()
+            query = query / max(np.linalg.norm(query), 1e-12)
+            exclude = set(exclude)
+
+            ranges = self._candidates(query)
+            scores = np.concatenate([self.embeddings[start:end] @ query for start, end in ranges])
+            rows = np.concatenate([np.arange(start, end) for start, end in ranges]) if len(ranges) > 1 else None
+
+            wanted = min(k + len(exclude), len(scores))
+            if wanted == 0:
+                return []
+            top = np.argpartition(-scores, wanted - 1)[:wanted]
+            top = top[np.argsort(-scores[top])]
+
+            results = []
+            for i in top:
+                object_id = self.object_ids[ranges[0][0] + i if rows is None else rows[i]]
+                if object_id not in exclude:
+                    results.append((object_id, float(scores[i])))
+            return results[:k]
+
+def find_similar_objects(db_path, object_id=None, crop=None, k=10, identification_model=None, index=None):
+    """
+    Find the k objects most similar to a stored object, or to a crop (path, PIL image or array)
+    embedded with identification_model. Pass a prebuilt SimilarityIndex to avoid reloading it per query.
+    """
+    if index is None:
+        index = SimilarityIndex.from_database(db_path)
+
+    if object_id is not None:
+        query = get_object_embedding(db_path, object_id)
+        if query is None:
+            raise KeyError(f"No embedding stored for object {object_id}")
+        return index.search(query, k, exclude=(object_id,))
+
+    if crop is None or identification_model is None:
+        raise ValueError("Pass an object_id, or a crop together with an identification_model")
+    query = identification_model.encode_images([identification_model.load_crop(crop)])[0]
+    return index.search(query.cpu().numpy(), k)
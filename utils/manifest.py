@@ -0,0 +1,166 @@
+import collections
+import logging
+import os
+import threading
+import time
+from utils.preprocessing import iter_image_files
+from utils.result_cache import image_content_hash
+from utils.storage import get_store
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+class IngestManifest:
+    """
+    Incremental ingestion of a directory tree, backed by the ingest_manifest table
+    (path, size, mtime, content hash -> master_id).
+    scan() yields only files that are new or whose content changed. Callers report each one
+    with record() once its rows are stored, or release() if it failed. The scan position below
+    which every file is settled is checkpointed, so an interrupted ingest resumes there
+    instead of walking the whole tree again.
+    """
+    def __init__(self, db_path, root, recursive=True, checkpoint_every=1000):
+        self.store = get_store(db_path)
+        self.root = os.path.abspath(root)
+        self.recursive = recursive
+        self.checkpoint_every = checkpoint_every
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.order = collections.deque()
+        self.settled = set()
+        self.position = None
+        self.unsaved = 0
+        self.scan_complete = False
+
+    def load_checkpoint(self):
+        rows = self.store.query("SELECT position FROM ingest_checkpoints WHERE root = ?", (self.root,))
+        return rows[0][0] if rows else None
+
+    def _execute(self, sql, params):
+        with self.store.transaction() as cursor:
+            cursor.execute(sql, params)
+
+    def _save_checkpoint(self, position, cursor=None):
+        params = (self.root, os.path.relpath(position, self.root).replace(os.sep, '/'), time.time())
+        sql = "INSERT OR REPLACE INTO ingest_checkpoints (root, position, updated_at) VALUES (?, ?, ?)"
+        if cursor is not None:
+            cursor.execute(sql, params)
+        else:
+            self._execute(sql, params)
+
+    def scan(self):
+        """
+        Lazily yield the paths under root that still need ingesting, resuming after the last checkpoint.
+        A file whose size and mtime match its manifest entry is skipped without being read; one whose
+        content hash matches despite a new mtime has its entry refreshed and is skipped too.
+        """
+        start_after = self.load_checkpoint()
+        if start_after:
+            logger.info(f"Resuming scan of {self.root} after {start_after}")
+
+        for entry in iter_image_files(self.root, self.recursive, start_after):
+            path = entry.path
+            with self.lock:
+                self.order.append(path)
+            stat = entry.stat()
+            metrics.increment('manifest.scanned')
+
+            rows = self.store.query("SELECT size, mtime_ns, content_hash FROM ingest_manifest WHERE path = ?", (path,))
+            if rows and rows[0][:2] == (stat.st_size, stat.st_mtime_ns):
+                self._settle(path)
+                continue
+
+            content_hash = image_content_hash(path)
+            if rows and rows[0][2] == content_hash:
+                self._execute("UPDATE ingest_manifest SET size = ?, mtime_ns = ? WHERE path = ?",
+                              (stat.st_size, stat.st_mtime_ns, path))
+                self._settle(path)
+                continue
+
+            with self.lock:
+                self.pending[path] = (stat.st_size, stat.st_mtime_ns, content_hash)
+            metrics.increment('manifest.pending')
+            yield path
+
+        with self.lock:
+            self.scan_complete = True
+
+    def content_hash(self, path):
+        """
+        Content hash computed by the scan for a pending path.
+        """
+        with self.lock:
+            entry = self.pending.get(path)
+        return entry[2] if entry else None
+
+    def record(self, path, master_id, cursor=None):
+        """
+        Mark a scanned file as ingested under master_id. Pass the cursor of the transaction
+        that stores its rows to make both (and any checkpoint it completes) visible together.
+        The objects of an earlier version of the file are deleted with its old entry, unless
+        another path still refers to them.
+        """
+        if cursor is None:
+            with self.store.transaction() as cursor:
+                self._write_entry(cursor, path, master_id)
+            self._settle(path)
+        else:
+            self._write_entry(cursor, path, master_id)
+            self._settle(path, cursor)
+
+    def _write_entry(self, cursor, path, master_id):
+        with self.lock:
+            size, mtime_ns, content_hash = self.pending[path]
+        row = cursor.execute("SELECT master_id FROM ingest_manifest WHERE path = ?", (path,)).fetchone()
+        previous = row[0] if row else None
+        if previous is not None and previous != master_id and not cursor.execute(
+                "SELECT 1 FROM ingest_manifest WHERE master_id = ? AND path != ?", (previous, path)).fetchone():
+            # The cache entry goes too, or a hit on the old content would find no objects
+            cursor.execute("DELETE FROM objects WHERE master_id = ?", (previous,))
+            cursor.execute("DELETE FROM image_cache WHERE master_id = ?", (previous,))
+            logger.info(f"Superseded objects of {previous} for changed file {path}")
+        cursor.execute("""INSERT OR REPLACE INTO ingest_manifest
+                          (path, size, mtime_ns, content_hash, master_id, ingested_at)
+                          VALUES (?, ?, ?, ?, ?, ?)""", (path, size, mtime_ns, content_hash, master_id, time.time()))
+
+    def release(self, path):
+        """
+        Give up on a scanned file for this run; with no manifest entry it is offered again by the next full scan.
+        """
+        self._settle(path)
+
+    def _settle(self, path, cursor=None):
+        """
+        Advance the scan position over every leading file of the scan order that is settled,
+        checkpointing it every checkpoint_every files. The database is written outside self.lock,
+        since callers may already hold the store's lock.
+        """
+        with self.lock:
+            self.pending.pop(path, None)
+            self.settled.add(path)
+            while self.order and self.order[0] in self.settled:
+                self.position = self.order.popleft()
+                self.settled.discard(self.position)
+                self.unsaved += 1
+            position = None
+            if self.unsaved >= self.checkpoint_every:
+                position, self.unsaved = self.position, 0
+
+        if position is not None:
+            self._save_checkpoint(position, cursor)
+
+    def finish(self):
+        """
+        Clear the checkpoint after a scan that ran to the end with every file settled,
+        so the next run walks the whole tree for new files; otherwise save how far it got.
+        Returns True if the scan was complete.
+        """
+        with self.lock:
+            complete = self.scan_complete and not self.order
+            position = self.position
+
+        if complete:
+            self._execute("DELETE FROM ingest_checkpoints WHERE root = ?", (self.root,))
+        elif position is not None:
+            self._save_checkpoint(position)
+        return complete
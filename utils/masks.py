@@ -0,0 +1,129 @@
+import struct
+import numpy as np
+
+class BinaryMask:
+    """
+    Binary object mask stored as the bit-packed contents of its tight bounding box.
+    The full-frame mask is only materialized on request.
+    """
+    header = struct.Struct("<6I")
+
+    def __init__(self, image_size, box, packed):
+        self.image_size = tuple(image_size)  # (width, height) of the frame
+        self.box = tuple(int(v) for v in box)  # (x1, y1, x2, y2), exclusive ends
+        self.packed = packed
+
+    @classmethod
+    def from_array(cls, mask, threshold=0.5):
+        """
+        Build from a dense HxW mask (bool, or probabilities compared against threshold).
+        """
+        mask = np.asarray(mask)
+        if mask.dtype != np.bool_:
+            mask = mask > threshold
+        height, width = mask.shape
+
+        rows = np.flatnonzero(mask.any(axis=1))
+        cols = np.flatnonzero(mask.any(axis=0))
+        if rows.size == 0:
+            return cls((width, height), (0, 0, 0, 0), np.zeros(0, dtype=np.uint8))
+
+        box = (cols[0], rows[0], cols[-1] + 1, rows[-1] + 1)
+        return cls.from_crop(mask[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1], box, (width, height))
+
+    @classmethod
+    def from_tensor(cls, mask, threshold=0.5, origin=(0, 0), image_size=None):
+        """
+        Build from an HxW torch mask, thresholding and cropping on its device
+        so only the box contents are copied to the host.
+        The mask may be a window of a larger frame: origin is its (x, y) offset in a frame of image_size.
+        """
+        if mask.dtype.is_floating_point:
+            mask = mask > threshold
+        height, width = mask.shape
+        ox, oy = origin
+        image_size = image_size or (width, height)
+
+        rows = mask.any(dim=1).nonzero()
+        cols = mask.any(dim=0).nonzero()
+        if rows.numel() == 0:
+            return cls(image_size, (0, 0, 0, 0), np.zeros(0, dtype=np.uint8))
+
+        y1, y2 = int(rows[0]), int(rows[-1]) + 1
+        x1, x2 = int(cols[0]), int(cols[-1]) + 1
+        return cls.from_crop(mask[y1:y2, x1:x2].cpu().numpy(), (x1 + ox, y1 + oy, x2 + ox, y2 + oy), image_size)
+
+    @classmethod
+    def from_crop(cls, crop, box, image_size):
+        return cls(image_size, box, np.packbits(crop, axis=None))
+
+    @classmethod
+    def from_bytes(cls, data):
+        width, height, x1, y1, x2, y2 = cls.header.unpack_from(data)
+        packed = np.frombuffer(data, dtype=np.uint8, offset=cls.header.size)
+        return cls((width, height), (x1, y1, x2, y2), packed)
+
+    def to_bytes(self):
+        return self.header.pack(*self.image_size, *self.box) + self.packed.tobytes()
+
+    @property
+    def shape(self):
+        return self.image_size[1], self.image_size[0]
+
+    @property
+    def crop_shape(self):
+        x1, y1, x2, y2 = self.box
+        return y2 - y1, x2 - x1
+
+    def is_empty(self):
+        return self.box[2] <= self.box[0] or self.box[3] <= self.box[1]
+
+    def crop(self):
+        """
+        Decode the bool mask of the tight bounding box.
+        """
+        crop_height, crop_width = self.crop_shape
+        count = crop_height * crop_width
+        return np.unpackbits(self.packed, count=count).view(np.bool_).reshape(crop_height, crop_width)
+
+    def region(self, x1, y1, x2, y2):
+        """
+        Decode the bool mask of an arbitrary window of the frame.
+        """
+        region = np.zeros((y2 - y1, x2 - x1), dtype=np.bool_)
+        bx1, by1, bx2, by2 = self.box
+        ix1, iy1 = max(x1, bx1), max(y1, by1)
+        ix2, iy2 = min(x2, bx2), min(y2, by2)
+        if ix2 > ix1 and iy2 > iy1:
+            region[iy1 - y1:iy2 - y1, ix1 - x1:ix2 - x1] = self.crop()[iy1 - by1:iy2 - by1, ix1 - bx1:ix2 - bx1]
+        return region
+
+    def to_array(self):
+        """
+        Decode the full-frame HxW bool mask.
+        """
+        return self.region(0, 0, *self.image_size)
+
+    def area(self):
+        return int(np.unpackbits(self.packed).sum())
+
+    def offset(self, dx, dy, image_size):
+        """
+        The same mask placed at (dx, dy) inside a larger frame of image_size, sharing the packed bits.
+        """
+        x1, y1, x2, y2 = self.box
+        if self.is_empty():
+            return BinaryMask(image_size, (0, 0, 0, 0), self.packed)
+        return BinaryMask(image_size, (x1 + dx, y1 + dy, x2 + dx, y2 + dy), self.packed)
+
+    def union(self, other):
+        """
+        Mask of the pixels set in either mask (same frame).
+        """
+        if self.is_empty():
+            return other
+        if other.is_empty():
+            return self
+        box = (min(self.box[0], other.box[0]), min(self.box[1], other.box[1]),
+               max(self.box[2], other.box[2]), max(self.box[3], other.box[3]))
+        return BinaryMask.from_crop(self.region(*box) | other.region(*box), box, self.image_size)
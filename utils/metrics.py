@@ -0,0 +1,132 @@
+import cProfile
+import functools
+import io
+import json
+import logging
+import pstats
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+class MetricsRegistry:
+    """
+    In-process counters, summaries (count/sum/max of observed values) and peak gauges.
+    All updates take one lock, so recording is cheap and thread-safe.
+    """
+    def __init__(self, prefix="segmentation"):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.summaries = {}
+            self.peaks = {}
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        with self.lock:
+            summary = self.summaries.get(name)
+            if summary is None:
+                self.summaries[name] = {'count': 1, 'sum': value, 'max': value}
+            else:
+                summary['count'] += 1
+                summary['sum'] += value
+                summary['max'] = max(summary['max'], value)
+
+    def record_peak(self, name, value):
+        with self.lock:
+            self.peaks[name] = max(self.peaks.get(name, value), value)
+
+    @contextmanager
+    def timer(self, name):
+        """
+        Observe the wall time of a block under `<name>.seconds`.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(f"{name}.seconds", time.perf_counter() - started)
+
+    def timed(self, name):
+        """
+        Decorator form of timer.
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record_tensor_memory(self, name, tensors):
+        """
+        Track the peak bytes held by a group of tensors, plus the CUDA allocator peak when on GPU.
+        """
+        total = sum(tensor.element_size() * tensor.nelement() for tensor in tensors)
+        self.record_peak(f"{name}.tensor_bytes", total)
+
+        import torch
+        if torch.cuda.is_available():
+            self.record_peak("cuda.max_memory_allocated_bytes", torch.cuda.max_memory_allocated())
+
+    def snapshot(self):
+        with self.lock:
+            summaries = {}
+            for name, summary in self.summaries.items():
+                summaries[name] = dict(summary, mean=summary['sum'] / summary['count'])
+            return {'counters': dict(self.counters), 'summaries': summaries, 'peaks': dict(self.peaks)}
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.snapshot(), **kwargs)
+
+    def _metric_name(self, name):
+        return re.sub(r'[^a-zA-Z0-9_]', '_', f"{self.prefix}_{name}")
+
+    def to_prometheus(self):
+        """
+        Render the metrics in the Prometheus text exposition format.
+        """
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in sorted(snapshot['counters'].items()):
+            metric = self._metric_name(name) + "_total"
+            lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+        for name, summary in sorted(snapshot['summaries'].items()):
+            metric = self._metric_name(name)
+            lines += [f"# TYPE {metric} summary", f"{metric}_count {summary['count']}", f"{metric}_sum {summary['sum']}",
+                      f"# TYPE {metric}_max gauge", f"{metric}_max {summary['max']}"]
+        for name, value in sorted(snapshot['peaks'].items()):
+            metric = self._metric_name(name) + "_peak"
+            lines += [f"# TYPE {metric} gauge", f"{metric} {value}"]
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+
+@contextmanager
+def profile(output_path=None, sort_by="cumulative", limit=30):
+    """
+    Run a block under cProfile; dump the stats to output_path, or log the top entries.
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        if output_path:
+            profiler.dump_stats(output_path)
+            logger.info(f"Wrote profile to {output_path}")
+        else:
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats(sort_by).print_stats(limit)
+            logger.info(stream.getvalue())
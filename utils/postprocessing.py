@@ -93,94 +93,187 @@ import os
 import uuid
 import json
 import sqlite3
+import queue
+import threading
+import atexit
 from PIL import Image
 import numpy as np
+from utils.masks import BinaryMask
+from utils.storage import get_store
+from utils.embeddings import save_object_embeddings
+from utils.metrics import metrics
 
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-def extract_and_save_objects(segmented_objects, original_image, input_image_path, output_dir, db_path):
+def save_image(image, path):
+    """
+    Save an image, recording save time and bytes written.
+    """
+    with metrics.timer('crops.save'):
+        image.save(path)
+    metrics.increment('crops.written')
+    metrics.increment('crops.bytes_written', os.path.getsize(path))
+
+class CropWriter:
+    """
+    Background thread that saves object crops to disk through a bounded queue.
+    """
+    def __init__(self, max_queue_size=64):
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.thread = threading.Thread(target=self._run, name="crop-writer", daemon=True)
+        self.closed = False
+        self.thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                image, path = item
+                save_image(image, path)
+                logger.debug(f"Saved object image to {path}")
+            except Exception as e:
+                logger.error(f"Failed to save object image: {e}")
+            finally:
+                self.queue.task_done()
+
+    def submit(self, image, path):
+        """
+        Queue a crop for saving; blocks while the queue is full.
+        """
+        if self.closed:
+            raise RuntimeError("CropWriter is closed")
+        self.queue.put((image, path))
+
+    def flush(self):
+        """
+        Block until every queued crop has been written.
+        """
+        self.queue.join()
+
+    def close(self):
+        """
+        Flush pending crops and stop the writer thread.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+
+def clip_box(bbox, width, height):
+    """
+    Round a float (x1, y1, x2, y2) box outwards to integer pixel bounds inside the image.
+    """
+    x1, y1, x2, y2 = bbox
+    x1 = min(max(int(np.floor(x1)), 0), width)
+    y1 = min(max(int(np.floor(y1)), 0), height)
+    x2 = min(max(int(np.ceil(x2)), x1), width)
+    y2 = min(max(int(np.ceil(y2)), y1), height)
+    return x1, y1, x2, y2
+
+def extract_object_crop(frame, mask, bbox):
+    """
+    Cut one object out of an HxWx3 uint8 frame using its BinaryMask, looking only inside its detector box.
+    Returns a uint8 RGBA crop tightened to the mask (pixels outside it are zero/transparent)
+    and its (x1, y1, x2, y2) box in frame coordinates with exclusive ends, or (None, None) if the mask is empty.
+    """
+    height, width = frame.shape[:2]
+    x1, y1, x2, y2 = clip_box(bbox, width, height)
+
+    mask_region = mask.region(x1, y1, x2, y2)
+    rows = np.flatnonzero(mask_region.any(axis=1))
+    cols = np.flatnonzero(mask_region.any(axis=0))
+    if rows.size == 0:
+        return None, None
+
+    top, bottom = rows[0], rows[-1] + 1
+    left, right = cols[0], cols[-1] + 1
+    mask_region = mask_region[top:bottom, left:right]
+
+    crop = np.zeros(mask_region.shape + (4,), dtype=np.uint8)
+    crop[..., :3] = frame[y1 + top:y1 + bottom, x1 + left:x1 + right]
+    crop[..., :3] *= mask_region[..., np.newaxis]
+    crop[..., 3] = mask_region * np.uint8(255)
+
+    return crop, (int(x1 + left), int(y1 + top), int(x1 + right), int(y1 + bottom))
+
+@metrics.timed('extract')
+def extract_and_save_objects(segmented_objects, original_image, input_image_path, output_dir, db_path, crop_writer=None,
+                             save_metadata=True, master_id=None, crop_store=None):
     """
     Extract each segmented object, save it as a separate image, and store metadata in SQLite database.
+    Each returned object carries its crop under 'image' so callers need not reload it from disk.
+    If a crop_writer is given, saving happens on its background thread.
+    With a crop_store (utils.crop_store.CropStore) the crops are appended to its shards instead of
+    written as PNG files, and 'filename' holds the '<shard>#<offset>' location.
+    With save_metadata=False the rows are left for the caller to write with save_object_metadata.
     """
     logger.debug(f"Starting extraction with {len(segmented_objects)} segmented objects")
 
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    # Ensure the directory for the database exists
-    db_dir = os.path.dirname(db_path)
-    if not os.path.exists(db_dir):
-        os.makedirs(db_dir)
-
     # Generate a master ID for the original image
-    master_id = str(uuid.uuid4())
+    if master_id is None:
+        master_id = str(uuid.uuid4())
 
-    # Connect to SQLite database
     try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-
-        # Create table if it doesn't exist
-        cursor.execute('''CREATE TABLE IF NOT EXISTS objects
-                  (id TEXT PRIMARY KEY, master_id TEXT, filename TEXT, bbox TEXT, 
-                  category TEXT, confidence REAL)''')
-
         extracted_objects = []
+        frame = np.asarray(original_image.convert("RGB"))
+        debug = logger.isEnabledFor(logging.DEBUG)
 
-        for i, mask in enumerate(segmented_objects):
-            logger.debug(f"Processing object {i+1}")
+        for i, obj in enumerate(segmented_objects):
+            if debug:
+                logger.debug(f"Processing object {i+1}")
 
             # Generate a unique ID for the object
             object_id = str(uuid.uuid4())
 
-            # Extract the object using the mask
-            mask = mask.squeeze()
-            logger.debug(f"Mask shape: {mask.shape}")
-            logger.debug(f"Mask unique values: {np.unique(mask)}")
-
-            object_image = np.array(original_image) * mask[..., np.newaxis]
-            object_image = Image.fromarray(object_image.astype(np.uint8))
-
-            # Calculate bounding box
-            bbox = mask.nonzero()
-            logger.debug(f"Bounding box coordinates: {bbox}")
-
-            if bbox[0].size > 0 and bbox[1].size > 0:
-                min_y, max_y = int(bbox[0].min()), int(bbox[0].max())
-                min_x, max_x = int(bbox[1].min()), int(bbox[1].max())
-                bbox = (min_x, min_y, max_x, max_y)
-            else:
-                logger.warning(f"No clear bounding box for object {i+1}, using full image")
-                bbox = (0, 0, original_image.width, original_image.height)
+            mask = obj['mask']
+            if not isinstance(mask, BinaryMask):
+                mask = BinaryMask.from_array(np.squeeze(mask))
 
-            logger.debug(f"Final bounding box: {bbox}")
+            # Extract the object inside its detector box only
+            crop, bbox = extract_object_crop(frame, mask, obj['bbox'])
+            if crop is None:
+                logger.warning(f"Empty mask for object {i+1}, skipping")
+                continue
 
-            # Crop the object image
-            object_image = object_image.crop(bbox)
+            if debug:
+                logger.debug(f"Final bounding box: {bbox}")
+            object_image = Image.fromarray(crop, mode="RGBA")
 
             # Save the object image
-            object_filename = f"{object_id}.png"
-            object_path = os.path.join(output_dir, object_filename)
-            object_image.save(object_path)
-            logger.debug(f"Saved object image to {object_path}")
-
-            # Store metadata in the database
-            cursor.execute("""INSERT INTO objects 
-                  (id, master_id, filename, bbox, category, confidence) 
-                  VALUES (?, ?, ?, ?, ?, ?)""",
-               (object_id, master_id, object_filename, json.dumps(bbox), None, None))
+            if crop_store is not None:
+                object_filename = crop_store.append(object_id, crop)
+            else:
+                object_filename = f"{object_id}.png"
+                object_path = os.path.join(output_dir, object_filename)
+                if crop_writer is not None:
+                    crop_writer.submit(object_image, object_path)
+                else:
+                    save_image(object_image, object_path)
+                    if debug:
+                        logger.debug(f"Saved object image to {object_path}")
 
             extracted_objects.append({
                 'id': object_id,
                 'master_id': master_id,
                 'filename': object_filename,
-                'bbox': bbox
+                'bbox': bbox,
+                'mask': mask,
+                'image': object_image,
+                'detector_label': obj.get('label'),
+                'detector_score': obj.get('score')
             })
 
-        # Commit changes and close the database connection
-        conn.commit()
-        conn.close()
+        metrics.observe('extract.objects_per_image', len(extracted_objects))
+
+        if save_metadata:
+            save_object_metadata(db_path, extracted_objects)
 
         logger.debug(f"Extracted {len(extracted_objects)} objects")
         return extracted_objects
@@ -193,28 +286,74 @@ def extract_and_save_objects(segmented_objects, original_image, input_image_path
         logger.error(f"An error occurred: {e}")
         raise  # Re-raise the exception
 
+def object_row(obj):
+    """
+    The objects table row (in INSERT_OBJECT_SQL column order) for an extracted object.
+    """
+    return (obj['id'], obj['master_id'], obj['filename'], json.dumps(obj['bbox']),
+            obj.get('category'), obj.get('confidence'), obj['mask'].to_bytes(), obj.get('label_source'))
+
+def save_object_metadata(db_path, extracted_objects):
+    """
+    Insert the rows for one image's extracted objects in a single transaction,
+    then store the image embeddings of the objects that carry one.
+    """
+    get_store(db_path).insert_objects([object_row(obj) for obj in extracted_objects])
+
+    embedded = [obj for obj in extracted_objects if obj.get('embedding') is not None]
+    if embedded:
+        save_object_embeddings(db_path, [obj['id'] for obj in embedded], np.stack([obj['embedding'] for obj in embedded]))
+
+# Fixed visualization palette; entry 0 (background) is black, objects cycle through entries 1-255
+PALETTE = np.random.default_rng(0).integers(0, 255, (256, 3), dtype=np.uint8)
+PALETTE[0] = 0
+
+def build_label_map(segmented_objects, width, height):
+    """
+    Paint every object's mask into one HxW uint8 palette-index map, touching only each mask's box.
+    Later objects win where masks overlap.
+    """
+    label_map = np.zeros((height, width), dtype=np.uint8)
+    for i, obj in enumerate(segmented_objects):
+        mask = obj['mask']
+        if not isinstance(mask, BinaryMask):
+            mask = BinaryMask.from_array(np.squeeze(mask))
+        x1, y1, x2, y2 = mask.box
+        label_map[y1:y2, x1:x2][mask.crop()] = i % 255 + 1
+    return label_map
+
+def blend_label_map(image, label_map, alpha=0.5):
+    """
+    Blend palette colors over an RGB image in 8-bit fixed point: (image * (256 - a) + color * a) >> 8.
+    """
+    weight = int(round(alpha * 256))
+    blended = np.asarray(image.convert("RGB"), dtype=np.uint16) * np.uint16(256 - weight)
+    blended += (PALETTE.astype(np.uint16) * np.uint16(weight))[label_map]
+    blended >>= 8
+    return Image.fromarray(blended.astype(np.uint8))
+
 def save_visualization(visualized_image, output_path):
     """
     Save the visualization of segmented objects.
     """
-    visualized_image.save(output_path)
+    with metrics.timer('visualize.save'):
+        visualized_image.save(output_path)
+    metrics.increment('visualize.bytes_written', os.path.getsize(output_path))
 
 def update_object_metadata(db_path, object_id, category, confidence):
     """
     Update the category and confidence for an object in the database.
     """
-    try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-
-        cursor.execute("""UPDATE objects 
-                          SET category = ?, confidence = ?
-                          WHERE id = ?""",
-                       (category, confidence, object_id))
+    update_objects_metadata(db_path, [(object_id, category, confidence)])
 
-        conn.commit()
-        conn.close()
+def update_objects_metadata(db_path, updates):
+    """
+    Update category and confidence for many (object_id, category, confidence) tuples in one transaction.
+    """
+    try:
+        get_store(db_path).update_categories([(category, confidence, object_id)
+                                              for object_id, category, confidence in updates])
     except sqlite3.OperationalError as e:
         print(f"Error accessing the database: {e}")
     except Exception as e:
-        print(f"An error occurred: {e}")
\ No newline at end of file
+        print(f"An error occurred: {e}")
@@ -1,29 +1,146 @@
+import io
+import logging
+import math
 import os
+import threading
+import weakref
 from PIL import Image
 import numpy as np
+from utils.metrics import metrics
 
-def preprocess_image(image_path):
+logger = logging.getLogger(__name__)
+
+def resize_to_max_size(image, max_size):
+    """
+    Downscale a PIL image so its longer side is at most max_size (None keeps it as is).
+    """
+    if not max_size or max(image.size) <= max_size:
+        return image
+    scale = max_size / max(image.size)
+    size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    return image.resize(size, Image.BILINEAR)
+
+def load_image(source, max_size=None, full_resolution=True):
+    """
+    Decode an image (path, bytes or file object) once, as RGB. Returns (image, size), where size is
+    the source's full (width, height). With full_resolution=False and a max_size, a JPEG is decoded in
+    draft mode at the smallest DCT scale that still covers max_size, so image may be smaller than size.
+    """
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+
+    with metrics.timer('decode'):
+        image = Image.open(source)
+        size = image.size
+        if not full_resolution and max_size and image.format == 'JPEG' and max(size) > max_size:
+            scale = max_size / max(size)
+            image.draft('RGB', (math.ceil(size[0] * scale), math.ceil(size[1] * scale)))
+            metrics.increment('decode.draft')
+        image = image.convert("RGB")
+    return image, size
+
+def image_to_float32(image, out=None):
+    """
+    CHW float32 array in [0, 1] from an RGB PIL image (the values torchvision's to_tensor gives),
+    converted from uint8 in one pass into out if given.
+    """
+    pixels = np.asarray(image)
+    if out is None:
+        out = np.empty((pixels.shape[2],) + pixels.shape[:2], dtype=np.float32)
+    np.divide(pixels.transpose(2, 0, 1), np.float32(255), out=out)
+    return out
+
+class ArrayPool:
+    """
+    Reusable float32 buffers keyed by shape, so a decoded image is converted into memory left over
+    from an earlier one of the same size. Consumers hand a buffer back with release(address) when
+    done with it; buffers never released are garbage collected as usual.
+    """
+    def __init__(self, max_per_shape=4, max_shapes=8):
+        self.max_per_shape = max_per_shape
+        self.max_shapes = max_shapes
+        self.free = {}
+        self.outstanding = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, shape):
+        with self.lock:
+            buffers = self.free.get(shape)
+            buffer = buffers.pop() if buffers else None
+            if buffer is None:
+                buffer = np.empty(shape, dtype=np.float32)
+                metrics.increment('buffers.allocated')
+            else:
+                metrics.increment('buffers.reused')
+            self.outstanding[buffer.ctypes.data] = weakref.ref(buffer)
+            return buffer
+
+    def release(self, address):
+        """
+        Return the buffer at this data address to the pool; unknown addresses are ignored.
+        """
+        with self.lock:
+            reference = self.outstanding.pop(address, None)
+            buffer = reference() if reference is not None else None
+            if buffer is None:
+                return
+            # Reinsert the shape so the dict stays in least-recently-released order
+            buffers = self.free.pop(buffer.shape, [])
+            if len(buffers) < self.max_per_shape:
+                buffers.append(buffer)
+            self.free[buffer.shape] = buffers
+            if len(self.free) > self.max_shapes:
+                del self.free[next(iter(self.free))]
+
+def preprocess_image(image_path, max_size=1024):
     """
     Preprocess the input image for segmentation.
     """
-    image = Image.open(image_path).convert("RGB")
+    image, _ = load_image(image_path, max_size, full_resolution=False)
     
     # Resize image if it's too large
-    max_size = 1024
-    if max(image.size) > max_size:
-        image.thumbnail((max_size, max_size))
+    image = resize_to_max_size(image, max_size)
     
-    # Convert to numpy array and normalize
-    image_array = np.array(image) / 255.0
+    # Convert to a float32 array in [0, 1]
+    image_array = np.divide(np.asarray(image), np.float32(255))
     
     return image_array, image
 
+VALID_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+def iter_image_files(input_dir, recursive=False, start_after=None):
+    """
+    Lazily yield an os.DirEntry for each image file in input_dir (and its subdirectories if recursive),
+    in sorted path order. start_after, a '/'-separated path relative to input_dir, resumes the walk
+    after that file and skips whole directories that sort before it. An unreadable subdirectory is
+    skipped with a warning, but an input_dir that cannot be read raises its OSError.
+    """
+    resume = tuple(start_after.split('/')) if start_after else None
+    return _walk_image_files(input_dir, (), recursive, resume)
+
+def _walk_image_files(directory, parts, recursive, resume):
+    try:
+        with os.scandir(directory) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+    except OSError as e:
+        # A missing or unreadable input directory is an error; an unreadable subdirectory is skipped
+        if not parts:
+            raise
+        logger.warning(f"Cannot scan {directory}: {e}")
+        return
+
+    for entry in entries:
+        entry_parts = parts + (entry.name,)
+        if entry.is_dir(follow_symlinks=False):
+            # A directory can only hold files after the resume point if it sorts after it or contains it
+            if recursive and (resume is None or entry_parts >= resume[:len(entry_parts)]):
+                yield from _walk_image_files(entry.path, entry_parts, recursive, resume)
+        elif (os.path.splitext(entry.name)[1].lower() in VALID_EXTENSIONS and entry.is_file()
+              and (resume is None or entry_parts > resume)):
+            yield entry
+
 def get_image_paths(input_dir):
     """
     Get all image file paths from the input directory.
     """
-    valid_extensions = ['.jpg', '.jpeg', '.png', '.bmp']
-    image_paths = [os.path.join(input_dir, f) for f in os.listdir(input_dir)
-                   if os.path.isfile(os.path.join(input_dir, f)) and 
-                   os.path.splitext(f)[1].lower() in valid_extensions]
-    return image_paths
\ No newline at end of file
+    return [entry.path for entry in iter_image_files(input_dir)]
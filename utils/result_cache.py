@@ -0,0 +1,122 @@
+import hashlib
+import json
+import logging
+import struct
+import time
+from utils.crop_store import load_crop_image, crop_size
+from utils.masks import BinaryMask
+from utils.storage import get_store
+
+logger = logging.getLogger(__name__)
+
+def image_content_hash(image_path, chunk_size=1 << 20):
+    """
+    SHA-256 of the raw image file bytes (image_path may also be the bytes themselves).
+    """
+    if isinstance(image_path, (bytes, bytearray)):
+        return hashlib.sha256(image_path).hexdigest()
+    digest = hashlib.sha256()
+    with open(image_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def result_cache_key(content_hash, settings):
+    """
+    Combine an image content hash with the model/threshold settings that produced its results.
+    """
+    return hashlib.sha256((content_hash + json.dumps(settings, sort_keys=True)).encode('utf-8')).hexdigest()
+
+def lookup_cached_result(db_path, cache_key):
+    """
+    Return the master_id stored for cache_key, or None, marking the entry as recently used.
+    """
+    with get_store(db_path).transaction() as cursor:
+        row = cursor.execute("SELECT master_id FROM image_cache WHERE cache_key = ?", (cache_key,)).fetchone()
+        if row is None:
+            return None
+        cursor.execute("UPDATE image_cache SET last_used = ? WHERE cache_key = ?", (time.time(), cache_key))
+    return row[0]
+
+def record_cached_result(db_path, cache_key, content_hash, master_id):
+    now = time.time()
+    with get_store(db_path).transaction() as cursor:
+        # An upsert rather than INSERT OR REPLACE, whose implicit delete would skip the byte-total trigger
+        cursor.execute("""INSERT INTO image_cache (cache_key, content_hash, master_id, bytes, created_at, last_used)
+                          VALUES (?, ?, ?, NULL, ?, ?)
+                          ON CONFLICT (cache_key) DO UPDATE SET content_hash = excluded.content_hash,
+                          master_id = excluded.master_id, bytes = NULL, created_at = excluded.created_at,
+                          last_used = excluded.last_used""", (cache_key, content_hash, master_id, now, now))
+
+def forget_cached_result(db_path, cache_key):
+    with get_store(db_path).transaction() as cursor:
+        cursor.execute("DELETE FROM image_cache WHERE cache_key = ?", (cache_key,))
+
+def load_cached_objects(db_path, master_id, output_dir):
+    """
+    Rebuild the extracted object dicts of a previously processed image from the database and crop files.
+    Returns None if a crop is missing or unreadable (lost in a crash before it was written, or deleted).
+    """
+    rows = get_store(db_path).query("""SELECT id, filename, bbox, category, confidence, mask, label_source
+                                       FROM objects WHERE master_id = ?""", (master_id,))
+    extracted_objects = []
+    for object_id, filename, bbox, category, confidence, mask, label_source in rows:
+        try:
+            image = load_crop_image(output_dir, filename)
+            image.load()
+        except (OSError, ValueError, struct.error) as e:
+            logger.warning(f"Cached crop {filename} of {master_id} cannot be read: {e}")
+            return None
+        extracted_objects.append({
+            'id': object_id,
+            'master_id': master_id,
+            'filename': filename,
+            'bbox': tuple(json.loads(bbox)),
+            'mask': BinaryMask.from_bytes(mask) if mask is not None else None,
+            'image': image,
+            'category': category,
+            'confidence': confidence,
+            'label_source': label_source
+        })
+    return extracted_objects
+
+def _artifact_bytes(cursor, master_id, output_dir):
+    """
+    Size of the crop files of one cached image, or None while some are still being written.
+    """
+    total = 0
+    for (filename,) in cursor.execute("SELECT filename FROM objects WHERE master_id = ?", (master_id,)).fetchall():
+        try:
+            total += crop_size(output_dir, filename)
+        except OSError:
+            return None
+    return total
+
+def evict_cached_results(db_path, output_dir, max_bytes):
+    """
+    Drop the least recently used cache entries until the crops of the remaining entries fit in
+    max_bytes. Only the image_cache rows go: the object rows and their crops are the stored results
+    that descriptions, relabelling and search read, so an evicted image is simply segmented again
+    the next time it is seen. Entries whose crops are still being written are sized on a later call.
+    """
+    evicted = []
+    with get_store(db_path).transaction() as cursor:
+        for cache_key, master_id in cursor.execute(
+                "SELECT cache_key, master_id FROM image_cache WHERE bytes IS NULL").fetchall():
+            size = _artifact_bytes(cursor, master_id, output_dir)
+            if size is not None:
+                cursor.execute("UPDATE image_cache SET bytes = ? WHERE cache_key = ?", (size, cache_key))
+
+        total = cursor.execute("SELECT bytes FROM image_cache_totals").fetchone()[0]
+        while total > max_bytes:
+            cache_key, master_id, size = cursor.execute("""SELECT cache_key, master_id, bytes FROM image_cache
+                                                           WHERE bytes IS NOT NULL
+                                                           ORDER BY last_used LIMIT 1""").fetchone()
+            cursor.execute("DELETE FROM image_cache WHERE cache_key = ?", (cache_key,))
+            evicted.append(master_id)
+            total -= size
+
+    for master_id in evicted:
+        logger.info(f"Evicted cache entry for {master_id}")
+
+    return evicted
@@ -0,0 +1,252 @@
+import atexit
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+def table_columns(cursor, table):
+    return [row[1] for row in cursor.execute(f"PRAGMA table_info({table})")]
+
+def add_column(cursor, table, column, column_type):
+    """
+    Add a column unless an older version of the code already created it.
+    """
+    if column not in table_columns(cursor, table):
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+
+def _create_objects_table(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS objects
+                      (id TEXT PRIMARY KEY, master_id TEXT, filename TEXT, bbox TEXT,
+                      category TEXT, confidence REAL)''')
+
+def _add_mask_column(cursor):
+    add_column(cursor, "objects", "mask", "BLOB")
+
+def _add_objects_indexes(cursor):
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_objects_master_id ON objects (master_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_objects_category ON objects (category)")
+
+def _create_image_cache_table(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS image_cache
+                      (cache_key TEXT PRIMARY KEY, content_hash TEXT, master_id TEXT,
+                      bytes INTEGER, created_at REAL, last_used REAL)''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_image_cache_last_used ON image_cache (last_used)")
+
+def _create_change_tracking(cursor):
+    """
+    Log the master_id of every inserted, updated or deleted object with an increasing seq,
+    so exports can regenerate only what changed after their watermark.
+    """
+    cursor.execute('''CREATE TABLE IF NOT EXISTS object_changes
+                      (seq INTEGER PRIMARY KEY AUTOINCREMENT, master_id TEXT)''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS export_state
+                      (output_file TEXT PRIMARY KEY, watermark INTEGER)''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS objects_track_insert AFTER INSERT ON objects
+                      BEGIN INSERT INTO object_changes (master_id) VALUES (NEW.master_id); END''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS objects_track_update AFTER UPDATE ON objects
+                      BEGIN
+                          INSERT INTO object_changes (master_id)
+                          SELECT OLD.master_id UNION SELECT NEW.master_id;
+                      END''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS objects_track_delete AFTER DELETE ON objects
+                      BEGIN INSERT INTO object_changes (master_id) VALUES (OLD.master_id); END''')
+
+def _create_ingest_progress_table(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS ingest_progress
+                      (image_path TEXT PRIMARY KEY, master_id TEXT, worker INTEGER, finished_at REAL)''')
+
+def _create_object_embeddings_table(cursor):
+    """
+    Map object ids to their row in the memory-mapped embedding file next to the database.
+    """
+    cursor.execute('''CREATE TABLE IF NOT EXISTS object_embeddings
+                      (object_id TEXT PRIMARY KEY, row INTEGER NOT NULL)''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS objects_drop_embedding AFTER DELETE ON objects
+                      BEGIN DELETE FROM object_embeddings WHERE object_id = OLD.id; END''')
+
+def _add_label_source_column(cursor):
+    add_column(cursor, "objects", "label_source", "TEXT")
+
+def _track_changes_only_while_exporting(cursor):
+    """
+    Only log object changes while some output file has an incremental export watermark,
+    so databases that are never exported incrementally don't grow object_changes forever.
+    """
+    for name, event, body in [
+            ("objects_track_insert", "INSERT", "INSERT INTO object_changes (master_id) VALUES (NEW.master_id);"),
+            ("objects_track_update", "UPDATE",
+             "INSERT INTO object_changes (master_id) SELECT OLD.master_id UNION SELECT NEW.master_id;"),
+            ("objects_track_delete", "DELETE", "INSERT INTO object_changes (master_id) VALUES (OLD.master_id);")]:
+        cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+        cursor.execute(f'''CREATE TRIGGER {name} AFTER {event} ON objects
+                           WHEN EXISTS (SELECT 1 FROM export_state)
+                           BEGIN {body} END''')
+    prune_object_changes(cursor)
+
+def prune_object_changes(cursor):
+    """
+    Drop logged changes every incremental export has already seen (all of them when there are none).
+    """
+    cursor.execute("""DELETE FROM object_changes
+                      WHERE NOT EXISTS (SELECT 1 FROM export_state)
+                      OR seq <= (SELECT MIN(watermark) FROM export_state)""")
+
+def _create_image_cache_totals(cursor):
+    """
+    Running total of the sized image_cache entries' bytes, kept by triggers so eviction need not
+    sum the whole table, and an index on the entries whose size is still unknown.
+    """
+    cursor.execute('''CREATE TABLE IF NOT EXISTS image_cache_totals
+                      (id INTEGER PRIMARY KEY CHECK (id = 0), bytes INTEGER NOT NULL)''')
+    cursor.execute("INSERT OR REPLACE INTO image_cache_totals (id, bytes) "
+                   "SELECT 0, COALESCE(SUM(bytes), 0) FROM image_cache")
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS image_cache_total_insert AFTER INSERT ON image_cache
+                      WHEN NEW.bytes IS NOT NULL
+                      BEGIN UPDATE image_cache_totals SET bytes = bytes + NEW.bytes; END''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS image_cache_total_update AFTER UPDATE OF bytes ON image_cache
+                      BEGIN
+                          UPDATE image_cache_totals
+                          SET bytes = bytes + COALESCE(NEW.bytes, 0) - COALESCE(OLD.bytes, 0);
+                      END''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS image_cache_total_delete AFTER DELETE ON image_cache
+                      WHEN OLD.bytes IS NOT NULL
+                      BEGIN UPDATE image_cache_totals SET bytes = bytes - OLD.bytes; END''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_image_cache_unsized ON image_cache (cache_key) WHERE bytes IS NULL")
+
+def _create_ingest_manifest_tables(cursor):
+    """
+    Files already ingested from a directory tree, and how far an unfinished scan of each root got.
+    """
+    cursor.execute('''CREATE TABLE IF NOT EXISTS ingest_manifest
+                      (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, content_hash TEXT,
+                      master_id TEXT, ingested_at REAL)''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS ingest_checkpoints
+                      (root TEXT PRIMARY KEY, position TEXT, updated_at REAL)''')
+
+# Each entry upgrades the schema by one version; PRAGMA user_version records how many have run.
+MIGRATIONS = [
+    _create_objects_table,
+    _add_mask_column,
+    _add_objects_indexes,
+    _create_image_cache_table,
+    _create_change_tracking,
+    _create_ingest_progress_table,
+    _create_object_embeddings_table,
+    _add_label_source_column,
+    _create_ingest_manifest_tables,
+    _track_changes_only_while_exporting,
+    _create_image_cache_totals,
+]
+
+INSERT_OBJECT_SQL = """INSERT INTO objects
+                       (id, master_id, filename, bbox, category, confidence, mask, label_source)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?)"""
+
+class ObjectStore:
+    """
+    Persistent WAL-mode connection to the objects database, shared by all helpers for a given path.
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+        db_dir = os.path.dirname(db_path)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.migrate()
+
+    def migrate(self):
+        """
+        Apply any schema migrations the database has not seen yet.
+        """
+        with self.transaction() as cursor:
+            version = cursor.execute("PRAGMA user_version").fetchone()[0]
+            for index, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+                migration(cursor)
+                cursor.execute(f"PRAGMA user_version = {index}")
+                logger.info(f"Migrated {self.db_path} to schema version {index}")
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run a block of statements as one transaction, rolling back on error.
+        """
+        with self.lock, metrics.timer('db.transaction'):
+            cursor = self.conn.cursor()
+            cursor.execute("BEGIN")
+            try:
+                yield cursor
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+            else:
+                cursor.execute("COMMIT")
+            finally:
+                cursor.close()
+
+    def query(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def iterate(self, sql, params=(), batch_size=1000):
+        """
+        Stream the rows of a query from a separate read connection without loading them all.
+        """
+        conn = sqlite3.connect(self.db_path)
+        try:
+            cursor = conn.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield from rows
+        finally:
+            conn.close()
+
+    def insert_objects(self, rows):
+        """
+        Insert (id, master_id, filename, bbox, category, confidence, mask) rows in one transaction.
+        """
+        with self.transaction() as cursor:
+            cursor.executemany(INSERT_OBJECT_SQL, rows)
+
+    def update_categories(self, updates):
+        """
+        Set category and confidence for many objects from (category, confidence, id) tuples in one transaction.
+        """
+        with self.transaction() as cursor:
+            cursor.executemany("UPDATE objects SET category = ?, confidence = ? WHERE id = ?", updates)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def get_store(db_path):
+    """
+    Return the process-wide ObjectStore for db_path, opening it on first use.
+    """
+    key = os.path.abspath(db_path)
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            store = _stores[key] = ObjectStore(db_path)
+        return store
+
+def close_stores():
+    with _stores_lock:
+        for store in _stores.values():
+            store.close()
+        _stores.clear()
+
+atexit.register(close_stores)